@@ -0,0 +1,47 @@
+#Compares two benchmark result files written by run_benchmarks.py, stage by stage
+#    python benchmarks/compare_benchmarks.py benchmarks/results/before.json benchmarks/results/after.json
+import argparse
+import json
+
+#Changes smaller than this (as a ratio) are shown without a marker
+NOISE_RATIO = 0.1
+
+
+def load(path):
+    with open(path) as f:
+        report = json.load(f)
+    return report, {stage['stage']: stage for stage in report['stages']}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare two benchmark result files.")
+    parser.add_argument("before")
+    parser.add_argument("after")
+    parser.add_argument("--metric", default="wall_s", choices=["wall_s", "cpu_s", "peak_rss_mb", "rss_growth_mb"])
+    args = parser.parse_args()
+
+    before, before_stages = load(args.before)
+    after, after_stages = load(args.after)
+    print(f"before: {before.get('commit')} ({before.get('created')}), after: {after.get('commit')} ({after.get('created')})")
+    if before.get('params') != after.get('params'):
+        print(f"WARNING: the runs used different inputs: {before.get('params')} vs {after.get('params')}")
+
+    print(f"{'stage':<26} {'before':>10} {'after':>10} {'ratio':>7}")
+    for name in list(before_stages) + [name for name in after_stages if name not in before_stages]:
+        old = before_stages.get(name, {}).get(args.metric)
+        new = after_stages.get(name, {}).get(args.metric)
+        if old is None or new is None:
+            print(f"{name:<26} {str(old):>10} {str(new):>10}")
+            continue
+        ratio = new / old if old else float('inf')
+        marker = '' if abs(ratio - 1) < NOISE_RATIO else ('  slower' if ratio > 1 else '  faster')
+        if args.metric.endswith('_mb') and marker:
+            marker = '  more' if ratio > 1 else '  less'
+        print(f"{name:<26} {old:>10.3f} {new:>10.3f} {ratio:>6.2f}x{marker}")
+    if args.metric == 'wall_s':
+        print(f"{'total':<26} {before['total_wall_s']:>10.3f} {after['total_wall_s']:>10.3f} "
+              f"{after['total_wall_s'] / before['total_wall_s']:>6.2f}x")
+
+
+if __name__ == "__main__":
+    main()
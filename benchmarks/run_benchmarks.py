@@ -0,0 +1,181 @@
+#End-to-end benchmark of the prediction pipeline on synthetic data
+#Generates seeded synthetic layers (see synthetic_data.py), runs the stages of predict_demand.py on them one by one
+#and records the wall time, CPU time and peak memory of every stage to a JSON file. Results of different commits
+#can be compared offline with compare_benchmarks.py.
+#
+#Usage (from the project root):
+#    python benchmarks/run_benchmarks.py --scale small
+#    python benchmarks/run_benchmarks.py --pois 10000000 --cells 1000000 --stations 20000 --roads 100000
+#    python benchmarks/compare_benchmarks.py benchmarks/results/old.json benchmarks/results/new.json
+import argparse
+import datetime
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, os.path.join(ROOT, 'scripts'))
+import grid
+import model_io
+import storage
+import top_k
+from features import FEATURES, POI_DENSITY_RADII
+from instrumentation import MemorySampler
+from predict_demand import create_prediction_grid, load_model, ranking_stage, vector_feature_stage
+from synthetic_data import WA_BOUNDS, generate
+
+RESULTS_PATH = os.path.join(ROOT, 'benchmarks', 'results')
+MODEL_FILE = model_io.find_model_file(models_path=os.path.join(ROOT, 'models'))
+
+#Preset sizes, from a quick smoke run to the largest inputs we expect
+SCALES = {
+    'tiny': {'pois': 1_000, 'cells': 10_000, 'stations': 200, 'roads': 1_000},
+    'small': {'pois': 100_000, 'cells': 100_000, 'stations': 2_000, 'roads': 10_000},
+    'medium': {'pois': 1_000_000, 'cells': 250_000, 'stations': 5_000, 'roads': 30_000},
+    'large': {'pois': 3_000_000, 'cells': 1_000_000, 'stations': 10_000, 'roads': 60_000},
+    'xlarge': {'pois': 10_000_000, 'cells': 1_000_000, 'stations': 20_000, 'roads': 100_000},
+}
+
+#Number of top locations written as GeoJSON, like predict_demand.py
+TOP_LOCATIONS = top_k.TOP_K
+
+class StageTimer:
+    """
+    Times pipeline stages. The memory is sampled while a stage runs (see instrumentation.MemorySampler),
+    so every stage gets its own peak instead of the peak of the whole process so far.
+    """
+
+    def __init__(self):
+        self.stages = []
+
+    def run(self, name, fn, *args, rows=None, **kwargs):
+        memory = MemorySampler()
+        wall_start, cpu_start = time.perf_counter(), time.process_time()
+        with memory:
+            result = fn(*args, **kwargs)
+        wall, cpu = time.perf_counter() - wall_start, time.process_time() - cpu_start
+        stage = {
+            'stage': name,
+            'wall_s': round(wall, 4),
+            'cpu_s': round(cpu, 4),
+            'peak_rss_mb': round(memory.peak_bytes / 1024 ** 2, 1),
+            'rss_growth_mb': round((memory.peak_bytes - memory.start_bytes) / 1024 ** 2, 1),
+            'rows': rows(result) if callable(rows) else rows,
+        }
+        self.stages.append(stage)
+        print(f"  {name:<26} {stage['wall_s']:>9.3f} s  {stage['peak_rss_mb']:>9.1f} MB peak  "
+              f"{'' if stage['rows'] is None else stage['rows']}")
+        return result
+
+
+def _git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _versions():
+    versions = {'python': platform.python_version()}
+    for module in ('numpy', 'pandas', 'geopandas', 'shapely', 'scipy', 'xgboost', 'pyarrow'):
+        try:
+            versions[module] = __import__(module).__version__
+        except ImportError:
+            pass
+    return versions
+
+
+def cell_size_for(n_cells, bounds=WA_BOUNDS):
+    """
+    Cell size (in meters) that covers bounds with about n_cells square cells.
+    """
+    xmin, ymin, xmax, ymax = bounds
+    return float(np.sqrt((xmax - xmin) * (ymax - ymin) / n_cells))
+
+
+def run_pipeline(params, formats, work_dir):
+    """
+    Runs every stage of predict_demand.py on synthetic data of the given size and returns the stage records.
+    """
+    timer = StageTimer()
+    stations, roads, pois = timer.run(
+        'generate_data', generate, params['pois'], params['stations'], params['roads'], seed=params['seed'],
+        rows=lambda layers: sum(len(layer) for layer in layers),
+    )
+    cell_size = cell_size_for(params['cells'])
+
+    grid_gdf = timer.run('create_prediction_grid', create_prediction_grid, roads, cell_size, rows=len)
+    vector_features, _ = timer.run('vector_features', vector_feature_stage, grid_gdf, roads, stations, pois,
+                                   density_radii=POI_DENSITY_RADII, rows=lambda result: len(result[0]))
+    grid_gdf = grid_gdf.join(vector_features)
+
+    model = timer.run('load_model', load_model, MODEL_FILE)
+    grid_gdf['predicted_open_year'] = timer.run('predict', model.predict, grid_gdf[FEATURES], rows=len)
+    ranked = timer.run('ranking', ranking_stage, grid_gdf, rows=len)
+
+    columns = ['geometry', 'cell_id', 'predicted_open_year', 'suitability_score', 'dist_to_nearest_station_m'] + \
+        list(POI_DENSITY_RADII)
+    top = timer.run('select_top', top_k.select_top, ranked[columns], TOP_LOCATIONS, rows=len)
+    for fmt in formats:
+        timer.run(f'write_ranked_{fmt}', top_k.write_ranked_stream, ranked[columns], 'ranked_locations', fmt, work_dir,
+                  rows=len(ranked))
+    timer.run('write_top_geojson', storage.write_layer, top, 'top_locations', 'geojson', work_dir, rows=len(top))
+    return timer.stages, grid.grid_spec(roads.total_bounds, cell_size)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the prediction pipeline on synthetic data.")
+    parser.add_argument("--scale", choices=SCALES, default="small", help="preset input sizes")
+    parser.add_argument("--pois", type=int, default=None)
+    parser.add_argument("--cells", type=int, default=None, help="approximate number of grid cells")
+    parser.add_argument("--stations", type=int, default=None)
+    parser.add_argument("--roads", type=int, default=None)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--formats", default="parquet,geojson", help="formats the ranked layer is written in")
+    parser.add_argument("--output", default=None, help="result JSON file (default: benchmarks/results/<time>_<commit>.json)")
+    args = parser.parse_args()
+
+    params = dict(SCALES[args.scale], seed=args.seed)
+    for key in ('pois', 'cells', 'stations', 'roads'):
+        if getattr(args, key) is not None:
+            params[key] = getattr(args, key)
+    formats = [fmt for fmt in args.formats.split(',') if fmt]
+
+    print(f"Benchmarking with {params['pois']} POIs, ~{params['cells']} cells, {params['stations']} stations "
+          f"and {params['roads']} roads (seed {params['seed']})...")
+    start = time.perf_counter()
+    with tempfile.TemporaryDirectory() as work_dir:
+        stages, spec = run_pipeline(params, formats, work_dir)
+    total = time.perf_counter() - start
+
+    commit = _git_commit()
+    report = {
+        'created': datetime.datetime.now().isoformat(timespec='seconds'),
+        'commit': commit,
+        'scale': args.scale,
+        'params': params,
+        'grid': {'cell_size_m': round(spec.cell_size, 1), 'cells': spec.ncols * spec.nrows},
+        'machine': {'platform': platform.platform(), 'cpus': os.cpu_count()},
+        'versions': _versions(),
+        'model_file': os.path.relpath(MODEL_FILE, ROOT),
+        'total_wall_s': round(total, 3),
+        'stages': stages,
+    }
+    output = args.output or os.path.join(
+        RESULTS_PATH, f"{datetime.datetime.now():%Y%m%d_%H%M%S}_{commit or 'nocommit'}_{args.scale}.json"
+    )
+    os.makedirs(os.path.dirname(output) or '.', exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"Total {total:.2f} s. Results saved to '{output}'.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,119 @@
+#Seeded synthetic Washington-scale inputs for the benchmarks
+#The real raw inputs are not part of the repository, so the benchmarks run on generated layers with the same
+#columns the pipeline reads: stations (ID, Open Date, State), roads (highway) and POIs, all in EPSG:32148.
+#Points cluster around city centers like the real data does, so spatial index queries see a realistic skew.
+#
+#Write a data set the pipeline scripts can run on:
+#    python benchmarks/synthetic_data.py --pois 1000000 --stations 5000 --roads 20000 --output /tmp/ev_bench/data/processed/
+import argparse
+import os
+import sys
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import shapely
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts'))
+import storage
+from features import TARGET_CRS
+
+#Washington in EPSG:32148 (xmin, ymin, xmax, ymax), in meters
+WA_BOUNDS = (189_800, -166_800, 807_600, 229_900)
+
+#Approximate centers of the largest cities (Seattle, Spokane, Tacoma, Yakima, Bellingham, ...) in EPSG:32148.
+#More centers are added at random positions when n_cities asks for more.
+CITY_CENTERS = [
+    (387_480, 68_915), (755_549, 79_031), (378_376, 29_065), (525_547, -44_420), (378_917, 195_872),
+    (405_000, 85_000), (370_000, 110_000), (335_000, -20_000), (640_000, -80_000), (350_000, -140_000),
+]
+
+#Share of the POIs and stations that cluster around cities, the rest is spread over the whole state
+CLUSTERED_SHARE = 0.8
+#Road classes and how often they occur
+ROAD_CLASSES = {'motorway': 0.05, 'trunk': 0.1, 'primary': 0.2, 'secondary': 0.25, 'tertiary': 0.2, 'residential': 0.2}
+ROAD_VERTICES = 20
+ROAD_STEP_M = 800
+
+
+def _city_points(rng, n, centers, weights, bounds, spread_m):
+    #n points, CLUSTERED_SHARE of them normally distributed around the weighted city centers, the rest uniform
+    xmin, ymin, xmax, ymax = bounds
+    n_clustered = int(n * CLUSTERED_SHARE)
+    city = rng.choice(len(centers), n_clustered, p=weights)
+    spread = rng.uniform(0.3, 1.0, len(centers))[city] * spread_m
+    clustered = centers[city] + rng.normal(0, 1, (n_clustered, 2)) * spread[:, None]
+    uniform = np.column_stack([rng.uniform(xmin, xmax, n - n_clustered), rng.uniform(ymin, ymax, n - n_clustered)])
+    xy = np.vstack([clustered, uniform])
+    xy[:, 0] = np.clip(xy[:, 0], xmin, xmax)
+    xy[:, 1] = np.clip(xy[:, 1], ymin, ymax)
+    return xy[rng.permutation(n)]
+
+
+def generate(n_pois=100_000, n_stations=2_000, n_roads=10_000, n_cities=40, seed=0, bounds=WA_BOUNDS):
+    """
+    Generates (stations, roads, pois) GeoDataFrames in TARGET_CRS. The same seed always gives the same layers.
+    """
+    rng = np.random.default_rng(seed)
+    xmin, ymin, xmax, ymax = bounds
+    extra = max(0, n_cities - len(CITY_CENTERS))
+    centers = np.vstack([
+        np.asarray(CITY_CENTERS[:n_cities], dtype=float),
+        np.column_stack([rng.uniform(xmin, xmax, extra), rng.uniform(ymin, ymax, extra)]),
+    ])
+    #Zipf-like city sizes, the first (largest) city gets the most points
+    weights = 1 / np.arange(1, len(centers) + 1)
+    weights /= weights.sum()
+
+    poi_xy = _city_points(rng, n_pois, centers, weights, bounds, spread_m=15_000)
+    pois = gpd.GeoDataFrame(
+        {'amenity': rng.choice(['restaurant', 'cafe', 'fuel', 'parking', 'shop'], n_pois)},
+        geometry=shapely.points(poi_xy), crs=TARGET_CRS,
+    )
+
+    station_xy = _city_points(rng, n_stations, centers, weights, bounds, spread_m=20_000)
+    open_dates = pd.Timestamp('2010-01-01') + pd.to_timedelta(rng.integers(0, 15 * 365, n_stations), unit='D')
+    stations = gpd.GeoDataFrame(
+        {'ID': np.arange(n_stations), 'Open Date': open_dates.strftime('%Y-%m-%d'), 'State': 'WA'},
+        geometry=shapely.points(station_xy), crs=TARGET_CRS,
+    )
+
+    #Roads are random walks starting near cities (or anywhere), built in one shapely.linestrings call
+    starts = _city_points(rng, n_roads, centers, weights, bounds, spread_m=40_000)
+    headings = rng.uniform(0, 2 * np.pi, (n_roads, 1)) + np.cumsum(rng.normal(0, 0.2, (n_roads, ROAD_VERTICES)), axis=1)
+    steps = np.stack([np.cos(headings), np.sin(headings)], axis=-1) * ROAD_STEP_M
+    steps[:, 0] = 0
+    vertices = starts[:, None, :] + np.cumsum(steps, axis=1)
+    roads = gpd.GeoDataFrame(
+        {'highway': rng.choice(list(ROAD_CLASSES), n_roads, p=list(ROAD_CLASSES.values()))},
+        geometry=shapely.linestrings(vertices), crs=TARGET_CRS,
+    )
+    return stations, roads, pois
+
+
+def write_layers(stations, roads, pois, base_path, fmt=None):
+    """
+    Writes the layers under the names the pipeline reads them from, so the scripts can run on them.
+    """
+    os.makedirs(base_path, exist_ok=True)
+    for name, gdf in (('stations', stations), ('roads', roads), ('pois', pois)):
+        storage.write_layer(gdf, name, fmt, base_path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate synthetic Washington-scale input layers.")
+    parser.add_argument("--pois", type=int, default=100_000)
+    parser.add_argument("--stations", type=int, default=2_000)
+    parser.add_argument("--roads", type=int, default=10_000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--format", default=None, help="layer format (default: storage.DATA_FORMAT)")
+    parser.add_argument("--output", required=True, help="directory to write the layers to, e.g. <root>/data/processed/")
+    args = parser.parse_args()
+
+    stations, roads, pois = generate(args.pois, args.stations, args.roads, seed=args.seed)
+    write_layers(stations, roads, pois, args.output, args.format)
+    print(f"Wrote {len(stations)} stations, {len(roads)} roads and {len(pois)} POIs to '{args.output}'.")
+
+
+if __name__ == "__main__":
+    main()
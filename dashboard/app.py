@@ -1,59 +1,171 @@
 import dash
-from dash import dcc, html
-import plotly.express as px
-import geopandas as gpd
-import pandas as pd
+from dash import dcc, html, Input, Output
+import plotly.graph_objects as go
+import numpy as np
 from dotenv import load_dotenv
 import os
+import sys
 
 load_dotenv()
 
-# --- DATA LOADING (UPDATED) ---
+# --- DATA LOADING ---
+# The points are prepared offline by scripts/build_dashboard_data.py: one record (lon, lat, score, rank, cell_id)
+# per ranked location, sorted by longitude. Memory-mapping the file means a worker starts without parsing anything,
+# and all gunicorn workers share the same pages through the OS page cache.
 base_dir = os.path.dirname(os.path.abspath(__file__))
-file_path = os.path.join(base_dir, '..', 'data', 'processed', 'top_charging_locations.geojson')
+processed_dir = os.path.join(base_dir, '..', 'data', 'processed')
+# The pipeline modules, for the loaders that reuse them
+sys.path.insert(0, os.path.join(base_dir, '..', 'scripts'))
+points_path = os.path.join(processed_dir, 'dashboard_points.npy')
+legacy_file_path = os.path.join(processed_dir, 'top_charging_locations.geojson')
+
+DEFAULT_CENTER = {"lat": 47.75, "lon": -120.74}
+DEFAULT_ZOOM = 6
+
+# Upper bound of the markers sent to the browser for one view
+MAX_POINTS = 4000
+# Zoomed out, the points are aggregated into bins, this many bins across the width of one 256 px map tile
+BINS_PER_TILE = 16
+# From this zoom level on every point is shown
+FULL_DETAIL_ZOOM = 13
+# Map size assumed when the browser did not tell us the corners of the view
+VIEW_SIZE_PX = (1400, 800)
+
+
+def load_legacy_points(file_path):
+    # Fallback for a data directory that only has the top locations GeoJSON, built by the same code as
+    # build_dashboard_data.py: centroids in the layer's own projected CRS, then only the points go to lat/lon
+    import geopandas as gpd
+
+    from build_dashboard_data import build_points
 
-try:
     gdf = gpd.read_file(file_path)
-except Exception as e:
-    print(f"Error loading file: {e}")
-    gdf = gpd.GeoDataFrame(
-        {'rank': [], 'suitability_score': [], 'geometry': []},
-        crs="EPSG:4326"
+    if 'rank' in gdf.columns:
+        gdf = gdf.sort_values('rank', kind='stable')
+    return build_points(gdf)
+
+
+def load_points():
+    try:
+        return np.load(points_path, mmap_mode='r')
+    except FileNotFoundError:
+        print(f"'{points_path}' not found, run scripts/build_dashboard_data.py. Falling back to the top locations GeoJSON.")
+    try:
+        return load_legacy_points(legacy_file_path)
+    except Exception as e:
+        print(f"Error loading file: {e}")
+        return np.empty(0, dtype=[('lon', 'f4'), ('lat', 'f4'), ('score', 'f4'), ('rank', 'i4'), ('cell_id', 'i8')])
+
+
+points = load_points()
+
+
+# --- VIEWPORT FILTERING AND AGGREGATION ---
+def view_from_relayout(relayout_data):
+    # Returns (west, south, east, north, zoom, center) of the map view, or None if the event did not move the map
+    if not relayout_data:
+        relayout_data = {'map.center': DEFAULT_CENTER, 'map.zoom': DEFAULT_ZOOM}
+    if 'map.center' not in relayout_data and 'map.zoom' not in relayout_data:
+        return None
+    center = relayout_data.get('map.center', DEFAULT_CENTER)
+    zoom = relayout_data.get('map.zoom', DEFAULT_ZOOM)
+
+    corners = (relayout_data.get('map._derived') or {}).get('coordinates')
+    if corners:
+        lons, lats = zip(*corners)
+        return min(lons), min(lats), max(lons), max(lats), zoom, center
+
+    # Approximate the view from the center and zoom (web mercator, 256 px tiles)
+    degrees_per_px = 360 / (256 * 2 ** zoom)
+    half_width = VIEW_SIZE_PX[0] / 2 * degrees_per_px
+    half_height = VIEW_SIZE_PX[1] / 2 * degrees_per_px * np.cos(np.radians(center['lat']))
+    return (center['lon'] - half_width, center['lat'] - half_height,
+            center['lon'] + half_width, center['lat'] + half_height, zoom, center)
+
+
+def visible_points(points, west, south, east, north, zoom):
+    # Returns (points in the view, number of locations each of them stands for)
+    # The file is sorted by longitude, so the visible columns are found with a binary search and only that slice is read
+    start, stop = np.searchsorted(points['lon'], [west, east])
+    window = points[start:stop]
+    window = window[(window['lat'] >= south) & (window['lat'] <= north)]
+    if zoom >= FULL_DETAIL_ZOOM or len(window) <= MAX_POINTS:
+        return window, np.ones(len(window), dtype=np.int64)
+
+    # Aggregate into bins whose size follows the zoom level, each bin is shown as its best ranked location
+    bin_size = 360 / (2 ** zoom * BINS_PER_TILE)
+    bin_x = ((window['lon'] - west) // bin_size).astype(np.int64)
+    bin_y = ((window['lat'] - south) // bin_size).astype(np.int64)
+    bins = bin_x * (bin_y.max() + 1) + bin_y
+    order = np.lexsort((window['rank'], bins))
+    sorted_bins = bins[order]
+    first = np.r_[True, sorted_bins[1:] != sorted_bins[:-1]]
+    counts = np.diff(np.r_[np.flatnonzero(first), len(order)])
+    shown = window[order[first]]
+
+    if len(shown) > MAX_POINTS:
+        best = np.argpartition(shown['rank'], MAX_POINTS)[:MAX_POINTS]
+        shown, counts = shown[best], counts[best]
+    return shown, counts
+
+
+def make_figure(shown, counts, center, zoom):
+    marker_size = 8 + 2 * np.log2(counts)
+    fig = go.Figure(go.Scattermap(
+        lat=np.round(shown['lat'], 5),
+        lon=np.round(shown['lon'], 5),
+        mode='markers',
+        marker={'size': marker_size, 'color': '#FF0000'},
+        customdata=np.column_stack([shown['rank'], np.round(shown['score'], 2), counts, shown['cell_id']]),
+        hovertemplate="<b>%{customdata[0]}</b><br>suitability_score=%{customdata[1]}<br>locations here=%{customdata[2]}"
+                      "<br>click for details<extra></extra>",
+    ))
+    fig.update_layout(
+        map={'style': "dark", 'center': center, 'zoom': zoom},
+        height=800,
+        # Keeps the user's pan/zoom when the callback sends new points
+        uirevision='ev-map',
+        title_text="Recommended EV Charging Station Locations in Washington Based on XGBoost Model. Hover for details. The big number indicates rank of a station.",
+        title_x=0.5,
+        margin={"r":0,"t":40,"l":0,"b":0}
     )
+    return fig
+
+
+# --- EXPLANATIONS ---
+def load_explanation(cell_id):
+    # The contributions of one cell (a dict), or None. Per-cell feature contributions are written by
+    # scripts/explain.py and only the row group that can hold the cell is read, nothing before the first click.
+    # predict_demand.py removes them when a ranking is made without explanations, so they never belong to another run.
+    from explain import read_explanation
+
+    if cell_id is None or cell_id < 0:
+        return None
+    try:
+        return read_explanation(cell_id, base_path=processed_dir)
+    except FileNotFoundError:
+        return None
+
+
+def explanation_panel(rank, explanation):
+    if explanation is None:
+        return html.P(f"No explanation for location #{rank}, run scripts/predict_demand.py to compute them.")
+    features = [column[len('contrib_'):] for column in explanation
+                if column.startswith('contrib_') and column != 'contrib_bias']
+    # Largest effects first. A negative contribution means an earlier predicted open year, i.e. more demand.
+    features.sort(key=lambda feature: -abs(explanation[f'contrib_{feature}']))
+    predicted = explanation['contrib_bias'] + sum(explanation[f'contrib_{feature}'] for feature in features)
+    rows = [html.Tr([html.Td(feature), html.Td(f"{explanation[feature]:,.0f}"),
+                     html.Td(f"{explanation[f'contrib_{feature}']:+.2f} years")]) for feature in features]
+    return html.Div([
+        html.H3(f"Why location #{rank} ranks here"),
+        html.P(f"Predicted open year {predicted:.1f} = average {explanation['contrib_bias']:.1f} plus the effects below "
+               "(negative = earlier = more demand)."),
+        html.Table([html.Tr([html.Th("feature"), html.Th("value"), html.Th("effect")])] + rows),
+    ])
 
-# --- (The rest of your data processing code remains the same) ---
-if gdf.crs != "EPSG:4326":
-    gdf = gdf.to_crs("EPSG:4326")
-
-projected_gdf = gdf.to_crs("EPSG:32148")
-gdf['centroid_geom'] = projected_gdf['geometry'].centroid.to_crs("EPSG:4326")
-gdf['lat'] = gdf['centroid_geom'].y
-gdf['lon'] = gdf['centroid_geom'].x
-
-
-mapbox_token = os.getenv("MAPBOX_TOKEN")
-px.set_mapbox_access_token(mapbox_token)
-
-fig = px.scatter_map(
-    gdf,
-    lat="lat",
-    lon="lon",
-    hover_name="rank",
-    hover_data={"suitability_score": True, "lat": False, "lon": False},
-    color_discrete_sequence=["#FF0000"],
-    zoom=6,
-    height=800,
-    center={"lat": 47.75, "lon": -120.74}
-)
-
-fig.update_layout(
-    map_style="dark",
-    title_text="Recommended EV Charging Station Locations in Washington Based on XGBoost Model. Hover for details. The big number indicates rank of a station.",
-    title_x=0.5,
-    margin={"r":0,"t":40,"l":0,"b":0}
-)
-
-# 
+
+#
 app = dash.Dash(__name__)
 server = app.server  # Add this line
 
@@ -63,11 +175,29 @@ app.layout = html.Div(children=[
         style={'textAlign': 'center'}
     ),
     dcc.Graph(
-        id='ev-map',
-        figure=fig
-    )
+        id='ev-map'
+    ),
+    html.Div(id='explanation', style={'padding': '0 20px'})
 ])
 
 
+@app.callback(Output('ev-map', 'figure'), Input('ev-map', 'relayoutData'))
+def update_map(relayout_data):
+    view = view_from_relayout(relayout_data)
+    if view is None:
+        return dash.no_update
+    west, south, east, north, zoom, center = view
+    shown, counts = visible_points(points, west, south, east, north, zoom)
+    return make_figure(shown, counts, center, zoom)
+
+
+@app.callback(Output('explanation', 'children'), Input('ev-map', 'clickData'))
+def show_explanation(click_data):
+    if not click_data or not click_data.get('points'):
+        return dash.no_update
+    rank, _, _, cell_id = click_data['points'][0]['customdata']
+    return explanation_panel(int(rank), load_explanation(int(cell_id)))
+
+
 if __name__ == '__main__':
     app.run(debug=True)
@@ -0,0 +1,210 @@
+#Coarse-to-fine (quadtree) scoring of the prediction grid
+#A uniform fine grid spends almost all of its work on cells that can never make the ranking: cells close to a
+#station, mountains, water and the corners of the bounding box. This script scores a coarse grid first (FINE_SIZE
+#times 2**LEVELS meters) and only splits the promising cells into their four children, level by level, down to
+#FINE_SIZE. Features and predictions are only computed for the cells that are actually visited.
+#
+#A cell is dropped when it cannot hold a charging desert: if its center is D meters from the nearest station, no
+#point of the cell is further away than D plus half its diagonal, so with D + half_diag <= CHARGING_DESERT_M every
+#fine cell inside it is within the desert distance as well. That pruning is exact. Of the remaining cells only the
+#best KEEP_FRACTION (by their optimistic score, the score with that largest possible distance) are split further,
+#which is a heuristic: with --keep-fraction 1 the result is exactly the uniform fine grid's ranking.
+#
+#The fine cells use the cell IDs of the uniform grid of FINE_SIZE over the same bounds, so the output can be
+#compared with (or used instead of) tiled_scoring.py --grid-size FINE_SIZE. The outputs go to their own layers;
+#--as-top-locations also writes the top locations as the layer the dashboard shows:
+#    python scripts/adaptive_grid.py --fine-size 250 --levels 3 --compare
+import argparse
+import time
+
+import geopandas as gpd
+import numpy as np
+
+import grid
+import storage
+import top_k
+from features import DRIVE_FEATURE, POI_DENSITY_RADII, TARGET_CRS, FeatureIndex, point_coords, select_major_roads
+from instrumentation import fail, instrumented_run, stage
+from predict_demand import CHARGING_DESERT_M, MODEL_FILE, OUTPUT_PATH, load_layers, load_model, suitability_score
+from tiled_scoring import OUTPUT_COLUMNS
+
+#Size of the finest cells in meters, and the number of times the coarsest cells are halved to get there
+#(250 m and 3 levels start from 2 km cells)
+FINE_SIZE = 250
+LEVELS = 3
+
+#Share of the remaining candidate cells of a level that is split into the next level
+KEEP_FRACTION = 0.25
+
+#Layers the ranked fine cells and the top locations among them are written to
+ADAPTIVE_LAYER = "ranked_locations_adaptive"
+ADAPTIVE_TOP_LAYER = "top_locations_adaptive"
+
+
+def level_centroids(spec, level, cols, rows):
+    """
+    Centers of cells of a level (cells of spec.cell_size * 2**level meters, on the same origin as spec).
+    """
+    size = spec.cell_size * 2 ** level
+    return np.column_stack([spec.xmin + (cols + 0.5) * size, spec.ymin + (rows + 0.5) * size])
+
+
+def level_shape(spec, level):
+    """
+    Number of columns and rows of a level that cover every cell of spec.
+    """
+    factor = 2 ** level
+    return -(-spec.ncols // factor), -(-spec.nrows // factor)
+
+
+def children(spec, level, cols, rows):
+    """
+    The (cols, rows) of the four children (at level - 1) of every given cell, without the ones outside the grid.
+    """
+    cols = (2 * cols[:, None] + np.array([0, 0, 1, 1])).ravel()
+    rows = (2 * rows[:, None] + np.array([0, 1, 0, 1])).ravel()
+    ncols, nrows = level_shape(spec, level - 1)
+    inside = (cols < ncols) & (rows < nrows)
+    return cols[inside], rows[inside]
+
+
+def score_cells(feature_index, model, xy):
+    #Features and predicted open year of the points in xy
+    features = feature_index.compute(xy, density_radii=POI_DENSITY_RADII)
+    features['predicted_open_year'] = model.predict(features)
+    return features
+
+
+def refine(feature_index, model, spec, levels=LEVELS, keep_fraction=KEEP_FRACTION, desert_m=CHARGING_DESERT_M):
+    """
+    Scores the grid coarse to fine. spec is the fine grid; the coarsest level has cells of 2**levels fine cells.
+    Returns (the charging desert cells of the fine grid with their features and suitability_score, and one dict of
+    statistics per level).
+    """
+    ncols, nrows = level_shape(spec, levels)
+    cols, rows = np.meshgrid(np.arange(ncols), np.arange(nrows), indexing='ij')
+    cols, rows = cols.ravel(), rows.ravel()
+    stats = []
+    for level in range(levels, -1, -1):
+        cell_size = spec.cell_size * 2 ** level
+        features = score_cells(feature_index, model, level_centroids(spec, level, cols, rows))
+        dist = features['dist_to_nearest_station_m'].to_numpy(dtype=float)
+        if level == 0:
+            deserts = features[dist > desert_m].copy()
+            deserts.insert(0, 'cell_id', grid.cell_ids(spec, cols, rows)[dist > desert_m])
+            deserts['suitability_score'] = suitability_score(
+                deserts['dist_to_nearest_station_m'], deserts['predicted_open_year'], deserts['poi_density_1.5m']
+            )
+            stats.append({'level': level, 'cell_size': cell_size, 'scored': len(features), 'kept': len(deserts)})
+            return deserts.reset_index(drop=True), stats
+
+        #The furthest any point of the cell can be from a station; only cells that can hold a desert go on
+        reach = dist + cell_size * np.sqrt(0.5)
+        candidates = np.flatnonzero(reach > desert_m)
+        optimistic = suitability_score(reach[candidates], features['predicted_open_year'].to_numpy()[candidates],
+                                       features['poi_density_1.5m'].to_numpy()[candidates])
+        if keep_fraction < 1 and len(candidates):
+            candidates = candidates[optimistic >= np.quantile(optimistic, 1 - keep_fraction)]
+        stats.append({'level': level, 'cell_size': cell_size, 'scored': len(features), 'kept': len(candidates)})
+        cols, rows = children(spec, level, cols[candidates], rows[candidates])
+
+
+def build_feature_index(gdf_stations, gdf_roads, gdf_pois, model):
+    #The same indexes tiled_scoring.py builds, with the drive distance when the model was trained on it
+    drive_distance = None
+    if DRIVE_FEATURE in model.features:
+        import road_graph
+
+        print("Labelling the road network with drive distances to the nearest station...")
+        drive_distance = road_graph.DriveDistance(road_graph.load_road_graph(gdf_roads), point_coords(gdf_stations.geometry))
+    return FeatureIndex(select_major_roads(gdf_roads), gdf_stations, gdf_pois, drive_distance)
+
+
+def ranked_to_gdf(ranked, spec):
+    """
+    The ranked fine cells as a GeoDataFrame of cell polygons.
+    """
+    ids = ranked['cell_id'].to_numpy(dtype=np.int64)
+    return gpd.GeoDataFrame(ranked[OUTPUT_COLUMNS], geometry=grid.cell_boxes(spec, ids), crs=TARGET_CRS)
+
+
+@instrumented_run('adaptive_grid')
+def main():
+    parser = argparse.ArgumentParser(description="Score the prediction grid coarse to fine, refining only promising cells.")
+    parser.add_argument("--fine-size", type=float, default=FINE_SIZE, help="size of the finest cells in meters")
+    parser.add_argument("--levels", type=int, default=LEVELS, help="number of times the coarsest cells are halved")
+    parser.add_argument("--keep-fraction", type=float, default=KEEP_FRACTION,
+                        help="share of the candidate cells of a level that is refined (1 = exact)")
+    parser.add_argument("--top", type=int, default=top_k.TOP_K, help="number of top locations written for the dashboard")
+    parser.add_argument("--min-separation", type=float, default=top_k.MIN_SEPARATION_M,
+                        help="minimum distance in meters between two top locations (0 = none)")
+    parser.add_argument("--no-ranked-export", action="store_true",
+                        help="only write the top locations, not the full ranked layer")
+    parser.add_argument("--as-top-locations", action="store_true",
+                        help="also write the top locations as the top locations layer the dashboard shows")
+    parser.add_argument("--compare", action="store_true",
+                        help="also score the uniform fine grid and report how many top locations both agree on")
+    args = parser.parse_args()
+    if not 0 < args.keep_fraction <= 1:
+        parser.error("--keep-fraction must be in (0, 1]")
+
+    print("Starting adaptive demand prediction...")
+    try:
+        with stage('load_layers') as s:
+            gdf_stations, gdf_roads, gdf_pois = load_layers()
+            model = load_model(MODEL_FILE, drive_distance=True)
+            s.rows = len(gdf_stations) + len(gdf_roads) + len(gdf_pois)
+    except (FileNotFoundError, ValueError) as e:
+        print(f"ERROR: {e}. Please ensure all required files are present.")
+        fail(str(e))
+        return
+
+    spec = grid.grid_spec(gdf_roads.total_bounds, args.fine_size)
+    n_fine = spec.ncols * spec.nrows
+    with stage('build_indexes'):
+        feature_index = build_feature_index(gdf_stations, gdf_roads, gdf_pois, model)
+
+    start = time.perf_counter()
+    with stage('refine') as s:
+        ranked, stats = refine(feature_index, model, spec, args.levels, args.keep_fraction)
+        scored = sum(level['scored'] for level in stats)
+        s.rows = scored
+        s.info['levels'] = stats
+    for level in stats:
+        print(f"  - {level['cell_size']:.0f} m cells: scored {level['scored']}, kept {level['kept']}")
+    print(f"Scored {scored} cells instead of the {n_fine} cells of the uniform {args.fine_size:.0f} m grid "
+          f"({scored / max(n_fine, 1):.1%}) in {time.perf_counter() - start:.1f} s; "
+          f"ranked {len(ranked)} charging desert cells.")
+
+    ranked_gdf = ranked_to_gdf(ranked, spec)
+    with stage('select_top_locations') as s:
+        top_gdf = top_k.select_top(
+            ranked_gdf, args.top, args.min_separation,
+            xy=grid.cell_centroids(spec, ranked_gdf['cell_id'].to_numpy()) if args.min_separation > 0 else None,
+        )
+        s.rows = len(top_gdf)
+
+    if args.compare:
+        from tiled_scoring import run_tiled_scoring
+
+        print(f"Scoring the uniform {args.fine_size:.0f} m grid for comparison...")
+        with stage('compare', rows=n_fine):
+            _, _, uniform_top = run_tiled_scoring(gdf_stations, gdf_roads, gdf_pois, MODEL_FILE, None,
+                                                  grid_size=args.fine_size, top=args.top,
+                                                  min_separation=args.min_separation)
+        shared = np.intersect1d(top_gdf['cell_id'].to_numpy(), uniform_top['cell_id'].to_numpy())
+        print(f"The adaptive and the uniform grid share {len(shared)} of their top {len(uniform_top)} locations.")
+
+    with stage('write_outputs', rows=len(top_gdf)):
+        top_path = storage.write_layer(top_gdf, ADAPTIVE_TOP_LAYER, top_k.TOP_LOCATIONS_FORMAT, OUTPUT_PATH)
+        print(f"Saved the top {len(top_gdf)} locations to {top_path}.")
+        if args.as_top_locations:
+            top_path = storage.write_layer(top_gdf, 'top_locations', top_k.TOP_LOCATIONS_FORMAT, OUTPUT_PATH)
+            print(f"Saved them as the dashboard's top locations to {top_path}.")
+        if not args.no_ranked_export:
+            path = top_k.write_ranked_stream(ranked_gdf, ADAPTIVE_LAYER, base_path=OUTPUT_PATH)
+            print(f"Saved the ranked locations to {path}.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+#Builds the compact point file the dashboard serves from
+#The dashboard only needs a lat/lon, score and rank per location, so instead of every gunicorn worker reading and
+#reprojecting a GeoJSON at boot, this offline step writes those columns once into a NumPy .npy file.
+#Workers memory-map it, which means they start instantly and share one copy of the data through the OS page cache.
+import argparse
+import os
+
+import numpy as np
+import shapely
+
+import projection
+import storage
+
+PROCESSED_DATA_PATH = storage.PROCESSED_DATA_PATH
+OUTPUT_FILE = os.path.join(PROCESSED_DATA_PATH, "dashboard_points.npy")
+
+#One record per ranked location. The file is sorted by longitude so the dashboard can cut out
+#the visible part of the map with a binary search.
+POINT_DTYPE = np.dtype([
+    ('lon', 'f4'),
+    ('lat', 'f4'),
+    ('score', 'f4'),
+    ('rank', 'i4'),
+    ('cell_id', 'i8'),
+])
+
+
+def build_points(gdf):
+    """
+    Turns ranked locations (sorted best first, in any CRS) into the structured point array, ranks start at 1.
+    Centroids are taken in the layer's own (projected) CRS and only the points are transformed to lat/lon.
+    """
+    centroids = shapely.centroid(gdf.geometry.values)
+    xy = np.column_stack([shapely.get_x(centroids), shapely.get_y(centroids)])
+    if gdf.crs is not None:
+        xy = projection.transform_xy(xy, gdf.crs, "EPSG:4326")
+    x, y = xy[:, 0], xy[:, 1]
+
+    points = np.empty(len(gdf), dtype=POINT_DTYPE)
+    points['lon'] = x
+    points['lat'] = y
+    points['score'] = gdf['suitability_score'].to_numpy()
+    points['rank'] = np.arange(1, len(gdf) + 1)
+    points['cell_id'] = gdf['cell_id'].to_numpy() if 'cell_id' in gdf.columns else -1
+    return points[np.argsort(points['lon'], kind='stable')]
+
+
+def write_points(points, output_file=OUTPUT_FILE):
+    """
+    Writes the point array atomically, so running dashboard workers never map a half written file.
+    """
+    storage.atomic_write(output_file, lambda tmp_path: np.save(tmp_path, points), suffix='.npy')
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build the memory-mapped point file for the dashboard.")
+    parser.add_argument("--layer", default="ranked_locations",
+                        help="layer to serve: 'ranked_locations' (full ranked grid) or 'top_locations'")
+    parser.add_argument("--output", default=OUTPUT_FILE)
+    args = parser.parse_args()
+
+    print(f"Loading the '{args.layer}' layer...")
+    try:
+        gdf = storage.read_layer(args.layer, columns=['suitability_score', 'cell_id'], base_path=PROCESSED_DATA_PATH)
+    except (KeyError, ValueError):
+        #Older outputs have no cell_id column
+        gdf = storage.read_layer(args.layer, columns=['suitability_score'], base_path=PROCESSED_DATA_PATH)
+    gdf = gdf.sort_values('suitability_score', ascending=False, kind='stable')
+
+    points = build_points(gdf)
+    write_points(points, args.output)
+    print(f"Saved {len(points)} points ({os.path.getsize(args.output) / 1e6:.1f} MB) to '{args.output}'.")
+
+
+if __name__ == "__main__":
+    main()
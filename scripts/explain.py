@@ -0,0 +1,150 @@
+#Per-cell explanations of the open year model
+#For every ranked cell the model's prediction is split into one contribution per feature plus a bias (TreeSHAP,
+#XGBoost's pred_contribs), so the dashboard can show why a cell ranks high. The contributions are written next to
+#the ranked locations as the 'explanations' table, sorted by cell_id in small row groups, so the contributions of a
+#single cell are read by skipping straight to its row group.
+#
+#Exact TreeSHAP costs far more than a prediction, so cells are not explained one by one. A tree only looks at a
+#feature through its split thresholds, so two cells whose features fall between the same thresholds of every
+#feature go down the same paths in every tree and get the same contributions. Cells are grouped by those threshold
+#intervals, only one cell per group is explained (in batches, on all prediction threads) and the result is copied
+#to the rest of its group. The contributions stay exact; a grid has far fewer groups than cells.
+#
+#predict_demand.py runs this for all charging desert cells (skip it with --no-explanations). To explain the
+#cells of an existing grid feature table:
+#    python scripts/explain.py
+import argparse
+import json
+import os
+import time
+
+import numpy as np
+import pandas as pd
+
+import model_io
+import storage
+
+#Representative cells explained per pred_contribs call
+EXPLAIN_BATCH_ROWS = 50_000
+
+#Rows per row group of the explanations table, i.e. the rows read to look up one cell
+ROW_GROUP_ROWS = 16_384
+
+#Use the Saabas approximation instead of exact Shapley values (set EV_EXPLAIN_APPROX=1)
+EXPLAIN_APPROX = os.getenv("EV_EXPLAIN_APPROX", "0") == "1"
+
+
+def split_thresholds(model):
+    """
+    The sorted split thresholds (float32) of every feature of the model, in feature order.
+    They are read from the JSON dump of the model, which keeps the exact float32 values.
+    """
+    trees = json.loads(model.booster.save_raw('json'))['learner']['gradient_booster']['model']['trees']
+    thresholds = [[] for _ in model.features]
+    for tree in trees:
+        inner = np.asarray(tree['left_children']) != -1
+        features = np.asarray(tree['split_indices'])[inner]
+        conditions = np.asarray(tree['split_conditions'], dtype=np.float32)[inner]
+        for feature, values in enumerate(thresholds):
+            values.append(conditions[features == feature])
+    return [np.unique(np.concatenate(values)) if values else np.empty(0, dtype=np.float32) for values in thresholds]
+
+
+def threshold_groups(X, thresholds):
+    """
+    Groups the rows of X (float32, features in model order) by the threshold interval of every feature.
+    Returns (position of one representative row per group, group of every row).
+    """
+    #A tree goes left when value < threshold, so the number of thresholds <= value decides every split.
+    #Missing values follow the default branch, they get an interval of their own.
+    intervals = np.empty(X.shape, dtype=np.int64)
+    for feature, values in enumerate(thresholds):
+        column = X[:, feature]
+        intervals[:, feature] = np.where(np.isnan(column), len(values) + 1, np.searchsorted(values, column, side='right'))
+    sizes = [len(values) + 2 for values in thresholds]
+    if np.prod(np.asarray(sizes, dtype=float)) < 2 ** 62:
+        #One integer per row is much faster to deduplicate than rows of integers
+        keys = np.zeros(len(X), dtype=np.int64)
+        for feature, size in enumerate(sizes):
+            keys = keys * size + intervals[:, feature]
+        _, first, group = np.unique(keys, return_index=True, return_inverse=True)
+    else:
+        _, first, group = np.unique(intervals, axis=0, return_index=True, return_inverse=True)
+    return first, group.ravel()
+
+
+def contributions(model, X, batch_rows=EXPLAIN_BATCH_ROWS, approx=EXPLAIN_APPROX):
+    """
+    Feature contributions of every row of X (a DataFrame with the model features, or an array in model order):
+    an (N, n_features + 1) float32 array whose last column is the bias. Returns (contributions, number of groups).
+    """
+    if hasattr(X, 'columns'):
+        X = X[model.features].to_numpy(dtype=np.float32)
+    X = np.ascontiguousarray(X, dtype=np.float32)
+    first, group = threshold_groups(X, split_thresholds(model))
+    representatives = X[first]
+    explained = np.empty((len(first), len(model.features) + 1), dtype=np.float32)
+    for start in range(0, len(first), batch_rows):
+        batch = representatives[start:start + batch_rows]
+        explained[start:start + len(batch)] = model.contributions(batch, approx=approx)
+    return explained[group], len(first)
+
+
+def explain_cells(cell_ids, X, model_file, approx=EXPLAIN_APPROX):
+    """
+    The explanations table of the cells: cell_id, the model features and one 'contrib_<feature>' column per feature
+    plus 'contrib_bias' (in years of the predicted open year), sorted by cell_id.
+    """
+    model = model_io.load_model(model_file)
+    values, n_groups = contributions(model, X, approx=approx)
+    print(f"  - explained {len(values)} cells through {n_groups} distinct threshold groups")
+    table = pd.DataFrame({'cell_id': np.asarray(cell_ids, dtype=np.int64)})
+    for position, feature in enumerate(model.features):
+        table[feature] = X[feature].to_numpy(dtype=np.float32) if hasattr(X, 'columns') else X[:, position]
+    for position, feature in enumerate(model.features):
+        table[f'contrib_{feature}'] = values[:, position]
+    table['contrib_bias'] = values[:, -1]
+    return table.sort_values('cell_id', kind='stable').reset_index(drop=True)
+
+
+def write_explanations(table, model_file, base_path=storage.PROCESSED_DATA_PATH):
+    """
+    Writes the explanations table and returns its path.
+    """
+    features = [column[len('contrib_'):] for column in table.columns if column.startswith('contrib_') and column != 'contrib_bias']
+    metadata = {'model_file': os.path.basename(model_file), 'features': features, 'approx': EXPLAIN_APPROX}
+    return storage.write_table(table, 'explanations', metadata=metadata, base_path=base_path, row_group_size=ROW_GROUP_ROWS)
+
+
+def read_explanation(cell_id, base_path=storage.PROCESSED_DATA_PATH):
+    """
+    The explanation row of one cell as a dict, or None if the cell was not explained.
+    Only the row group that can hold the cell is read.
+    """
+    rows = storage.read_table('explanations', base_path=base_path, filters=[('cell_id', '==', int(cell_id))])
+    if not len(rows):
+        return None
+    explanation = rows.iloc[0].to_dict()
+    explanation['cell_id'] = int(explanation['cell_id'])
+    return explanation
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Explain the predictions of the charging desert cells of the grid feature table.")
+    parser.add_argument("--all-cells", action="store_true", help="explain every cell, not only the charging deserts")
+    args = parser.parse_args()
+
+    #Imported here so the explanation code does not depend on the prediction script
+    from predict_demand import CHARGING_DESERT_M, MODEL_FILE, OUTPUT_PATH
+
+    table = storage.read_table('grid_features', base_path=OUTPUT_PATH)
+    if not args.all_cells:
+        table = table[table['dist_to_nearest_station_m'] > CHARGING_DESERT_M]
+    start = time.perf_counter()
+    explanations = explain_cells(table['cell_id'].to_numpy(), table, MODEL_FILE)
+    print(f"Explained {len(explanations)} cells in {time.perf_counter() - start:.2f} s.")
+    print(f"Saved the explanations to '{write_explanations(explanations, MODEL_FILE, OUTPUT_PATH)}'.")
+
+
+if __name__ == "__main__":
+    main()
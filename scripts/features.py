@@ -0,0 +1,195 @@
+#Shared feature engineering for the open year model
+#Both training (forecast_demand.py) and inference (predict_demand.py) import this module,
+#so the features a station was trained on are computed exactly the same way as the features of a grid cell.
+import numpy as np
+import pandas as pd
+import shapely
+from scipy.spatial import cKDTree
+
+#All distance features are in meters, so every layer must be in this projected CRS first
+TARGET_CRS = "EPSG:32148" #Washington/North
+
+#Only these road classes count as "major roads"
+MAJOR_ROAD_TYPES = ['motorway', 'trunk', 'primary', 'secondary']
+
+#1.5 miles in meters, the radius we count points of interest in
+POI_RADIUS_M = 2414
+
+#Radii for the multi-scale POI density features (0.5, 1.5 and 3 miles in meters)
+POI_DENSITY_RADII = {
+    'poi_density_0.5m': 805,
+    'poi_density_1.5m': POI_RADIUS_M,
+    'poi_density_3m': 4828,
+}
+
+#The model features, in the order the model was trained on
+FEATURES = ['dist_to_major_road_m', 'poi_density_1.5m', 'dist_to_nearest_station_m']
+
+#Optional extra feature: drive distance over the road network to the nearest station (see road_graph.py).
+#A model trained with it lists it after FEATURES in its metadata.
+DRIVE_FEATURE = 'drive_dist_to_nearest_station_m'
+
+
+def point_coords(geoseries):
+    """
+    Returns an (N, 2) array of x/y coordinates for a GeoSeries.
+    Points are used as they are, any other geometry (cell polygons, building footprints) is reduced to its centroid.
+    """
+    if len(geoseries) and not (geoseries.geom_type == 'Point').all():
+        geoseries = geoseries.centroid
+    return np.column_stack([geoseries.x.to_numpy(), geoseries.y.to_numpy()])
+
+
+def select_major_roads(gdf_roads, road_types=MAJOR_ROAD_TYPES):
+    """
+    Keeps only the road segments whose 'highway' class is one of road_types.
+    """
+    return gdf_roads[gdf_roads['highway'].isin(road_types)]
+
+
+def dist_to_major_road(points, road_tree):
+    """
+    Distance in meters from every point to the closest major road segment.
+    road_tree is a shapely STRtree over the major road geometries. One bulk nearest query
+    replaces a full distance scan per point.
+    """
+    tree_index, distances = road_tree.query_nearest(points, all_matches=False, return_distance=True)
+    #query_nearest() returns one match per input point, tree_index[0] holds the input point positions
+    result = np.full(len(points), np.inf)
+    result[tree_index[0]] = distances
+    return result
+
+
+def dist_to_nearest_station(xy, station_tree, exclude_self=False):
+    """
+    Distance in meters from every query point to the closest station.
+    station_tree is a cKDTree over the station coordinates (None when there are no stations).
+    With exclude_self=True the query points are the stations themselves, and any station sitting at the
+    exact same location as the query point is ignored, just like the old "geometry != point" filter did.
+    """
+    if station_tree is None or station_tree.n == 0:
+        return np.full(len(xy), np.inf)
+    if not exclude_self:
+        distances, _ = station_tree.query(xy, k=1)
+        return distances
+
+    n_stations = station_tree.n
+    result = np.full(len(xy), np.inf)
+    pending = np.arange(len(xy))
+    k = 2
+    #Most stations only need their 2 nearest neighbours (themselves plus the closest rival).
+    #Stations that share their location with others are re-queried with a larger k until a rival turns up.
+    while len(pending):
+        distances, _ = station_tree.query(xy[pending], k=min(k, n_stations))
+        distances = np.asarray(distances).reshape(len(pending), -1)
+        rivals = np.where(distances > 0, distances, np.inf).min(axis=1)
+        found = np.isfinite(rivals)
+        result[pending[found]] = rivals[found]
+        if k >= n_stations:
+            break
+        pending = pending[~found]
+        k *= 4
+    return result
+
+
+class RadiusCounter:
+    """
+    Counts how many points lie within a radius of each query point.
+    The KD-tree over the points is built once and can be reused for any number of queries and radii.
+    Only the counts are returned, so memory stays at one integer per query point and radius
+    instead of a materialized spatial join.
+    workers is the number of threads of every query (-1 = all cores); set it to 1 inside a process pool.
+    """
+
+    def __init__(self, xy, chunk_size=200_000, workers=-1):
+        self.tree = cKDTree(np.asarray(xy, dtype=float).reshape(-1, 2))
+        self.chunk_size = chunk_size
+        self.workers = workers
+
+    def count(self, xy, radii):
+        """
+        Returns {radius: counts} for every radius in radii, with one count per row of xy.
+        Queries run in chunks, on self.workers threads.
+        """
+        xy = np.asarray(xy, dtype=float).reshape(-1, 2)
+        counts = {radius: np.zeros(len(xy), dtype=np.int64) for radius in radii}
+        for start in range(0, len(xy), self.chunk_size):
+            chunk = xy[start:start + self.chunk_size]
+            for radius in radii:
+                counts[radius][start:start + len(chunk)] = self.tree.query_ball_point(
+                    chunk, r=radius, return_length=True, workers=self.workers
+                )
+        return counts
+
+
+class FeatureIndex:
+    """
+    The spatial indexes needed to compute the model features: an STRtree over the major roads,
+    a KD-tree over the existing stations and a RadiusCounter over the POIs.
+    With a road_graph.DriveDistance, compute() also adds the DRIVE_FEATURE column.
+    Build it once and reuse it for every batch of points (grid tiles, candidate sites, ...);
+    it is only ever read, so it can be shared between worker processes.
+    All layers must already be in TARGET_CRS.
+    """
+
+    def __init__(self, gdf_major_roads, gdf_stations, gdf_pois, drive_distance=None):
+        self.road_tree = shapely.STRtree(gdf_major_roads.geometry.values)
+        self.station_xy = point_coords(gdf_stations.geometry)
+        self.station_tree = cKDTree(self.station_xy) if len(self.station_xy) else None
+        self.poi_counter = RadiusCounter(point_coords(gdf_pois.geometry))
+        self.drive_distance = drive_distance
+
+    def set_workers(self, workers):
+        """
+        Threads of the POI radius queries (-1 = all cores). Worker processes of a pool set it to 1, like the model's nthread.
+        """
+        self.poi_counter.workers = workers
+
+    def nearest_station_xy(self, xy):
+        """
+        Coordinates of the nearest station of every point of xy, an (N, 2) array (NaN when there are no stations).
+        """
+        xy = np.asarray(xy, dtype=float).reshape(-1, 2)
+        if self.station_tree is None:
+            return np.full((len(xy), 2), np.nan)
+        return self.station_xy[self.station_tree.query(xy, k=1)[1]]
+
+    def compute(self, xy, exclude_self=False, density_radii=None, index=None):
+        """
+        Computes the model features for the (N, 2) coordinates in xy and returns them as a DataFrame
+        with the columns in FEATURES order.
+        density_radii ({column: radius}, e.g. POI_DENSITY_RADII) adds extra POI density columns after the model features.
+        """
+        xy = np.asarray(xy, dtype=float).reshape(-1, 2)
+
+        #All POI densities come from a single pass over the KD-tree
+        density_columns = {'poi_density_1.5m': POI_RADIUS_M}
+        density_columns.update(density_radii or {})
+        counts = self.poi_counter.count(xy, set(density_columns.values()))
+
+        features = {'dist_to_major_road_m': dist_to_major_road(shapely.points(xy), self.road_tree)}
+        for column, radius in density_columns.items():
+            features[column] = counts[radius]
+        features['dist_to_nearest_station_m'] = dist_to_nearest_station(xy, self.station_tree, exclude_self=exclude_self)
+        extra_columns = [column for column in density_columns if column not in FEATURES]
+        if self.drive_distance is not None:
+            #Stations measured against the others need DriveDistance.to_nearest_other_station instead
+            if exclude_self:
+                raise ValueError("The drive distance can not exclude the point itself, use to_nearest_other_station")
+            features[DRIVE_FEATURE] = self.drive_distance.query(xy)
+            extra_columns.append(DRIVE_FEATURE)
+        #Built in one go, adding the columns one by one costs more than the queries for small batches
+        return pd.DataFrame({column: features[column] for column in FEATURES + extra_columns},
+                            index=index if index is not None else pd.RangeIndex(len(xy)))
+
+
+def compute_features(gdf, gdf_major_roads, gdf_stations, gdf_pois, exclude_self=False, density_radii=None):
+    """
+    Computes the model features for every row of gdf and returns them as a DataFrame
+    with the same index as gdf and the columns in FEATURES order.
+    gdf can hold station points (training) or grid cells (inference). Everything must already be in TARGET_CRS.
+    """
+    feature_index = FeatureIndex(gdf_major_roads, gdf_stations, gdf_pois)
+    return feature_index.compute(
+        point_coords(gdf.geometry), exclude_self=exclude_self, density_radii=density_radii, index=gdf.index
+    )
@@ -1,30 +1,74 @@
-import os
+import argparse
+
+import numpy as np
 import pandas as pd
-import geopandas as gpd
 import xgboost as xgb
+from scipy.spatial import cKDTree
 from sklearn.metrics import mean_absolute_error
-import joblib
+import model_io
+import projection
+import storage
+from instrumentation import fail, instrumented_run, stage
+from features import (DRIVE_FEATURE, FEATURES, TARGET_CRS, compute_features, dist_to_nearest_station, point_coords,
+                      select_major_roads)
 
 # --- CONFIGURATION ---
-PROCESSED_DATA_PATH = "data/processed/"
-MODELS_PATH = "models/"
+PROCESSED_DATA_PATH = storage.PROCESSED_DATA_PATH
+MODELS_PATH = model_io.MODELS_PATH
 
-def main():
+def as_of_station_distances(gdf_master, history, graph=None):
     """
-    Loads processed data, trains an XGBoost model to predict the opening year of a station,
-    evaluates its performance, and saves the trained model.
+    Recomputes the station distance of every station against the stations that existed on January 1 of its
+    open year (from the station history store), so no station is trained on rivals that opened after it.
+    With a road graph the DRIVE_FEATURE column is recomputed the same way.
     """
-    print("--- Starting Model Training: EV Station Opening Year Prediction ---")
+    if graph is not None:
+        import road_graph
+
+    xy = point_coords(gdf_master.geometry)
+    for year, positions in gdf_master.groupby('open_year').indices.items():
+        _, station_xy = history.stations_as_of(f"{int(year)}-01-01")
+        distances = dist_to_nearest_station(xy[positions], cKDTree(station_xy) if len(station_xy) else None)
+        #No station yet is a missing value for the model, not an infinite distance
+        gdf_master.iloc[positions, gdf_master.columns.get_loc('dist_to_nearest_station_m')] = \
+            np.where(np.isfinite(distances), distances, np.nan)
+        if graph is not None:
+            drive = road_graph.DriveDistance(graph, station_xy).query(xy[positions])
+            gdf_master.iloc[positions, gdf_master.columns.get_loc(DRIVE_FEATURE)] = drive
 
+def load_training_data(drive_distance=False, as_of_features=False):
+    """
+    Loads the stations, (re)computes their FEATURES and adds the 'open_year' target.
+    With drive_distance, the DRIVE_FEATURE column (drive distance to the nearest other station) is added too.
+    With as_of_features, the station distances are measured against the stations that existed when each station
+    opened (see station_history.py) instead of against every station there is today.
+    Returns the stations with a valid 'Open Date' as a GeoDataFrame in TARGET_CRS.
+    Raises FileNotFoundError when one of the inputs is missing.
+    """
     # LOAD DATA
     print("Loading feature-engineered dataset...")
-    try:
-        input_file = os.path.join(PROCESSED_DATA_PATH, "afdc_unique_stations_with_features.geojson")
-        gdf_master = gpd.read_file(input_file)
-        print(f"Successfully loaded master GeoDataFrame with {len(gdf_master)} records.")
-    except FileNotFoundError:
-        print(f"ERROR: The file '{input_file}' was not found. Please run the feature engineering notebook first.")
-        return
+    #The layers come reprojected to TARGET_CRS, from the projection cache when they did not change
+    gdf_master = projection.read_projected_layer('stations', TARGET_CRS, base_path=PROCESSED_DATA_PATH)
+    print(f"Successfully loaded master GeoDataFrame with {len(gdf_master)} records.")
+    gdf_roads = projection.read_projected_layer('roads', TARGET_CRS, columns=['geometry', 'highway'], base_path=PROCESSED_DATA_PATH)
+    gdf_pois = projection.read_projected_layer('pois', TARGET_CRS, columns=['geometry'], base_path=PROCESSED_DATA_PATH)
+
+    #(Re)compute the features with the shared features module, the same code predict_demand.py uses for the grid,
+    #so training and inference features can never drift apart.
+    print("Calculating features for each station...")
+    gdf_major_roads = select_major_roads(gdf_roads)
+    station_features = compute_features(gdf_master, gdf_major_roads, gdf_master, gdf_pois, exclude_self=True)
+    gdf_master[FEATURES] = station_features
+    graph = None
+    if drive_distance:
+        #Imported here so training without the drive distance does not need the graph code
+        import road_graph
+
+        print("Calculating drive distances over the road network...")
+        graph = road_graph.load_road_graph(gdf_roads,
+                                           roads_file=storage.find_layer('roads', PROCESSED_DATA_PATH)[0])
+        drive = road_graph.DriveDistance(graph, point_coords(gdf_master.geometry))
+        gdf_master[DRIVE_FEATURE] = drive.to_nearest_other_station()
 
     #Preparing data
     print("Preparing data for training...")
@@ -36,11 +80,44 @@ def main():
     gdf_master['open_year'] = gdf_master['Open Date'].dt.year
     print(f"After cleaning, {len(gdf_master)} records remain with a valid 'Open Date'.")
 
+    if as_of_features:
+        #Imported here so regular training does not need the history store
+        import station_history
+
+        print("Recomputing station distances against the stations that existed when each station opened...")
+        as_of_station_distances(gdf_master, station_history.load(PROCESSED_DATA_PATH), graph)
+    return gdf_master
+
+@instrumented_run('forecast_demand')
+def main():
+    """
+    Loads processed data, trains an XGBoost model to predict the opening year of a station,
+    evaluates its performance, and saves the trained model.
+    For cross-validated hyperparameter search see train_search.py.
+    """
+    parser = argparse.ArgumentParser(description="Train the open year model.")
+    parser.add_argument("--drive-distance", action="store_true",
+                        help=f"also train on '{DRIVE_FEATURE}', the drive distance over the road network (road_graph.py)")
+    parser.add_argument("--as-of-features", action="store_true",
+                        help="measure station distances against the stations that existed when each station opened "
+                             "(needs the station history store, see station_history.py)")
+    args = parser.parse_args()
+    print("--- Starting Model Training: EV Station Opening Year Prediction ---")
+
+    try:
+        with stage('load_training_data') as s:
+            gdf_master = load_training_data(drive_distance=args.drive_distance, as_of_features=args.as_of_features)
+            s.rows = len(gdf_master)
+    except FileNotFoundError as e:
+        print(f"ERROR: {e}. Please run the feature engineering notebook first.")
+        fail(str(e))
+        return
+
     # DEFINE FEATURES AND TARGET 
     # These are the features the model will use to make predictions.
-    # It must match the features used in your predict_demand.py script.
-    features = ['dist_to_major_road_m', 'poi_density_1.5m', 'dist_to_nearest_station_m']
+    # They come from features.py, so they always match the features used in predict_demand.py.
     target = 'open_year'
+    features = FEATURES + [DRIVE_FEATURE] if args.drive_distance else FEATURES
     
     X = gdf_master[features]
     y = gdf_master[target]
@@ -61,24 +138,37 @@ def main():
     xgb_reg = xgb.XGBRegressor(objective='reg:squarederror', n_estimators=500, random_state=42)
     
     # Fit the model to the training data
-    xgb_reg.fit(X_train, y_train)
+    with stage('train', rows=len(X_train)):
+        xgb_reg.fit(X_train, y_train)
     print("Model training complete.")
 
     # evaluating performance
     print("Evaluating model performance on the test set...")
-    predictions = xgb_reg.predict(X_test)
+    with stage('evaluate', rows=len(X_test)):
+        predictions = xgb_reg.predict(X_test)
     predictions_rounded = predictions.round().astype(int) # Round predictions to the nearest year
     
     mae = mean_absolute_error(y_test, predictions_rounded)
     print(f"-> Mean Absolute Error (MAE) on 2024 data: {mae:.4f} years")
 
     # saving the trained model
-    # Ensure the directory for saving models exists
-    os.makedirs(MODELS_PATH, exist_ok=True)
-    model_filename = os.path.join(MODELS_PATH, 'xgb_year_prediction_model.pkl')
-    
-    print(f"Saving trained model to '{model_filename}'...")
-    joblib.dump(xgb_reg, model_filename)
+    # The model is saved in XGBoost's native format, with a metadata file recording the feature order,
+    # the training window and the metrics (see model_io.py)
+    print(f"Saving trained model to '{model_io.model_path(models_path=MODELS_PATH)}'...")
+    training_window = {
+        'target': target,
+        'train_years': [int(y_train.min()), int(y_train.max())] if len(y_train) else None,
+        'test_years': [int(y_test.min()), int(y_test.max())] if len(y_test) else None,
+        'train_rows': len(y_train),
+        'test_rows': len(y_test),
+        'station_features': 'as_of_open_year' if args.as_of_features else 'current',
+    }
+    #Unset parameters and NaN (the 'missing' marker, not valid JSON) are left out
+    params = {key: value for key, value in xgb_reg.get_params().items() if value is not None and value == value}
+    with stage('save_model'):
+        model_filename = model_io.save_model(xgb_reg, features, models_path=MODELS_PATH, training_window=training_window,
+                                             metrics={'mae_years': float(mae)}, params=params)
+    print(f"Model saved to '{model_filename}'.")
     
     print("--- Model training and saving process complete! ---")
 
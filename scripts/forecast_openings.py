@@ -0,0 +1,302 @@
+#Monthly station openings forecast, per region
+#The notebook (model_dev.ipynb) forecasts the statewide monthly openings with one Prophet fit. This script builds
+#one monthly openings series per region (a square grid region, or any column of the station layer such as a county)
+#plus the statewide total, all in one groupby, and forecasts all of them in one run:
+#    - "holt_winters": damped additive Holt-Winters, run on all series at once as NumPy arrays,
+#      with the smoothing parameters picked per series from a small grid. No per-series model start-up cost.
+#    - "xgboost": one global lag-feature XGBoost model trained on every series together and forecast recursively
+#      for all series at once. The model is saved as models/xgb_monthly_openings_model.ubj.
+#    - "prophet": one Prophet model per series, fitted in a process pool (needs the prophet package).
+#The forecasts are written as the 'openings_forecast' table (region, month, forecast, backend).
+#
+#Usage (from the project root):
+#    python scripts/forecast_openings.py --backend holt_winters --region-cell-km 25 --evaluate
+#    python scripts/forecast_openings.py --backend xgboost --region-column County
+import argparse
+import importlib.util
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+import xgboost as xgb
+from numpy.lib.stride_tricks import sliding_window_view
+
+import grid
+import model_io
+import projection
+import storage
+from features import TARGET_CRS, point_coords
+
+PROCESSED_DATA_PATH = storage.PROCESSED_DATA_PATH
+
+BACKENDS = ['holt_winters', 'xgboost', 'prophet']
+
+#Months to forecast
+HORIZON_MONTHS = 12
+#Side of the square grid regions, in meters
+REGION_CELL_M = 25_000
+#The evaluation holds out the months from here on, like the notebook's 2024 test set
+TEST_START = '2024-01-01'
+
+#Name of the statewide series
+TOTAL_REGION = 'total'
+
+SEASON_MONTHS = 12
+#Parameter grid of the Holt-Winters backend (level, trend, season smoothing), and the trend damping
+HW_ALPHAS = [0.05, 0.15, 0.3, 0.6]
+HW_BETAS = [0.01, 0.1]
+HW_GAMMAS = [0.05, 0.2]
+HW_DAMPING = 0.9
+
+#Lag features of the xgboost backend, in model order
+N_LAGS = 12
+LAG_FEATURES = [f'lag_{lag}' for lag in range(1, N_LAGS + 1)] + ['mean_3', 'mean_12', 'month']
+XGB_PARAMS = {
+    'objective': 'count:poisson',
+    'tree_method': 'hist',
+    'eta': 0.05,
+    'max_depth': 6,
+    'min_child_weight': 5,
+    'subsample': 0.8,
+}
+XGB_ROUNDS = 300
+MONTHLY_MODEL_NAME = "xgb_monthly_openings_model"
+
+
+def load_openings(region_column=None, region_cell_m=REGION_CELL_M):
+    """
+    Reads the opening month and region of every station. Returns (DataFrame with 'region' and 'month',
+    description of the regions for the output metadata).
+    Without region_column the regions are the cells of a square grid of region_cell_m meters.
+    """
+    columns = ['Open Date'] + ([region_column] if region_column else [])
+    stations = storage.read_layer('stations', columns=columns, base_path=PROCESSED_DATA_PATH)
+    stations['month'] = pd.to_datetime(stations['Open Date'], errors='coerce').dt.to_period('M').dt.to_timestamp()
+    stations = stations.dropna(subset=['month'])
+
+    if region_column:
+        regions = stations[region_column].astype(str)
+        description = {'type': 'column', 'column': region_column}
+    else:
+        stations = projection.to_crs(stations, TARGET_CRS)
+        spec = grid.grid_spec(stations.total_bounds, region_cell_m)
+        regions = pd.Series(grid.point_cell_ids(spec, point_coords(stations.geometry)), index=stations.index).astype(str)
+        description = {'type': 'grid', 'grid': spec._asdict(), 'crs': TARGET_CRS}
+    return pd.DataFrame({'region': regions, 'month': stations['month']}), description
+
+
+def monthly_series(openings, include_total=True):
+    """
+    Counts the openings per region and month in one groupby and returns them as a wide matrix
+    (one row per region, one column per month from the first to the last opening, months without openings are 0).
+    """
+    counts = openings.groupby(['region', 'month']).size().unstack('month', fill_value=0)
+    months = pd.date_range(openings['month'].min(), openings['month'].max(), freq='MS')
+    counts = counts.reindex(columns=months, fill_value=0)
+    if include_total:
+        counts.loc[TOTAL_REGION] = counts.sum(axis=0)
+    return counts.astype(np.float64)
+
+
+def forecast_holt_winters(Y, horizon, period=SEASON_MONTHS):
+    """
+    Damped additive Holt-Winters for every row of Y (n_series x n_months) at once.
+    Every parameter combination of the HW_* grid runs side by side, and each series keeps the combination
+    with the lowest one-step-ahead absolute error. Returns an (n_series, horizon) array.
+    """
+    alpha, beta, gamma = [a.reshape(-1, 1) for a in np.meshgrid(HW_ALPHAS, HW_BETAS, HW_GAMMAS, indexing='ij')]
+    n_series, n_months = Y.shape
+    n_params = len(alpha)
+
+    start = min(period, n_months)
+    level = np.broadcast_to(Y[:, :start].mean(axis=1), (n_params, n_series)).copy()
+    trend = np.zeros((n_params, n_series))
+    season = np.zeros((n_params, n_series, period))
+    season[:, :, :start] = Y[:, :start] - Y[:, :start].mean(axis=1, keepdims=True)
+    errors = np.zeros((n_params, n_series))
+
+    for t in range(n_months):
+        y = Y[:, t]
+        s = season[:, :, t % period]
+        errors += np.abs(y - (level + HW_DAMPING * trend + s))
+        new_level = alpha * (y - s) + (1 - alpha) * (level + HW_DAMPING * trend)
+        trend = beta * (new_level - level) + (1 - beta) * HW_DAMPING * trend
+        season[:, :, t % period] = gamma * (y - new_level) + (1 - gamma) * s
+        level = new_level
+
+    damping = np.cumsum(HW_DAMPING ** np.arange(1, horizon + 1))
+    season_idx = (n_months + np.arange(horizon)) % period
+    forecasts = level[:, :, None] + damping * trend[:, :, None] + season[:, :, season_idx]
+    best = errors.argmin(axis=0)
+    return np.clip(forecasts[best, np.arange(n_series)], 0, None)
+
+
+def lag_features(windows, months):
+    """
+    Feature matrix of the xgboost backend. windows is (n, N_LAGS) with the most recent month last,
+    months is the calendar month (1-12) of the month being predicted, one per row.
+    """
+    lags = windows[:, ::-1]
+    return np.column_stack([
+        lags,
+        lags[:, :3].mean(axis=1),
+        lags.mean(axis=1),
+        months,
+    ]).astype(np.float32)
+
+
+def train_lag_model(Y, month_numbers, nthread=0):
+    """
+    Trains one global XGBoost model on every (series, month) pair of Y that has N_LAGS months of history.
+    Months before the first opening of a region are left out, they only tell the model that nothing happens
+    where nothing has happened yet. month_numbers holds the calendar month of every column of Y.
+    """
+    windows = sliding_window_view(Y, N_LAGS, axis=1)[:, :-1]  #(n_series, n_months - N_LAGS, N_LAGS)
+    targets = Y[:, N_LAGS:]
+    target_months = np.broadcast_to(month_numbers[N_LAGS:], targets.shape)
+    started = (np.cumsum(Y, axis=1)[:, N_LAGS - 1:-1] > 0).ravel()
+    X = lag_features(windows.reshape(-1, N_LAGS)[started], target_months.ravel()[started])
+    dtrain = xgb.QuantileDMatrix(X, targets.ravel()[started], feature_names=LAG_FEATURES, nthread=nthread)
+    return xgb.train({**XGB_PARAMS, 'nthread': nthread}, dtrain, num_boost_round=XGB_ROUNDS)
+
+
+def forecast_xgboost(Y, month_numbers, horizon, booster=None):
+    """
+    Recursive multi-step forecast with the global lag model: each step predicts the next month of all series
+    in one call and feeds it back as the newest lag. Returns (forecasts, booster).
+    """
+    if Y.shape[1] <= N_LAGS:
+        raise ValueError(f"The xgboost backend needs more than {N_LAGS} months of history")
+    booster = booster or train_lag_model(Y, month_numbers)
+    window = Y[:, -N_LAGS:].copy()
+    forecasts = np.zeros((len(Y), horizon))
+    for step in range(horizon):
+        month = (month_numbers[-1] + step) % 12 + 1
+        X = lag_features(window, np.full(len(Y), month))
+        forecasts[:, step] = booster.inplace_predict(X, validate_features=False)
+        window = np.column_stack([window[:, 1:], forecasts[:, step]])
+    return np.clip(forecasts, 0, None), booster
+
+
+def _prophet_series(task):
+    #Runs in a worker process, one Prophet fit per series
+    from prophet import Prophet
+
+    months, values, horizon = task
+    model = Prophet()
+    model.fit(pd.DataFrame({'ds': months, 'y': values}))
+    future = model.make_future_dataframe(periods=horizon, freq='MS', include_history=False)
+    return np.clip(model.predict(future)['yhat'].to_numpy(), 0, None)
+
+
+def forecast_prophet(Y, months, horizon, workers=None):
+    """
+    Fits one Prophet model per series in a process pool. Returns an (n_series, horizon) array.
+    """
+    if importlib.util.find_spec('prophet') is None:
+        raise ImportError("The prophet backend needs the 'prophet' package (pip install prophet)")
+    tasks = [(months, row, horizon) for row in Y]
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        return np.vstack(list(executor.map(_prophet_series, tasks, chunksize=max(1, len(tasks) // 256))))
+
+
+def forecast(Y, months, backend, horizon=HORIZON_MONTHS, workers=None):
+    """
+    Forecasts the next horizon months of every row of Y (columns = months). Returns (forecasts, fitted model or None).
+    """
+    if backend == 'holt_winters':
+        return forecast_holt_winters(Y, horizon), None
+    if backend == 'xgboost':
+        return forecast_xgboost(Y, months.month.to_numpy(), horizon)
+    if backend == 'prophet':
+        return forecast_prophet(Y, months, horizon, workers), None
+    raise ValueError(f"Unknown backend '{backend}', expected one of {BACKENDS}")
+
+
+def evaluate(series, backend, test_start=TEST_START, horizon=HORIZON_MONTHS, workers=None):
+    """
+    Fits on the months before test_start, forecasts up to horizon months after it and returns
+    (MAE over all series, MAE of the statewide total) in stations per month.
+    """
+    months = series.columns
+    cut = int(np.searchsorted(months, pd.Timestamp(test_start)))
+    horizon = min(horizon, len(months) - cut)
+    if cut == 0 or horizon <= 0:
+        raise ValueError(f"Need months before and after {test_start} to evaluate")
+    predicted, _ = forecast(series.to_numpy()[:, :cut], months[:cut], backend, horizon, workers)
+    actual = series.to_numpy()[:, cut:cut + horizon]
+    errors = np.abs(predicted - actual)
+    total_mae = errors[series.index.get_loc(TOTAL_REGION)].mean() if TOTAL_REGION in series.index else float('nan')
+    return errors.mean(), total_mae
+
+
+def forecast_table(series, forecasts, backend):
+    """
+    Long format table of the forecasts: one row per region and forecast month.
+    """
+    horizon = forecasts.shape[1]
+    future = pd.date_range(series.columns[-1], periods=horizon + 1, freq='MS')[1:]
+    return pd.DataFrame({
+        'region': np.repeat(series.index.to_numpy(), horizon),
+        'month': np.tile(future.to_numpy(), len(series)),
+        'forecast': forecasts.ravel(),
+        'backend': backend,
+    })
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Forecast monthly station openings per region.")
+    parser.add_argument("--backend", choices=BACKENDS, default="holt_winters")
+    parser.add_argument("--horizon", type=int, default=HORIZON_MONTHS, help="months to forecast")
+    parser.add_argument("--region-column", default=None, help="station column to group by (e.g. County) instead of grid regions")
+    parser.add_argument("--region-cell-km", type=float, default=REGION_CELL_M / 1000, help="size of the grid regions")
+    parser.add_argument("--evaluate", action="store_true", help=f"also report the error on the months from {TEST_START} on")
+    parser.add_argument("--workers", type=int, default=None, help="worker processes of the prophet backend")
+    args = parser.parse_args()
+
+    print("--- Forecasting monthly station openings ---")
+    try:
+        openings, regions = load_openings(args.region_column, args.region_cell_km * 1000)
+    except (FileNotFoundError, KeyError, ValueError) as e:
+        print(f"ERROR: Could not load the station openings: {e}")
+        return
+    series = monthly_series(openings)
+    print(f"Built {len(series)} monthly series ({len(series) - 1} regions + statewide total) "
+          f"over {series.shape[1]} months, from {len(openings)} stations.")
+
+    try:
+        if args.evaluate:
+            start = time.perf_counter()
+            mae, total_mae = evaluate(series, args.backend, horizon=args.horizon, workers=args.workers)
+            print(f"-> {args.backend} MAE from {TEST_START}: {mae:.3f} stations/month per series, "
+                  f"{total_mae:.2f} for the statewide total ({time.perf_counter() - start:.1f} s)")
+
+        start = time.perf_counter()
+        forecasts, model = forecast(series.to_numpy(), series.columns, args.backend, args.horizon, args.workers)
+    except (ImportError, ValueError) as e:
+        print(f"ERROR: {e}")
+        return
+    print(f"Forecast {len(series)} series {args.horizon} months ahead in {time.perf_counter() - start:.2f} s.")
+
+    table = forecast_table(series, forecasts, args.backend)
+    metadata = {
+        'backend': args.backend,
+        'horizon_months': args.horizon,
+        'last_observed_month': series.columns[-1].strftime('%Y-%m'),
+        'regions': regions,
+    }
+    path = storage.write_table(table, 'openings_forecast', metadata=metadata, base_path=PROCESSED_DATA_PATH)
+    print(f"Forecasts saved to '{path}'.")
+    if model is not None:
+        model_path = model_io.save_model(model, LAG_FEATURES, name=MONTHLY_MODEL_NAME,
+                                         training_window={'first_month': series.columns[0].strftime('%Y-%m'),
+                                                          'last_month': series.columns[-1].strftime('%Y-%m'),
+                                                          'series': len(series)},
+                                         params={**XGB_PARAMS, 'num_boost_round': XGB_ROUNDS})
+        print(f"Global lag model saved to '{model_path}'.")
+    print(table[table['region'] == TOTAL_REGION][['month', 'forecast']].to_string(index=False))
+
+
+if __name__ == "__main__":
+    main()
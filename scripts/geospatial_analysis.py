@@ -1,47 +1,95 @@
-import os
+import argparse
+import json
+
 import geopandas as gpd
+import pyarrow.parquet as pq
+
+import storage
+import top_k
+from features import point_coords
+from instrumentation import fail, instrumented_run, stage
 
-#This script extracts the top 100 optimal locations for charging stations from the ranked list
+#This script extracts the top 200 optimal locations for charging stations from the ranked list
+#predict_demand.py already writes them in the same pass it scores the grid, this script picks them again
+#from an existing ranked layer (with another count or minimum separation, or after incremental_update.py)
 
-# This script reads the file with all the ranked locations...
-INPUT_FILENAME = "ranked_optimal_locations.geojson"
+# This script reads the layer with all the ranked locations...
+INPUT_LAYER = "ranked_locations"
 # ...and creates a new, clean file containing only the very best spots.
-OUTPUT_FILENAME = "top_charging_locations.geojson"
+# The dashboard reads this one as GeoJSON, whatever format the rest of the pipeline uses.
+OUTPUT_LAYER = "top_locations"
+OUTPUT_FORMAT = top_k.TOP_LOCATIONS_FORMAT
 
 # Define the paths. We assume this script is run from the project's root directory.
-PROCESSED_DATA_PATH = "data/processed/"
-INPUT_FILE_PATH = os.path.join(PROCESSED_DATA_PATH, INPUT_FILENAME)
-OUTPUT_FILE_PATH = os.path.join(PROCESSED_DATA_PATH, OUTPUT_FILENAME)
+PROCESSED_DATA_PATH = storage.PROCESSED_DATA_PATH
+OUTPUT_FILE_PATH = storage.layer_path(OUTPUT_LAYER, OUTPUT_FORMAT, PROCESSED_DATA_PATH)
+
+NUMBER_OF_TOP_SPOTS = top_k.TOP_K
 
-NUMBER_OF_TOP_SPOTS = 200
+#Rows read per batch when the ranked layer is streamed
+READ_BATCH_ROWS = 100_000
 
+def select_top_locations(k=NUMBER_OF_TOP_SPOTS, min_separation=top_k.MIN_SEPARATION_M):
+    """
+    Picks the top k locations of the ranked layer, whether or not it is sorted. A GeoParquet layer is streamed
+    batch by batch through a top_k.TopK, keeping the geometries as WKB until the few winners are known, so the
+    whole layer is never in memory. Other formats are read in full.
+    Returns (top locations GeoDataFrame with a 'rank' column, number of ranked locations read).
+    """
+    path, fmt = storage.find_layer(INPUT_LAYER, base_path=PROCESSED_DATA_PATH)
+    if fmt != 'parquet':
+        ranked_gdf = storage.read_layer(INPUT_LAYER, base_path=PROCESSED_DATA_PATH)
+        xy = point_coords(ranked_gdf.geometry) if min_separation > 0 else None
+        return top_k.select_top(ranked_gdf, k, min_separation, xy=xy), len(ranked_gdf)
+
+    parquet_file = pq.ParquetFile(path)
+    geo = json.loads(parquet_file.schema_arrow.metadata[b'geo'])
+    columns = [name for name in parquet_file.schema_arrow.names if name != 'bbox']
+    candidates = top_k.TopK(top_k.pool_size(k, min_separation))
+    for batch in parquet_file.iter_batches(batch_size=READ_BATCH_ROWS, columns=columns):
+        candidates.add(batch.to_pandas())
+    pool = candidates.result()
+    geometry = gpd.GeoSeries.from_wkb(pool['geometry'], index=pool.index, crs=geo['columns']['geometry'].get('crs'))
+    pool = gpd.GeoDataFrame(pool.drop(columns='geometry'), geometry=geometry)
+    xy = point_coords(pool.geometry) if min_separation > 0 else None
+    top = top_k.select_top(pool, k, min_separation, xy=xy)
+    if len(top) < k and candidates.truncated:
+        print(f"WARNING: only {len(top)} locations {min_separation} m apart among the best {len(pool)} candidates.")
+    return top, candidates.seen
+
+@instrumented_run('geospatial_analysis')
 def main():
     #this function filters the top locations and saves them to a new file
+    parser = argparse.ArgumentParser(description="Extract the top locations from the ranked layer.")
+    parser.add_argument("--top", type=int, default=NUMBER_OF_TOP_SPOTS, help="number of top locations")
+    parser.add_argument("--min-separation", type=float, default=top_k.MIN_SEPARATION_M,
+                        help="minimum distance in meters between two top locations (0 = none)")
+    args = parser.parse_args()
     print("--- Extracting Top Optimal Locations for EV Charging Stations ---")
 
-    print(f"Loading ranked locations from '{INPUT_FILE_PATH}'...")
+    print(f"Extracting the top {args.top} locations from the '{INPUT_LAYER}' layer...")
     try:
-        ranked_gdf = gpd.read_file(INPUT_FILE_PATH)
-        print(f"Successfully loaded {len(ranked_gdf)} ranked locations.")
+        with stage('select_top_locations') as s:
+            top_spots_gdf, n_ranked = select_top_locations(args.top, args.min_separation)
+            s.rows = n_ranked
+        print(f"Extracted {len(top_spots_gdf)} top locations out of {n_ranked} ranked locations.")
     except Exception as e:
-        print(f"Could not locate or read the file '{INPUT_FILE_PATH}'. Please ensure the file exists and is accessible.")
+        print(f"Could not locate or read the '{INPUT_LAYER}' layer: {e}. Please ensure the file exists and is accessible.")
+        fail(str(e))
         return
-    
-    print(f"Extracting the top {NUMBER_OF_TOP_SPOTS} locations...")
-    top_spots_gdf = ranked_gdf.head(NUMBER_OF_TOP_SPOTS)
-    print(f"Extracted {len(top_spots_gdf)} top locations.")
-    top_spots_gdf['rank'] = range(1, len(top_spots_gdf) + 1)
 
     print(f"Here are the top 5 locations")
     print(top_spots_gdf[['rank', 'suitability_score']].head().to_string())
 
       # making it much faster and more efficient than loading the entire grid every time.
-    print(f"\nSaving the top {NUMBER_OF_TOP_SPOTS} locations to '{OUTPUT_FILENAME}'...")
+    print(f"\nSaving the top {len(top_spots_gdf)} locations to '{OUTPUT_FILE_PATH}'...")
     try:
-        top_spots_gdf.to_file(OUTPUT_FILE_PATH, driver='GeoJSON')
+        with stage('write_top_locations', rows=len(top_spots_gdf)):
+            storage.write_layer(top_spots_gdf, OUTPUT_LAYER, OUTPUT_FORMAT, PROCESSED_DATA_PATH)
         print("--- Analysis complete! Your final data file is ready for the dashboard. ---")
     except Exception as e:
         print(f"Error saving the final output file: {e}")
+        fail(str(e))
 
     
 if __name__ == "__main__":
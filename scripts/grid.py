@@ -0,0 +1,174 @@
+#Vectorized helpers for the square prediction grid
+#A grid is fully described by its origin, cell size and number of columns/rows, so cells can be generated
+#for any part of it on demand (one tile at a time) instead of building every polygon up front.
+from collections import namedtuple
+
+import numpy as np
+import shapely
+
+#xmin/ymin is the lower left corner of the grid, cells are cell_size x cell_size meters
+GridSpec = namedtuple('GridSpec', ['xmin', 'ymin', 'cell_size', 'ncols', 'nrows'])
+
+
+def grid_spec(bounds, cell_size):
+    """
+    Returns the GridSpec of a grid that covers bounds (xmin, ymin, xmax, ymax) with square cells.
+    """
+    xmin, ymin, xmax, ymax = bounds
+    ncols = max(1, int(np.ceil((xmax - xmin) / cell_size)))
+    nrows = max(1, int(np.ceil((ymax - ymin) / cell_size)))
+    return GridSpec(float(xmin), float(ymin), float(cell_size), ncols, nrows)
+
+
+def cell_ids(spec, cols, rows):
+    """
+    Stable integer ID of every (col, row) cell. Cells are numbered column by column,
+    which is the order the original nested loop in predict_demand.py produced them in.
+    """
+    return np.asarray(cols, dtype=np.int64) * spec.nrows + np.asarray(rows, dtype=np.int64)
+
+
+def cell_col_row(spec, ids):
+    """
+    Inverse of cell_ids: returns the (cols, rows) of the given cell IDs.
+    """
+    ids = np.asarray(ids, dtype=np.int64)
+    return ids // spec.nrows, ids % spec.nrows
+
+
+def cell_centroids(spec, ids):
+    """
+    Returns an (N, 2) array with the center point of every cell in ids.
+    """
+    cols, rows = cell_col_row(spec, ids)
+    x = spec.xmin + (cols + 0.5) * spec.cell_size
+    y = spec.ymin + (rows + 0.5) * spec.cell_size
+    return np.column_stack([x, y])
+
+
+def cell_boxes(spec, ids):
+    """
+    Returns the square polygons of the cells in ids, built in one vectorized shapely.box call.
+    """
+    cols, rows = cell_col_row(spec, ids)
+    x0 = spec.xmin + cols * spec.cell_size
+    y0 = spec.ymin + rows * spec.cell_size
+    return shapely.box(x0, y0, x0 + spec.cell_size, y0 + spec.cell_size)
+
+
+def all_cell_ids(spec):
+    """
+    IDs of every cell in the grid, in cell ID order.
+    """
+    return np.arange(spec.ncols * spec.nrows, dtype=np.int64)
+
+
+def tiles(spec, tile_cells):
+    """
+    Splits the grid into square tiles of at most tile_cells x tile_cells cells.
+    Yields (col0, col1, row0, row1) ranges, end exclusive.
+    """
+    for col0 in range(0, spec.ncols, tile_cells):
+        for row0 in range(0, spec.nrows, tile_cells):
+            yield col0, min(col0 + tile_cells, spec.ncols), row0, min(row0 + tile_cells, spec.nrows)
+
+
+def tile_cell_ids(spec, col0, col1, row0, row1):
+    """
+    IDs of all cells inside one tile range.
+    """
+    cols, rows = np.meshgrid(np.arange(col0, col1), np.arange(row0, row1), indexing='ij')
+    return cell_ids(spec, cols.ravel(), rows.ravel())
+
+
+def point_cell_ids(spec, xy):
+    """
+    IDs of the cells the (N, 2) points in xy fall in. Points outside the grid go to the nearest edge cell.
+    """
+    xy = np.asarray(xy, dtype=float).reshape(-1, 2)
+    cols = np.clip(np.floor((xy[:, 0] - spec.xmin) / spec.cell_size), 0, spec.ncols - 1)
+    rows = np.clip(np.floor((xy[:, 1] - spec.ymin) / spec.cell_size), 0, spec.nrows - 1)
+    return cell_ids(spec, cols, rows)
+
+
+#Side of the blocks (in cells) DistanceBlocks groups the cells into
+BLOCK_CELLS = 16
+
+
+def cell_blocks(spec, ids, block_cells=BLOCK_CELLS):
+    """
+    Block of every cell in ids, for square blocks of block_cells x block_cells cells numbered row by row.
+    """
+    cols, rows = cell_col_row(spec, ids)
+    block_cols = -(-spec.ncols // block_cells)
+    return (rows // block_cells) * block_cols + cols // block_cells
+
+
+class DistanceBlocks:
+    """
+    The cells of a grid table grouped into square blocks, with an upper bound of the distance to the nearest station
+    in every block. A station can only be closer than the current nearest station, or have been the nearest one,
+    for cells of blocks that are within their bound of it, so a station change only looks at the blocks around it
+    instead of at every cell.
+    The rows of the table must be in block order (see order): the cells of block b are then the rows
+    starts[b]:starts[b + 1]. to_metadata/from_metadata store the blocks with the table, so they are not rebuilt.
+    """
+
+    def __init__(self, spec, starts, max_dist, block_cells=BLOCK_CELLS):
+        self.starts = np.asarray(starts, dtype=np.int64)
+        self.max_dist = np.asarray(max_dist, dtype=float)
+        self.block_cells = block_cells
+        #The box around the cell centers of every block
+        n_blocks = len(self.max_dist)
+        block_cols = -(-spec.ncols // block_cells)
+        block_col, block_row = np.arange(n_blocks) % block_cols, np.arange(n_blocks) // block_cols
+        self.x0 = spec.xmin + (block_col * block_cells + 0.5) * spec.cell_size
+        self.y0 = spec.ymin + (block_row * block_cells + 0.5) * spec.cell_size
+        self.x1 = self.x0 + (block_cells - 1) * spec.cell_size
+        self.y1 = self.y0 + (block_cells - 1) * spec.cell_size
+
+    @staticmethod
+    def order(spec, ids, block_cells=BLOCK_CELLS):
+        """
+        Positions that put the cells in ids in block order.
+        """
+        return np.argsort(cell_blocks(spec, ids, block_cells), kind='stable')
+
+    @classmethod
+    def from_cells(cls, spec, ids, dist, block_cells=BLOCK_CELLS):
+        """
+        The blocks of cells that are in block order, with dist the distance of every cell to its nearest station.
+        """
+        block = cell_blocks(spec, ids, block_cells)
+        if np.any(block[1:] < block[:-1]):
+            raise ValueError("The cells are not in block order")
+        n_blocks = -(-spec.ncols // block_cells) * -(-spec.nrows // block_cells)
+        max_dist = np.full(n_blocks, -np.inf)
+        np.maximum.at(max_dist, block, np.asarray(dist, dtype=float))
+        return cls(spec, np.searchsorted(block, np.arange(n_blocks + 1)), max_dist, block_cells)
+
+    @classmethod
+    def from_metadata(cls, spec, metadata):
+        return cls(spec, metadata['starts'], metadata['max_dist'], metadata['block_cells'])
+
+    def to_metadata(self):
+        return {'block_cells': self.block_cells, 'starts': self.starts.tolist(), 'max_dist': self.max_dist.tolist()}
+
+    def candidates(self, point):
+        """
+        Positions of the cells of the blocks that are within their bound of point.
+        """
+        dx = np.maximum(np.maximum(self.x0 - point[0], point[0] - self.x1), 0)
+        dy = np.maximum(np.maximum(self.y0 - point[1], point[1] - self.y1), 0)
+        near = np.flatnonzero(np.hypot(dx, dy) <= self.max_dist)
+        if not len(near):
+            return np.empty(0, dtype=np.int64)
+        return np.concatenate([np.arange(self.starts[b], self.starts[b + 1]) for b in near])
+
+    def update(self, positions, dist):
+        """
+        Recomputes the bound of the blocks of the cells at positions, after their distance changed.
+        """
+        for b in np.unique(np.searchsorted(self.starts, positions, side='right') - 1):
+            cells = dist[self.starts[b]:self.starts[b + 1]]
+            self.max_dist[b] = cells.max() if len(cells) else -np.inf
@@ -0,0 +1,258 @@
+#Incremental re-scoring when stations open or close
+#A station change only moves dist_to_nearest_station_m, and only for the cells around it, so instead of rerunning
+#predict_demand.py over the whole state we take the grid feature table it persisted, find the affected cells
+#with a spatial index, recompute their distance and prediction, and merge them into the ranked output.
+#
+#The index is the grid.DistanceBlocks stored with the table: the cells are kept in square blocks, each with the
+#largest distance to a station inside it, so only the blocks around a changed station are searched.
+#The changed rows are put into the ranked locations by a binary search on the scores instead of sorting them again.
+#The search, the new features and predictions and the merge follow the size of the delta; the output files
+#(grid feature table, ranked and top locations, explanations and dashboard points) are still rewritten whole.
+#
+#The delta is a CSV file with one row per change:
+#    ID,change,Latitude,Longitude
+#    91234,added,47.61,-122.33
+#    80511,removed,,
+#Latitude/Longitude are only needed for added stations.
+import argparse
+import os
+import time
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+from scipy.spatial import cKDTree
+
+import build_dashboard_data
+import grid
+import projection
+import storage
+import top_k
+from features import FEATURES, TARGET_CRS, point_coords
+from instrumentation import fail, instrumented_run, stage
+from predict_demand import CHARGING_DESERT_M, MODEL_FILE, OUTPUT_PATH, PROCESSED_DATA_PATH, load_model, suitability_score
+
+#Two station locations closer than this (in meters) are treated as the same location
+SAME_LOCATION_M = 0.01
+
+
+def load_delta(path):
+    """
+    Reads a station delta CSV and checks that it has what we need.
+    """
+    delta = pd.read_csv(path)
+    missing = {'ID', 'change'} - set(delta.columns)
+    if missing:
+        raise ValueError(f"Delta file '{path}' is missing the columns {sorted(missing)}")
+    delta['change'] = delta['change'].str.strip().str.lower()
+    unknown = set(delta['change']) - {'added', 'removed'}
+    if unknown:
+        raise ValueError(f"Unknown change types {sorted(unknown)}, expected 'added' or 'removed'")
+    added = delta[delta['change'] == 'added']
+    if len(added) and ({'Latitude', 'Longitude'} - set(delta.columns) or added[['Latitude', 'Longitude']].isna().any(axis=None)):
+        raise ValueError("Added stations need a Latitude and Longitude")
+    return delta
+
+
+def apply_delta(gdf_stations, delta):
+    """
+    Applies a delta to the station layer (in TARGET_CRS). An added station whose ID is in the layer already replaces
+    that station, so applying the same delta twice changes nothing.
+    Returns (updated stations, coordinates of the added stations, coordinates of the removed stations).
+    """
+    removed_mask = gdf_stations['ID'].isin(delta['ID'])
+    removed_xy = point_coords(gdf_stations.geometry[removed_mask])
+
+    added = delta[delta['change'] == 'added'].drop(columns=['change'])
+    if not len(added):
+        return gdf_stations[~removed_mask].reset_index(drop=True), np.empty((0, 2)), removed_xy
+    gdf_added = gpd.GeoDataFrame(
+        added, geometry=gpd.points_from_xy(added['Longitude'], added['Latitude']), crs="EPSG:4326"
+    )
+    gdf_added = projection.to_crs(gdf_added, TARGET_CRS)
+    added_xy = point_coords(gdf_added.geometry)
+
+    updated = pd.concat([gdf_stations[~removed_mask], gdf_added], ignore_index=True)
+    return gpd.GeoDataFrame(updated, geometry='geometry', crs=TARGET_CRS), added_xy, removed_xy
+
+
+def read_grid_table(base_path=OUTPUT_PATH):
+    """
+    The grid feature table with its metadata, GridSpec and DistanceBlocks. A table written before the blocks were
+    stored with it is put in block order here; the next write of the table stores them.
+    """
+    table = storage.read_table('grid_features', base_path=base_path)
+    metadata = storage.read_table_metadata('grid_features', base_path=base_path)
+    spec = grid.GridSpec(**metadata['grid'])
+    if 'blocks' in metadata:
+        return table, metadata, spec, grid.DistanceBlocks.from_metadata(spec, metadata['blocks'])
+    table = table.iloc[grid.DistanceBlocks.order(spec, table['cell_id'].to_numpy())].reset_index(drop=True)
+    blocks = grid.DistanceBlocks.from_cells(spec, table['cell_id'].to_numpy(), table['dist_to_nearest_station_m'].to_numpy())
+    return table, metadata, spec, blocks
+
+
+def affected_cells(grid_xy, dist, nearest_xy, added_xy, removed_xy, blocks):
+    """
+    Positions of the grid cells whose nearest station changes: the cells an added station is closer to than their
+    current nearest one, and the cells whose nearest station was removed. Only the cells of the blocks around every
+    station (see grid.DistanceBlocks) are checked.
+    """
+    affected = [np.empty(0, dtype=np.int64)]
+    for station in np.asarray(added_xy, dtype=float).reshape(-1, 2):
+        candidates = blocks.candidates(station)
+        affected.append(candidates[np.hypot(*(grid_xy[candidates] - station).T) < dist[candidates]])
+    for station in np.asarray(removed_xy, dtype=float).reshape(-1, 2):
+        candidates = blocks.candidates(station)
+        affected.append(candidates[np.hypot(*(nearest_xy[candidates] - station).T) <= SAME_LOCATION_M])
+    return np.unique(np.concatenate(affected))
+
+
+def merge_ranked(ranked_gdf, new_rows, cell_ids):
+    """
+    Replaces the rows of the cells in cell_ids of the ranked locations (sorted best first) with new_rows. The new
+    rows are put in place by a binary search on the scores, so the ranked rows are never sorted again.
+    """
+    kept = ranked_gdf[~ranked_gdf['cell_id'].isin(cell_ids)]
+    new_rows = new_rows.sort_values('suitability_score', ascending=False, kind='stable')
+    kept_scores = kept['suitability_score'].to_numpy(dtype=float)
+    if np.any(kept_scores[1:] > kept_scores[:-1]):
+        #A layer that was written unsorted is sorted once
+        kept = kept.sort_values('suitability_score', ascending=False, kind='stable')
+        kept_scores = kept['suitability_score'].to_numpy(dtype=float)
+    #After the kept rows of the same score, like a stable sort of the kept rows followed by the new ones
+    new_positions = np.searchsorted(-kept_scores, -new_rows['suitability_score'].to_numpy(dtype=float), side='right')
+    new_positions += np.arange(len(new_rows))
+    order = np.empty(len(kept) + len(new_rows), dtype=np.int64)
+    is_new = np.zeros(len(order), dtype=bool)
+    is_new[new_positions] = True
+    order[~is_new] = np.arange(len(kept))
+    order[new_positions] = len(kept) + np.arange(len(new_rows))
+    merged = pd.concat([kept, new_rows], ignore_index=True).iloc[order].reset_index(drop=True)
+    return gpd.GeoDataFrame(merged, geometry='geometry', crs=ranked_gdf.crs)
+
+
+def update_scores(table, spec, blocks, gdf_stations, delta, model, ranked_gdf):
+    """
+    Rescores the cells a station delta affects.
+    Updates table (the grid feature table, in block order) and blocks in place and returns (updated stations,
+    updated ranked locations, the updated rows of the affected cells).
+    """
+    updated_stations, added_xy, removed_xy = apply_delta(gdf_stations, delta)
+    grid_xy = table[['x', 'y']].to_numpy()
+    nearest_xy = table[['nearest_station_x', 'nearest_station_y']].to_numpy()
+    affected = affected_cells(grid_xy, table['dist_to_nearest_station_m'].to_numpy(), nearest_xy,
+                              added_xy, removed_xy, blocks)
+    if not len(affected):
+        return updated_stations, ranked_gdf, table.iloc[:0]
+
+    #New nearest station of every affected cell
+    station_xy = point_coords(updated_stations.geometry)
+    new_dist, nearest = cKDTree(station_xy).query(grid_xy[affected], k=1)
+    rows = table.index[affected]
+    table.loc[rows, 'dist_to_nearest_station_m'] = new_dist
+    table.loc[rows, 'nearest_station_x'] = station_xy[nearest, 0]
+    table.loc[rows, 'nearest_station_y'] = station_xy[nearest, 1]
+    table.loc[rows, 'predicted_open_year'] = model.predict(table.loc[rows, FEATURES])
+    blocks.update(affected, table['dist_to_nearest_station_m'].to_numpy())
+
+    #Replace the affected cells in the ranked output with their new values (if they are still charging deserts)
+    changed = table.loc[rows]
+    changed = changed[changed['dist_to_nearest_station_m'] > CHARGING_DESERT_M].copy()
+    changed['suitability_score'] = suitability_score(
+        changed['dist_to_nearest_station_m'], changed['predicted_open_year'], changed['poi_density_1.5m']
+    )
+    new_rows = gpd.GeoDataFrame(
+        changed, geometry=grid.cell_boxes(spec, changed['cell_id'].to_numpy()), crs=ranked_gdf.crs
+    )[list(ranked_gdf.columns)]
+    ranked = merge_ranked(ranked_gdf, new_rows, table.loc[rows, 'cell_id'])
+    return updated_stations, ranked, table.loc[rows]
+
+
+def update_explanations(affected, base_path=OUTPUT_PATH):
+    """
+    Replaces the explanations of the affected cells (the updated rows of the grid feature table) with those of the
+    ones that are still charging deserts, if predict_demand.py wrote explanations. Returns the path written to, or None.
+    """
+    if not os.path.exists(storage.table_path('explanations', base_path)):
+        return None
+    import explain
+
+    deserts = affected[affected['dist_to_nearest_station_m'] > CHARGING_DESERT_M]
+    explanations = storage.read_table('explanations', base_path=base_path)
+    explanations = explanations[~explanations['cell_id'].isin(affected['cell_id'])]
+    if len(deserts):
+        explanations = pd.concat([explanations, explain.explain_cells(deserts['cell_id'].to_numpy(), deserts, MODEL_FILE)])
+    explanations = explanations.sort_values('cell_id', kind='stable').reset_index(drop=True)
+    return explain.write_explanations(explanations, MODEL_FILE, base_path)
+
+
+@instrumented_run('incremental_update')
+def main():
+    parser = argparse.ArgumentParser(description="Rescore only the grid cells affected by added or removed stations.")
+    parser.add_argument("delta", help="CSV file with the station changes (ID, change, Latitude, Longitude)")
+    parser.add_argument("--top", type=int, default=top_k.TOP_K, help="number of top locations written for the dashboard")
+    parser.add_argument("--min-separation", type=float, default=top_k.MIN_SEPARATION_M,
+                        help="minimum distance in meters between two top locations (0 = none)")
+    args = parser.parse_args()
+
+    print("Starting incremental update...")
+    start = time.perf_counter()
+    try:
+        delta = load_delta(args.delta)
+    except (FileNotFoundError, ValueError) as e:
+        print(f"ERROR: {e}.")
+        fail(str(e))
+        return
+    try:
+        with stage('load') as s:
+            table, metadata, spec, blocks = read_grid_table()
+            gdf_stations = projection.read_projected_layer('stations', TARGET_CRS, base_path=PROCESSED_DATA_PATH)
+            ranked_gdf = storage.read_layer('ranked_locations', base_path=OUTPUT_PATH)
+            s.rows = len(table)
+    except FileNotFoundError as e:
+        print(f"ERROR: {e}. Run predict_demand.py first to create the grid feature table and the ranked locations.")
+        fail(str(e))
+        return
+    try:
+        model = load_model(MODEL_FILE)
+    except (FileNotFoundError, ValueError) as e:
+        #e.g. a model trained with the drive distance, which a station change does not update
+        print(f"ERROR: {e}.")
+        fail(str(e))
+        return
+    if 'ID' not in gdf_stations.columns:
+        print("ERROR: The station layer has no 'ID' column, so removed stations cannot be matched.")
+        fail("The station layer has no 'ID' column")
+        return
+    print(f"Loaded {len(table)} grid cells and a delta of {len(delta)} station changes.")
+
+    with stage('rescore') as s:
+        gdf_stations, ranked_gdf, affected = update_scores(table, spec, blocks, gdf_stations, delta, model, ranked_gdf)
+        s.rows = len(affected)
+    print(f"Rescored {len(affected)} affected cells.")
+
+    #Every write is atomic, and the station layer goes last: if a run stops partway, running it again with the same
+    #delta finishes the update, since the cells that were already updated are no longer affected by the delta
+    if len(affected):
+        with stage('write_outputs', rows=len(ranked_gdf)):
+            storage.write_layer(ranked_gdf, 'ranked_locations', base_path=OUTPUT_PATH)
+            top_gdf = top_k.select_top(ranked_gdf, args.top, args.min_separation,
+                                       xy=point_coords(ranked_gdf.geometry) if args.min_separation > 0 else None)
+            storage.write_layer(top_gdf, 'top_locations', top_k.TOP_LOCATIONS_FORMAT, OUTPUT_PATH)
+            updated = ['ranked locations', f'top {len(top_gdf)} locations']
+            if update_explanations(affected):
+                updated.append('explanations')
+            #Only refreshed if the dashboard is served from a point file already (see build_dashboard_data.py)
+            if os.path.exists(build_dashboard_data.OUTPUT_FILE):
+                build_dashboard_data.write_points(build_dashboard_data.build_points(ranked_gdf))
+                updated.append('dashboard points')
+            metadata['blocks'] = blocks.to_metadata()
+            storage.write_table(table, 'grid_features', metadata=metadata, base_path=OUTPUT_PATH)
+        print(f"Updated the {', '.join(updated[:-1])} and {updated[-1]}.")
+    storage.write_layer(gdf_stations, 'stations', base_path=PROCESSED_DATA_PATH)
+    print(f"Identified {len(ranked_gdf)} potential locations in charging deserts.")
+    print(f"Incremental update complete in {time.perf_counter() - start:.2f} s.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,305 @@
+#Stage-level instrumentation of the pipeline scripts
+#A script's main() is wrapped with @instrumented_run(name), and each of its steps runs inside `with stage(name):`.
+#Every stage records its wall time, CPU time, peak resident memory and (optionally) row count. At the end of the run
+#a JSON report is written to reports/runs/, so a slow or memory hungry stage of a nightly run can be found without
+#rerunning it under a profiler.
+#
+#Environment variables:
+#    EV_RUN_REPORTS=0            turns the reports off
+#    EV_RUN_REPORT_DIR=<dir>     where the JSON reports go (default reports/runs)
+#    EV_PROFILE=cprofile         also profile every stage with cProfile (.prof files, open with snakeviz/pstats)
+#    EV_PROFILE=pyinstrument     ...or with pyinstrument (.html files, needs the pyinstrument package)
+#    EV_PROFILE_DIR=<dir>        where the profiles go (default reports/profiles)
+#    EV_PROMETHEUS_DIR=<dir>     also write the metrics as a Prometheus text file (node_exporter textfile collector)
+import contextlib
+import datetime
+import functools
+import json
+import os
+import re
+import resource
+import sys
+import threading
+import time
+
+import storage
+
+REPORTS_ENABLED = os.getenv("EV_RUN_REPORTS", "1") != "0"
+RUN_REPORT_DIR = os.getenv("EV_RUN_REPORT_DIR", "reports/runs")
+PROFILER = os.getenv("EV_PROFILE", "").lower()
+PROFILE_DIR = os.getenv("EV_PROFILE_DIR", "reports/profiles")
+PROMETHEUS_DIR = os.getenv("EV_PROMETHEUS_DIR")
+
+#How often the memory of a running stage is sampled
+MEMORY_SAMPLE_S = 0.01
+
+#The run the stage() calls of this process report to, set by instrumented_run
+_current_run = None
+
+
+def rss_bytes():
+    """
+    Current resident set size of this process. Read from /proc on Linux; elsewhere the peak
+    from getrusage (which never decreases) is the best we have.
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        return peak_rss_bytes()
+
+
+def peak_rss_bytes():
+    """
+    Peak resident set size of this process so far.
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+class MemorySampler:
+    """
+    Samples the resident set size in a background thread while it is active, to get the peak memory of one
+    stage instead of the peak of the whole process so far.
+    """
+
+    def __init__(self, interval=MEMORY_SAMPLE_S):
+        self.interval = interval
+        self.start_bytes = self.peak_bytes = rss_bytes()
+        self._done = threading.Event()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+
+    def _sample(self):
+        while not self._done.wait(self.interval):
+            self.peak_bytes = max(self.peak_bytes, rss_bytes())
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._done.set()
+        self._thread.join()
+        self.peak_bytes = max(self.peak_bytes, rss_bytes())
+
+
+@contextlib.contextmanager
+def _profiled(run_name, stage_name):
+    #Profiles the block with the profiler selected by EV_PROFILE, if any
+    if PROFILER not in ('cprofile', 'pyinstrument'):
+        yield
+        return
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    base = os.path.join(PROFILE_DIR, f"{run_name}_{datetime.datetime.now():%Y%m%d_%H%M%S}_{_slug(stage_name)}")
+    if PROFILER == 'cprofile':
+        import cProfile
+
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            profiler.dump_stats(base + ".prof")
+    else:
+        from pyinstrument import Profiler
+
+        profiler = Profiler()
+        profiler.start()
+        try:
+            yield
+        finally:
+            profiler.stop()
+            with open(base + ".html", 'w') as f:
+                f.write(profiler.output_html())
+
+
+def _slug(name):
+    return re.sub(r'[^A-Za-z0-9_.-]+', '_', name)
+
+
+class StageRecord:
+    """
+    Measurements of one stage. Set .rows (and anything in .info) inside the with block.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.rows = None
+        self.info = {}
+        self.status = 'ok'
+        self.wall_s = self.cpu_s = 0.0
+        self.peak_rss_bytes = self.rss_growth_bytes = 0
+
+    def as_dict(self):
+        record = {
+            'stage': self.name,
+            'status': self.status,
+            'wall_s': round(self.wall_s, 4),
+            'cpu_s': round(self.cpu_s, 4),
+            'peak_rss_mb': round(self.peak_rss_bytes / 1024 ** 2, 1),
+            'rss_growth_mb': round(self.rss_growth_bytes / 1024 ** 2, 1),
+            'rows': self.rows,
+        }
+        if self.info:
+            record['info'] = self.info
+        return record
+
+
+class RunReport:
+    """
+    Collects the stage records of one script run and writes them as a JSON report (and Prometheus metrics).
+    """
+
+    def __init__(self, name, report_dir=RUN_REPORT_DIR, prometheus_dir=PROMETHEUS_DIR, enabled=REPORTS_ENABLED):
+        self.name = name
+        self.report_dir = report_dir
+        self.prometheus_dir = prometheus_dir
+        self.enabled = enabled
+        self.stages = []
+        self.status = 'ok'
+        self.message = None
+        self.started = datetime.datetime.now()
+        self._wall_start = time.perf_counter()
+        self._cpu_start = time.process_time()
+
+    @contextlib.contextmanager
+    def stage(self, name, rows=None):
+        record = StageRecord(name)
+        record.rows = rows
+        memory = MemorySampler()
+        wall_start, cpu_start = time.perf_counter(), time.process_time()
+        try:
+            with memory, _profiled(self.name, name):
+                yield record
+        except BaseException as e:
+            record.status = 'error'
+            record.info['error'] = f"{type(e).__name__}: {e}"
+            raise
+        finally:
+            record.wall_s = time.perf_counter() - wall_start
+            record.cpu_s = time.process_time() - cpu_start
+            record.peak_rss_bytes = memory.peak_bytes
+            record.rss_growth_bytes = memory.peak_bytes - memory.start_bytes
+            self.stages.append(record)
+
+    def fail(self, message):
+        """
+        Marks the run as failed, for scripts that stop with an error message instead of an exception.
+        """
+        self.status = 'failed'
+        self.message = message
+
+    def as_dict(self):
+        return {
+            'run': self.name,
+            'status': self.status,
+            'message': self.message,
+            'started': self.started.isoformat(timespec='seconds'),
+            'finished': datetime.datetime.now().isoformat(timespec='seconds'),
+            'argv': sys.argv,
+            'pid': os.getpid(),
+            'wall_s': round(time.perf_counter() - self._wall_start, 4),
+            'cpu_s': round(time.process_time() - self._cpu_start, 4),
+            'peak_rss_mb': round(peak_rss_bytes() / 1024 ** 2, 1),
+            'profiler': PROFILER or None,
+            'stages': [record.as_dict() for record in self.stages],
+        }
+
+    def finish(self):
+        """
+        Writes the report and returns its path (None when reports are turned off).
+        """
+        if not self.enabled:
+            return None
+        report = self.as_dict()
+        os.makedirs(self.report_dir, exist_ok=True)
+        path = os.path.join(self.report_dir, f"{self.name}_{self.started:%Y%m%d_%H%M%S}.json")
+        data = json.dumps(report, indent=2, default=str).encode()
+        storage.atomic_write(path, data)
+        storage.atomic_write(os.path.join(self.report_dir, f"{self.name}_latest.json"), data)
+        if self.prometheus_dir:
+            os.makedirs(self.prometheus_dir, exist_ok=True)
+            storage.atomic_write(os.path.join(self.prometheus_dir, f"ev_{self.name}.prom"), prometheus_text(report).encode())
+        return path
+
+
+def prometheus_text(report):
+    """
+    The metrics of a run report in the Prometheus text exposition format.
+    """
+    run = report['run']
+    lines = []
+
+    def metric(name, help_text, samples):
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} gauge")
+        for labels, value in samples:
+            label_text = ','.join(f'{key}="{value_}"' for key, value_ in labels.items())
+            lines.append(f"{name}{{{label_text}}} {value}")
+
+    stages = report['stages']
+    metric('ev_run_success', "1 if the last run succeeded", [({'run': run}, int(report['status'] == 'ok'))])
+    metric('ev_run_wall_seconds', "Wall time of the last run", [({'run': run}, report['wall_s'])])
+    metric('ev_run_peak_rss_bytes', "Peak resident memory of the last run",
+           [({'run': run}, int(report['peak_rss_mb'] * 1024 ** 2))])
+    metric('ev_run_last_finished_timestamp_seconds', "When the last run finished",
+           [({'run': run}, int(time.time()))])
+    metric('ev_stage_wall_seconds', "Wall time of a stage",
+           [({'run': run, 'stage': s['stage']}, s['wall_s']) for s in stages])
+    metric('ev_stage_cpu_seconds', "CPU time of a stage", [({'run': run, 'stage': s['stage']}, s['cpu_s']) for s in stages])
+    metric('ev_stage_peak_rss_bytes', "Peak resident memory during a stage",
+           [({'run': run, 'stage': s['stage']}, int(s['peak_rss_mb'] * 1024 ** 2)) for s in stages])
+    metric('ev_stage_rows', "Rows produced by a stage",
+           [({'run': run, 'stage': s['stage']}, s['rows']) for s in stages if s['rows'] is not None])
+    return '\n'.join(lines) + '\n'
+
+
+def current_run():
+    return _current_run
+
+
+@contextlib.contextmanager
+def stage(name, rows=None):
+    """
+    Records a stage of the current run. Outside of an instrumented run (e.g. when a stage function is
+    imported by another script) nothing is measured.
+    """
+    if _current_run is None:
+        yield StageRecord(name)
+        return
+    with _current_run.stage(name, rows) as record:
+        yield record
+
+
+def fail(message):
+    """
+    Marks the current run as failed (see RunReport.fail).
+    """
+    if _current_run is not None:
+        _current_run.fail(message)
+
+
+def instrumented_run(name):
+    """
+    Decorator for a script's main(): collects the stages of the call into a RunReport and writes it at the end,
+    also when main() raises.
+    """
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            global _current_run
+            previous, _current_run = _current_run, RunReport(name)
+            run = _current_run
+            try:
+                return fn(*args, **kwargs)
+            except BaseException as e:
+                run.fail(f"{type(e).__name__}: {e}")
+                raise
+            finally:
+                _current_run = previous
+                path = run.finish()
+                if path:
+                    print(f"Run report saved to '{path}'.")
+        return wrapper
+    return decorator
@@ -0,0 +1,190 @@
+#Saving and loading of the open year model
+#Models are stored in XGBoost's own format (UBJSON by default, JSON also works) instead of a pickle of the
+#sklearn wrapper: loading takes milliseconds, does not depend on the pickled library versions and gives us a
+#bare Booster that predicts straight from a NumPy array. Next to every model file there is a metadata sidecar
+#(<model>.meta.json) with the feature names in training order, the training window and the evaluation metrics.
+#
+#Old pickled models (models/*.pkl) can still be loaded, or converted once with:
+#    python scripts/model_io.py convert models/xgb_year_prediction_model.pkl
+import argparse
+import datetime
+import json
+import os
+
+import numpy as np
+
+import storage
+
+MODELS_PATH = "models/"
+MODEL_NAME = "xgb_year_prediction_model"
+
+#"ubj" (binary, smaller and faster to load) or "json" (human readable)
+MODEL_FORMAT = "ubj"
+MODEL_FORMATS = ('ubj', 'json')
+
+#Threads used by predict(), 0 means all cores. Can be set with the EV_PREDICT_THREADS environment variable.
+PREDICT_THREADS = int(os.getenv("EV_PREDICT_THREADS", 0))
+
+
+def model_path(name=MODEL_NAME, fmt=MODEL_FORMAT, models_path=MODELS_PATH):
+    """
+    Path of a model file in the native format fmt.
+    """
+    if fmt not in MODEL_FORMATS:
+        raise ValueError(f"Unknown model format '{fmt}', expected one of {list(MODEL_FORMATS)}")
+    return os.path.join(models_path, f"{name}.{fmt}")
+
+
+def metadata_path(model_file):
+    """
+    Path of the metadata sidecar of a model file.
+    """
+    return os.path.splitext(model_file)[0] + ".meta.json"
+
+
+def find_model_file(name=MODEL_NAME, models_path=MODELS_PATH):
+    """
+    Returns the path of a stored model, preferring the native formats over a legacy pickle.
+    If none exists, the path the model would be saved to is returned (so error messages point to it).
+    """
+    for path in [model_path(name, fmt, models_path) for fmt in MODEL_FORMATS] + [os.path.join(models_path, name + ".pkl")]:
+        if os.path.exists(path):
+            return path
+    return model_path(name, MODEL_FORMAT, models_path)
+
+
+class Model:
+    """
+    A loaded Booster with its metadata.
+    predict() takes a DataFrame (its feature columns are picked in training order) or an (N, n_features) array
+    already in that order, and predicts with inplace_predict from one contiguous float32 array, without a DMatrix.
+    """
+
+    def __init__(self, booster, metadata):
+        self.booster = booster
+        self.metadata = metadata
+        self.features = list(metadata['features'])
+
+    def predict(self, X):
+        if hasattr(X, 'columns'):
+            X = X[self.features].to_numpy(dtype=np.float32)
+        X = np.ascontiguousarray(X, dtype=np.float32)
+        if X.ndim != 2 or X.shape[1] != len(self.features):
+            raise ValueError(f"Expected an array with {len(self.features)} feature columns, got shape {X.shape}")
+        return self.booster.inplace_predict(X, validate_features=False)
+
+    def contributions(self, X, approx=False):
+        """
+        Feature contributions (TreeSHAP) of every row of X (same input as predict()): an (N, n_features + 1) array
+        whose last column is the bias, and every row adds up to the prediction. approx uses the faster Saabas
+        approximation instead of exact Shapley values.
+        """
+        import xgboost as xgb
+
+        if hasattr(X, 'columns'):
+            X = X[self.features].to_numpy(dtype=np.float32)
+        data = xgb.DMatrix(np.ascontiguousarray(X, dtype=np.float32), feature_names=self.features)
+        return self.booster.predict(data, pred_contribs=True, approx_contribs=approx, validate_features=False)
+
+    def set_threads(self, nthread):
+        self.booster.set_param({'nthread': nthread})
+
+
+def save_model(model, features, name=MODEL_NAME, fmt=MODEL_FORMAT, models_path=MODELS_PATH,
+               training_window=None, metrics=None, params=None):
+    """
+    Saves a trained XGBRegressor (or Booster) in the native format plus its metadata sidecar.
+    features are the feature names in the order of the training columns. training_window, metrics and params
+    are JSON serializable dicts describing how the model was trained. Returns the model path.
+    """
+    import xgboost as xgb
+
+    booster = model.get_booster() if hasattr(model, 'get_booster') else model
+    booster.feature_names = list(features)
+    os.makedirs(models_path, exist_ok=True)
+    path = model_path(name, fmt, models_path)
+    #XGBoost picks the file format from the extension, so the temporary file keeps it
+    storage.atomic_write(path, booster.save_model, suffix=os.path.splitext(path)[1])
+
+    metadata = {
+        'features': list(features),
+        'format': fmt,
+        'xgboost_version': xgb.__version__,
+        'saved_at': datetime.datetime.now().isoformat(timespec='seconds'),
+        'num_boosted_rounds': booster.num_boosted_rounds(),
+        'training_window': training_window or {},
+        'metrics': metrics or {},
+        'params': params or {},
+    }
+    storage.atomic_write(metadata_path(path), json.dumps(metadata, indent=2, default=str).encode())
+    return path
+
+
+def _load_legacy(model_file):
+    #joblib is only needed for old pickled models
+    import joblib
+
+    booster = joblib.load(model_file).get_booster()
+    return booster, {'features': booster.feature_names, 'format': 'pkl'}
+
+
+def load_model(model_file=None, nthread=PREDICT_THREADS, features=None):
+    """
+    Loads a model saved by save_model (or a legacy pickle) and returns it as a Model.
+    nthread sets the prediction threads (0 = all cores). When features is given, the model must have been
+    trained on exactly these features in this order, otherwise a ValueError is raised here instead of
+    the model silently predicting from the wrong columns.
+    """
+    #xgboost takes a second to import, so it is only loaded once a model is (the path helpers do not need it)
+    import xgboost as xgb
+
+    model_file = model_file or find_model_file()
+    if model_file.endswith(".pkl"):
+        booster, metadata = _load_legacy(model_file)
+    else:
+        booster = xgb.Booster()
+        booster.load_model(model_file)
+        try:
+            with open(metadata_path(model_file)) as f:
+                metadata = json.load(f)
+        except FileNotFoundError:
+            metadata = {'features': booster.feature_names}
+
+    if not metadata.get('features'):
+        raise ValueError(f"Model '{model_file}' has no feature names, save it with model_io.save_model")
+    if booster.feature_names and list(booster.feature_names) != list(metadata['features']):
+        raise ValueError(f"Model '{model_file}' and its metadata disagree on the features: "
+                         f"{booster.feature_names} vs {metadata['features']}")
+    if features is not None and list(features) != list(metadata['features']):
+        raise ValueError(f"Model '{model_file}' was trained on {metadata['features']}, expected {list(features)}")
+
+    model = Model(booster, metadata)
+    if nthread:
+        model.set_threads(nthread)
+    return model
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Inspect or convert saved open year models.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    convert_parser = subparsers.add_parser("convert", help="convert a pickled model to the native format")
+    convert_parser.add_argument("pickle_file")
+    convert_parser.add_argument("--format", default=MODEL_FORMAT, choices=MODEL_FORMATS)
+    info_parser = subparsers.add_parser("info", help="show the metadata of a model")
+    info_parser.add_argument("model_file", nargs="?", default=None)
+    args = parser.parse_args()
+
+    if args.command == "convert":
+        booster, metadata = _load_legacy(args.pickle_file)
+        name = os.path.splitext(os.path.basename(args.pickle_file))[0]
+        path = save_model(booster, metadata['features'], name=name, fmt=args.format,
+                          models_path=os.path.dirname(args.pickle_file) or '.',
+                          params={'converted_from': os.path.basename(args.pickle_file)})
+        print(f"Saved '{path}' and '{metadata_path(path)}'.")
+    else:
+        model = load_model(args.model_file)
+        print(json.dumps(model.metadata, indent=2))
+
+
+if __name__ == "__main__":
+    main()
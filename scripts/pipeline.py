@@ -0,0 +1,264 @@
+#One entry point for the whole pipeline
+#The pipeline is a handful of scripts that used to be run by hand in a fixed order. This script declares them as a
+#DAG of stages, each with the files it reads and writes, and runs them like make does:
+#  - a stage runs only when one of its outputs is missing or older than one of its inputs (or its own script),
+#  - stages whose dependencies are done run at the same time (--jobs), each one as its own Python process,
+#  - a failed stage stops everything downstream of it, but not the independent stages. A stage that cannot run
+#    (e.g. no raw data) stops nothing: the stages after it go by whether their own inputs exist.
+#Every stage script imports geopandas, xgboost etc. in its own process, this script only imports the standard
+#library and the path helpers of storage.py and model_io.py, so --help, status and no-op runs return at once.
+#
+#The stations and POI layers are made in notebooks/eda.ipynb; the pipeline uses them as given inputs.
+#
+#Usage (from the project root):
+#    python scripts/pipeline.py list
+#    python scripts/pipeline.py status
+#    python scripts/pipeline.py run                      # everything that is out of date
+#    python scripts/pipeline.py run predict --jobs 2     # predict and the stages it depends on
+#    python scripts/pipeline.py run predict --force --args predict="--no-explanations"
+import argparse
+import glob
+import os
+import shlex
+import subprocess
+import sys
+import time
+from collections import namedtuple
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import model_io
+import storage
+
+SCRIPTS_DIR = os.path.dirname(os.path.abspath(__file__))
+
+#Stages run at the same time; most stages use every core themselves, so this mostly overlaps I/O bound stages
+PIPELINE_JOBS = int(os.getenv("EV_PIPELINE_JOBS", 2))
+
+#inputs and outputs are paths relative to the project root, inputs may be glob patterns
+Stage = namedtuple('Stage', ['name', 'script', 'depends', 'inputs', 'outputs', 'description'])
+
+
+def _layer(name):
+    #A layer counts in whatever format it exists in, new layers are written in storage.DATA_FORMAT
+    try:
+        return storage.find_layer(name)[0]
+    except FileNotFoundError:
+        return storage.layer_path(name)
+
+
+def pipeline_stages():
+    """
+    The stages of the pipeline in dependency order. The paths are resolved when this is called, so a layer that
+    was written in another format since the last call is found.
+    """
+    osm_layers = ['osm_charging_stations', 'amenities', 'roads', 'leisure', 'shops', 'residential']
+    feature_layers = [_layer('stations'), _layer('roads'), _layer('pois')]
+    ranked = _layer('ranked_locations')
+    return [
+        Stage('clean_layers', 'preprocessJSON.py', [],
+              #The raw OSM exports of preprocessJSON.LAYER_SPECS
+              [os.path.join(storage.RAW_DATA_PATH, '*Washington.geojson')],
+              [_layer(name) for name in osm_layers],
+              "clean the raw OSM layers"),
+        Stage('ingest_history', 'preprocess_data.py', [],
+              [os.path.join(storage.RAW_DATA_PATH, 'alt_fuel_stations_historical_day*.csv')],
+              #Written last, after the afdc_history dataset
+              [storage.table_path('station_history')],
+              "ingest the AFDC history CSVs and build the as-of station history"),
+        Stage('train', 'forecast_demand.py', ['clean_layers'],
+              feature_layers,
+              [model_io.model_path()],
+              "train the open year model"),
+        Stage('forecast_openings', 'forecast_openings.py', [],
+              [_layer('stations')],
+              [storage.table_path('openings_forecast')],
+              "forecast the monthly station openings per region"),
+        Stage('predict', 'predict_demand.py', ['train'],
+              feature_layers + [model_io.model_path()],
+              [storage.table_path('grid_features'), ranked],
+              "score the grid and rank the charging desert cells"),
+        Stage('top_locations', 'geospatial_analysis.py', ['predict'],
+              [ranked],
+              [_layer('top_locations')],
+              "extract the top locations for the dashboard"),
+        Stage('dashboard_data', 'build_dashboard_data.py', ['predict'],
+              [ranked],
+              [os.path.join(storage.PROCESSED_DATA_PATH, 'dashboard_points.npy')],
+              "build the memory-mapped dashboard point file"),
+    ]
+
+
+def plan(stages, targets):
+    """
+    The stages needed for targets (all stages when there are none): the targets plus everything they depend on,
+    in dependency order.
+    """
+    by_name = {stage.name: stage for stage in stages}
+    unknown = [name for name in targets if name not in by_name]
+    if unknown:
+        raise ValueError(f"Unknown stage(s) {', '.join(unknown)}, expected some of {', '.join(by_name)}")
+    needed = set()
+    pending = list(targets or by_name)
+    while pending:
+        name = pending.pop()
+        if name not in needed:
+            needed.add(name)
+            pending.extend(by_name[name].depends)
+    return [stage for stage in stages if stage.name in needed]
+
+
+def _mtime(path):
+    try:
+        return os.path.getmtime(path)
+    except OSError:
+        return None
+
+
+def stage_status(stage):
+    """
+    (status, reason) of a stage: 'up to date', 'stale' or 'blocked' (outputs missing and inputs missing too).
+    A stage whose outputs exist but whose inputs are missing is up to date, with the missing inputs as the reason.
+    """
+    inputs, missing_inputs = [os.path.join(SCRIPTS_DIR, stage.script)], []
+    for pattern in stage.inputs:
+        matches = glob.glob(pattern) if glob.has_magic(pattern) else [pattern] if os.path.exists(pattern) else []
+        inputs.extend(matches)
+        if not matches:
+            missing_inputs.append(pattern)
+    output_times = {path: _mtime(path) for path in stage.outputs}
+    missing_outputs = [path for path, mtime in output_times.items() if mtime is None]
+    if missing_outputs and missing_inputs:
+        return 'blocked', f"missing inputs {', '.join(missing_inputs)}"
+    if missing_outputs:
+        return 'stale', f"missing {', '.join(missing_outputs)}"
+    #Without its inputs a stage cannot be rerun anyway, its existing outputs are used as they are
+    if missing_inputs:
+        return 'up to date', f"missing inputs {', '.join(missing_inputs)}, the existing outputs are used"
+    oldest = min(output_times, key=output_times.get)
+    newest = max(inputs, key=_mtime)
+    if _mtime(newest) > output_times[oldest]:
+        return 'stale', f"'{newest}' is newer than '{oldest}'"
+    return 'up to date', None
+
+
+def run_stage(stage, args=()):
+    """
+    Runs the script of a stage in its own Python process, with every line of its output prefixed by the stage name.
+    Returns (exit code, seconds).
+    """
+    command = [sys.executable, '-u', os.path.join(SCRIPTS_DIR, stage.script), *args]
+    start = time.perf_counter()
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True, bufsize=1)
+    for line in process.stdout:
+        print(f"[{stage.name}] {line.rstrip()}", flush=True)
+    return process.wait(), time.perf_counter() - start
+
+
+def run_pipeline(stages, jobs=PIPELINE_JOBS, force=False, stage_args=None):
+    """
+    Runs the stages that are out of date (all of them with force), each one as soon as its dependencies are done.
+    Returns {stage name: (result, seconds)}, result being 'ok', 'skipped', 'failed', 'blocked' (inputs missing)
+    or 'cancelled' (a dependency failed).
+    """
+    stage_args = stage_args or {}
+    names = {stage.name for stage in stages}
+    results = {}
+    pending = list(stages)
+    running = {}
+    with ThreadPoolExecutor(max_workers=max(jobs, 1)) as executor:
+        while pending or running:
+            for stage in list(pending):
+                depends = [name for name in stage.depends if name in names]
+                if any(name not in results for name in depends):
+                    continue
+                pending.remove(stage)
+                failed = [name for name in depends if results[name][0] in ('failed', 'cancelled')]
+                status, reason = stage_status(stage)
+                if failed:
+                    results[stage.name] = ('cancelled', 0.0)
+                    print(f"[{stage.name}] not run, {', '.join(failed)} did not finish")
+                elif status == 'blocked':
+                    results[stage.name] = ('blocked', 0.0)
+                    print(f"[{stage.name}] cannot run, {reason}")
+                elif status == 'up to date' and (not force or reason):
+                    #Not even --force reruns a stage whose inputs are missing
+                    results[stage.name] = ('skipped', 0.0)
+                    print(f"[{stage.name}] up to date" + (f", {reason}" if reason else ""))
+                else:
+                    print(f"[{stage.name}] running {stage.script} ({reason or 'forced'})")
+                    running[executor.submit(run_stage, stage, stage_args.get(stage.name, ()))] = (stage, time.time())
+            if not running:
+                continue
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                stage, started = running.pop(future)
+                returncode, seconds = future.result()
+                #The scripts report most errors and exit normally, so a stage only succeeded if it wrote all its outputs
+                stale = [path for path in stage.outputs if (_mtime(path) or 0) < started - 1]
+                if returncode != 0 or stale:
+                    results[stage.name] = ('failed', seconds)
+                    print(f"[{stage.name}] failed after {seconds:.1f} s"
+                          + (f" (exit code {returncode})" if returncode else f", did not write {', '.join(stale)}"))
+                else:
+                    results[stage.name] = ('ok', seconds)
+                    print(f"[{stage.name}] done in {seconds:.1f} s")
+    return results
+
+
+def parse_stage_args(values, stages):
+    """
+    {stage name: [arguments]} from --args values of the form STAGE="ARGS".
+    """
+    stage_args = {}
+    for value in values or []:
+        name, separator, args = value.partition('=')
+        if not separator or name not in {stage.name for stage in stages}:
+            raise ValueError(f"Expected --args STAGE=\"ARGS\" with a known stage, got '{value}'")
+        stage_args[name] = shlex.split(args)
+    return stage_args
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the stages of the pipeline that are out of date, in dependency order.")
+    parser.add_argument("command", choices=["run", "status", "list"])
+    parser.add_argument("stages", nargs="*", help="stages to run or check, with the stages they depend on (default: all)")
+    parser.add_argument("--jobs", type=int, default=PIPELINE_JOBS, help="stages run at the same time")
+    parser.add_argument("--force", action="store_true", help="also run the stages that are up to date")
+    parser.add_argument("--args", action="append", metavar='STAGE="ARGS"', help="extra arguments for the script of a stage")
+    parser.add_argument("--root", default=".", help="project root the paths are relative to (default: current directory)")
+    args = parser.parse_args()
+
+    os.chdir(args.root)
+    stages = pipeline_stages()
+    try:
+        planned = plan(stages, args.stages)
+        stage_args = parse_stage_args(args.args, stages)
+    except ValueError as e:
+        parser.error(str(e))
+
+    if args.command == "list":
+        for stage in planned:
+            depends = f" (after {', '.join(stage.depends)})" if stage.depends else ""
+            print(f"{stage.name:<18}{stage.script:<26}{stage.description}{depends}")
+        return
+    if args.command == "status":
+        for stage in planned:
+            status, reason = stage_status(stage)
+            print(f"{stage.name:<18}{status:<12}{reason or ''}")
+        return
+
+    start = time.perf_counter()
+    results = run_pipeline(planned, args.jobs, args.force, stage_args)
+    print(f"\n{'stage':<18}{'result':<10}{'seconds':>9}")
+    for stage in planned:
+        result, seconds = results[stage.name]
+        print(f"{stage.name:<18}{result:<10}{seconds:>9.1f}")
+    print(f"Pipeline finished in {time.perf_counter() - start:.1f} s.")
+    #A blocked stage is only an error when it was asked for, without raw data the earlier stages are always blocked
+    if any(result in ('failed', 'cancelled') or (result == 'blocked' and name in args.stages)
+           for name, (result, _) in results.items()):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
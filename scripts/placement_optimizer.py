@@ -0,0 +1,218 @@
+#Greedy multi-site placement plan
+#The ranking scores every cell on its own, so two top cells 1 km apart both look great even though opening one
+#takes most of the value of the other. This script picks K new stations one at a time instead: after every pick
+#the distance to the nearest station is updated for the cells around the new station (the same affected_cells
+#search over the blocks of the grid feature table incremental_update.py uses), and the next pick is made on the
+#updated scores.
+#
+#Scores are evaluated lazily, like CELF ("cost effective lazy forward" greedy) does: the candidates sit in a priority
+#queue with the score they had when they were last evaluated, and a candidate is only re-predicted when it comes out
+#on top of the queue with a score that is out of date. Most of the grid is never re-evaluated at all.
+#CELF is exact when a pick can only lower the scores of the other cells, which is not the case here: a pick lowers
+#the distance of nearby cells, but the open year model is not monotonic in dist_to_nearest_station_m, so a lower
+#distance can raise a cell's score, and an out of date cell deep in the queue can end up better than the pick.
+#The lazy plan is therefore a heuristic. --exact re-predicts every out of date cell before a pick is accepted,
+#which gives the plain greedy plan (on a statewide 1 km grid: the same 150 picks, with 8x the predictions).
+#
+#Works on the grid feature table written by predict_demand.py:
+#    python scripts/placement_optimizer.py --k 200
+import argparse
+import heapq
+import time
+
+import geopandas as gpd
+import numpy as np
+
+import grid
+import storage
+import top_k
+from features import TARGET_CRS
+from incremental_update import affected_cells, read_grid_table
+from instrumentation import fail, instrumented_run, stage
+from predict_demand import CHARGING_DESERT_M, MODEL_FILE, OUTPUT_PATH, load_model, suitability_score
+
+#Layer the plan is written to (in the dashboard's format)
+PLAN_LAYER = "placement_plan"
+
+#Out of date candidates that are re-predicted together when they reach the top of the queue. Predicting one row
+#at a time is dominated by call overhead, and the candidates right behind the top are the next ones to check anyway.
+LAZY_BATCH = 128
+
+
+class PlacementOptimizer:
+    """
+    Lazy greedy placement over the grid feature table (in block order, with its grid.DistanceBlocks).
+    pick(k) returns the plan as a list of dicts, in pick order.
+    """
+
+    def __init__(self, table, model, blocks, desert_m=CHARGING_DESERT_M, poi_column='poi_density_1.5m', exact=False):
+        self.model = model
+        self.desert_m = desert_m
+        self.cell_ids = table['cell_id'].to_numpy()
+        self.xy = table[['x', 'y']].to_numpy(dtype=float)
+        #The model features in training order, as one float32 array that is updated in place
+        self.X = table[model.features].to_numpy(dtype=np.float32)
+        self.dist_column = model.features.index('dist_to_nearest_station_m')
+        self.dist = table['dist_to_nearest_station_m'].to_numpy(dtype=float).copy()
+        self.nearest_xy = table[['nearest_station_x', 'nearest_station_y']].to_numpy(dtype=float).copy()
+        self.predicted = table['predicted_open_year'].to_numpy(dtype=float).copy()
+        self.poi_density = table[poi_column].to_numpy(dtype=float)
+        self.standalone = self.scores(np.arange(len(table)))
+        #The score of every cell when it was last evaluated, and whether every out of date cell is re-predicted
+        #before a pick is accepted
+        self.current = self.standalone.copy()
+        self.exact = exact
+        #A new station only searches the blocks around it; the bounds are updated as stations are opened
+        self.blocks = blocks
+        self.stale = np.zeros(len(table), dtype=bool)
+        self.picked = np.zeros(len(table), dtype=bool)
+        self.evaluations = 0
+
+    def scores(self, positions):
+        #Suitability of the cells with their current distance and prediction, 0 if they are no charging desert
+        dist = self.dist[positions]
+        score = suitability_score(dist, self.predicted[positions], self.poi_density[positions])
+        return np.where(dist > self.desert_m, score, 0.0)
+
+    def reevaluate(self, positions):
+        """
+        Re-predicts the open year of cells whose distance changed and returns their new scores.
+        """
+        positions = np.asarray(positions, dtype=np.intp)
+        self.X[positions, self.dist_column] = self.dist[positions]
+        self.predicted[positions] = self.model.predict(self.X[positions])
+        self.stale[positions] = False
+        self.evaluations += len(positions)
+        self.current[positions] = self.scores(positions)
+        return self.current[positions]
+
+    def open_station(self, position):
+        """
+        Adds a station at the center of a cell and updates the distance of the cells it is now the nearest station of.
+        Returns the positions of those cells.
+        """
+        station = self.xy[position][None, :]
+        affected = affected_cells(self.xy, self.dist, self.nearest_xy, station, np.empty((0, 2)), self.blocks)
+        self.dist[affected] = np.hypot(*(self.xy[affected] - station).T)
+        self.blocks.update(affected, self.dist)
+        self.nearest_xy[affected] = station
+        self.stale[affected] = True
+        return affected
+
+    def pick(self, k):
+        """
+        Picks up to k cells greedily. Every plan entry has the cell, its score when it was picked (the marginal
+        gain given the stations picked before it) and its score on its own (the independent ranking score).
+        Lazily unless exact is set, see the top of this file.
+        """
+        candidates = np.flatnonzero(self.standalone > 0)
+        queue = list(zip(-self.standalone[candidates], candidates.tolist()))
+        heapq.heapify(queue)
+        plan = []
+        while queue and len(plan) < k:
+            neg_score, position = heapq.heappop(queue)
+            #An exact pick leaves older entries of the cells it re-predicted in the queue
+            if self.picked[position] or self.dist[position] <= self.desert_m or -neg_score != self.current[position]:
+                continue
+            if not self.stale[position] and self.exact and self.stale.any():
+                heapq.heappush(queue, (neg_score, position))
+                stale = np.flatnonzero(self.stale)
+                for position, score in zip(stale.tolist(), self.reevaluate(stale)):
+                    if score > 0:
+                        heapq.heappush(queue, (-score, position))
+                continue
+            if not self.stale[position]:
+                plan.append(self._plan_entry(position, -neg_score, len(plan) + 1))
+                self.picked[position] = True
+                self.open_station(position)
+                continue
+            #Out of date: re-predict it (with the next few out of date candidates) and put them back in the queue
+            batch = [position]
+            while queue and len(batch) < LAZY_BATCH and self.stale[queue[0][1]]:
+                batch.append(heapq.heappop(queue)[1])
+            for position, score in zip(batch, self.reevaluate(batch)):
+                if score > 0:
+                    heapq.heappush(queue, (-score, position))
+        return plan
+
+    def _plan_entry(self, position, score, rank):
+        return {
+            'rank': rank,
+            'cell_id': int(self.cell_ids[position]),
+            'marginal_score': float(score),
+            'standalone_score': float(self.standalone[position]),
+            'dist_to_nearest_station_m': float(self.dist[position]),
+            'predicted_open_year': float(self.predicted[position]),
+        }
+
+    def remaining_deserts(self):
+        return int(np.count_nonzero(self.dist > self.desert_m))
+
+
+def plan_to_gdf(plan, spec):
+    """
+    The plan as a GeoDataFrame of cell polygons, with the running total of the marginal scores.
+    """
+    gdf = gpd.GeoDataFrame(plan, columns=['rank', 'cell_id', 'marginal_score', 'standalone_score',
+                                          'dist_to_nearest_station_m', 'predicted_open_year'])
+    gdf['cumulative_score'] = gdf['marginal_score'].cumsum()
+    #Kept under the name the dashboard colors the locations by
+    gdf['suitability_score'] = gdf['marginal_score']
+    ids = gdf['cell_id'].to_numpy(dtype=np.int64)
+    return gdf.set_geometry(grid.cell_boxes(spec, ids), crs=TARGET_CRS)
+
+
+@instrumented_run('placement_optimizer')
+def main():
+    parser = argparse.ArgumentParser(description="Plan K new stations greedily, accounting for the ones picked before.")
+    parser.add_argument("--k", type=int, default=top_k.TOP_K, help="number of stations to place")
+    parser.add_argument("--desert-m", type=float, default=CHARGING_DESERT_M,
+                        help="cells closer than this to a station are no candidates")
+    parser.add_argument("--exact", action="store_true",
+                        help="re-predict every out of date cell before a pick (exact greedy, slower than the lazy default)")
+    parser.add_argument("--as-top-locations", action="store_true",
+                        help="also write the plan as the top locations layer the dashboard shows")
+    args = parser.parse_args()
+
+    print("Starting placement optimization...")
+    try:
+        with stage('load_grid_features') as s:
+            table, _, spec, blocks = read_grid_table(OUTPUT_PATH)
+            model = load_model(MODEL_FILE)
+            s.rows = len(table)
+    except FileNotFoundError as e:
+        print(f"ERROR: {e}. Run predict_demand.py first to create the grid feature table.")
+        fail(str(e))
+        return
+    except ValueError as e:
+        #e.g. a model trained with the drive distance, which is not updated after a pick
+        print(f"ERROR: {e}.")
+        fail(str(e))
+        return
+
+    start = time.perf_counter()
+    with stage('pick', rows=args.k) as s:
+        optimizer = PlacementOptimizer(table, model, blocks, desert_m=args.desert_m, exact=args.exact)
+        n_deserts = optimizer.remaining_deserts()
+        plan = optimizer.pick(args.k)
+        s.info['evaluations'] = optimizer.evaluations
+    print(f"Picked {len(plan)} sites out of {n_deserts} charging desert cells in {time.perf_counter() - start:.2f} s "
+          f"({optimizer.evaluations} re-predicted cells).")
+    print(f"Charging desert cells left after the plan: {optimizer.remaining_deserts()}.")
+
+    plan_gdf = plan_to_gdf(plan, spec)
+    if len(plan_gdf):
+        independent = optimizer.standalone[top_k.top_k_indices(optimizer.standalone, len(plan_gdf))].sum()
+        print(f"Total marginal score of the plan: {plan_gdf['marginal_score'].sum():.1f} "
+              f"(the independent top {len(plan_gdf)} add up to {independent:.1f} on their own).")
+        print(plan_gdf[['rank', 'cell_id', 'marginal_score', 'standalone_score']].head().to_string(index=False))
+
+    with stage('write_plan', rows=len(plan_gdf)):
+        path = storage.write_layer(plan_gdf, PLAN_LAYER, top_k.TOP_LOCATIONS_FORMAT, OUTPUT_PATH)
+        if args.as_top_locations:
+            storage.write_layer(plan_gdf, 'top_locations', top_k.TOP_LOCATIONS_FORMAT, OUTPUT_PATH)
+    print(f"Placement plan saved to '{path}'.")
+
+
+if __name__ == "__main__":
+    main()
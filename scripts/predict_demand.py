@@ -1,172 +1,352 @@
 #File that will rank and look for optimal locations based on the open year XGboost model
+import argparse
 import os
 import pandas as pd
 import geopandas as gpd
-from shapely.geometry import Polygon
 import numpy as np
-from tqdm import tqdm
-import joblib
+import features
+import grid
+import model_io
+import projection
+import storage
+import top_k
+from instrumentation import fail, instrumented_run, stage
+from features import (DRIVE_FEATURE, FEATURES, MAJOR_ROAD_TYPES, POI_DENSITY_RADII, TARGET_CRS, FeatureIndex, point_coords,
+                      select_major_roads)
+from stage_cache import StageCache
 
 #This section sets up the key variables for our script
 #By defining file paths and parameters at the top, we make it easy to adjust settings without digging through the code.
-PROCESSED_DATA_PATH = "data/processed/"
-MODELS_PATH = "models/"
-OUTPUT_PATH = "data/processed/"
+#File names and the file format of the layers are configured in storage.py
+PROCESSED_DATA_PATH = storage.PROCESSED_DATA_PATH
+#The model saved by forecast_demand.py (native XGBoost format, or an older pickle), see model_io.py
+MODELS_PATH = model_io.MODELS_PATH
+MODEL_FILE = model_io.find_model_file(models_path=MODELS_PATH)
+OUTPUT_PATH = storage.PROCESSED_DATA_PATH
+#A backtest (--as-of) writes its outputs to a directory of its own under this one, never over the production outputs
+BACKTEST_PATH = os.path.join(OUTPUT_PATH, "backtests")
 
 #defining a grid size we use for our analysis
 #1000 meters (1 km) is a reasonable choice for urban planning
 GRID_SIZE = 1000  # in meters
 
-#firstly we define the CRS we will use for our geospatial data
-TARGET_CRS = "EPSG:32148" #Washington/North
+#The CRS we use for our geospatial data (EPSG:32148, Washington/North) is defined in features.py
 
-def create_prediction_grid(gdf):
+#How the road, station and POI features of the grid are computed: "vector" (spatial index queries per cell, see
+#features.py) or "raster" (distance transforms and convolutions, see raster_features.py), also set with --feature-backend
+FEATURE_BACKEND = os.getenv("EV_FEATURE_BACKEND", "vector")
+
+#If a cell is more than 2 miles (3218 meters) from the nearest station, we consider it a "charging desert"
+CHARGING_DESERT_M = 3218
+
+def create_prediction_grid(gdf, grid_size=GRID_SIZE):
     """
     This is a helper function that creates a square grid of polygons.
     It takes a gdf and uses its boundaries to determine the extennt of the grid
     ensuring our areas of interest are fully covered.
-    
+    All cells are built at once with shapely.box, and each cell keeps a stable 'cell_id' (also used as the index).
     """
-    #find the bounds of our data
-    xmin, ymin, xmax, ymax = gdf.total_bounds
-
-    #Create a series of points along the x and y axes at intervals defined by GRID_SIZE
-    cols = list(np.arange(xmin, xmax + GRID_SIZE, GRID_SIZE))
-    rows = list(np.arange(ymin, ymax + GRID_SIZE, GRID_SIZE))
-
-    #Now we create a square polygon for each cell in the grid
-    polygons = []
-    for x in cols[:-1]:
-        for y in rows[:-1]:
-            # A polygon is defined by the coordinates of its four corners.
-            polygons.append(Polygon([(x, y), (x + GRID_SIZE, y), (x + GRID_SIZE, y + GRID_SIZE), (x, y + GRID_SIZE)]))
+    spec = grid.grid_spec(gdf.total_bounds, grid_size)
+    ids = grid.all_cell_ids(spec)
     #Finally we return a GeoDataFrame containing all the grid cells
-    return gpd.GeoDataFrame({'geometry': polygons}, crs=TARGET_CRS)
+    return gpd.GeoDataFrame({'cell_id': ids}, geometry=grid.cell_boxes(spec, ids), crs=TARGET_CRS, index=ids)
+
+def suitability_score(dist_to_nearest_station_m, predicted_open_year, poi_density, poi_weight=1.0):
+    """
+    A great spot is one that is far from other stations and has high demand (low predicted open year),
+    with a bonus for having more pois. poi_weight scales that bonus (0 ranks by distance and demand only).
+    Works on Series and NumPy arrays alike.
+    """
+    return (dist_to_nearest_station_m / predicted_open_year) * (1 + poi_weight * np.log1p(poi_density))
+
+def load_layers():
+    """
+    Loads the existing stations, roads and POIs, with every layer reprojected to TARGET_CRS.
+    Raises FileNotFoundError when one of the inputs is missing.
+    """
+    #Load the processed data
+    print("Loading processed data...")
+    #Only the columns we actually use are read, which skips most of the parsing for GeoParquet layers.
+    #Every layer comes reprojected to TARGET_CRS for accurate spatial calculations; the reprojected layers are
+    #cached on disk (see projection.py), so only a changed input is ever reprojected again.
+    #We need ecisting stations to calc distances to the nearest rival
+    gdf_stations = projection.read_projected_layer('stations', TARGET_CRS, columns=['geometry'], base_path=PROCESSED_DATA_PATH)
+    #We need roads and POIs to calc features for our grid cells
+    gdf_roads = projection.read_projected_layer('roads', TARGET_CRS, columns=['geometry', 'highway'], base_path=PROCESSED_DATA_PATH)
+    #Concacenated POI data
+    gdf_pois = projection.read_projected_layer('pois', TARGET_CRS, columns=['geometry'], base_path=PROCESSED_DATA_PATH)
+    print("Successfully loaded all datasets.")
+    return gdf_stations, gdf_roads, gdf_pois
+
+def load_model(model_file=MODEL_FILE, nthread=model_io.PREDICT_THREADS, drive_distance=False):
+    """
+    Loads the model saved from forecast_demand.py and checks it was trained on our FEATURES, in our order
+    With drive_distance, a model that also uses the road network drive distance (DRIVE_FEATURE) is accepted,
+    for callers that can compute it (see road_graph.py).
+    """
+    if not drive_distance:
+        return model_io.load_model(model_file, nthread=nthread, features=FEATURES)
+    model = model_io.load_model(model_file, nthread=nthread)
+    if list(model.features) not in (FEATURES, FEATURES + [DRIVE_FEATURE]):
+        raise ValueError(f"Model '{model_file}' was trained on {model.features}, expected {FEATURES} "
+                         f"(optionally followed by '{DRIVE_FEATURE}')")
+    return model
+
+#The stages below each compute one piece of the grid, so every piece can be cached on its own.
+#They take the grid cells and return one value (or one column) per cell, computed at the cell center point.
+
+def vector_feature_stage(grid_gdf, gdf_roads, gdf_stations, gdf_pois, road_types=MAJOR_ROAD_TYPES, density_radii=POI_DENSITY_RADII):
+    #The same FeatureIndex queries that compute the training features (and tiled_scoring.py, adaptive_grid.py, ...).
+    #Also returns where the nearest station is, so incremental_update.py knows which cells a removed station affects
+    feature_index = FeatureIndex(select_major_roads(gdf_roads, road_types), gdf_stations, gdf_pois)
+    xy = point_coords(grid_gdf.geometry)
+    grid_features = feature_index.compute(xy, density_radii=density_radii, index=grid_gdf.index)
+    return grid_features, feature_index.nearest_station_xy(xy)
+
+def drive_distance_stage(grid_gdf, gdf_stations, gdf_roads, roads_file):
+    #Imported here so the road graph code is only loaded for models that use the drive distance
+    import road_graph
+
+    graph = road_graph.load_road_graph(gdf_roads, roads_file=roads_file)
+    drive = road_graph.DriveDistance(graph, point_coords(gdf_stations.geometry))
+    return drive.query(point_coords(grid_gdf.geometry))
+
+def prediction_stage(grid_features, model_file=MODEL_FILE):
+    #The model picks its features in training order and predicts from one float32 array
+    return load_model(model_file, drive_distance=True).predict(grid_features)
+
+def ranking_stage(grid_gdf, desert_m=CHARGING_DESERT_M):
+    # First, we filter out any grid cells that are already close to an existing station.
+    charging_deserts_gdf = grid_gdf[grid_gdf['dist_to_nearest_station_m'] > desert_m].copy()
+
+    #Now we createa final 'sustainability score' that ranks remaining locations
+    charging_deserts_gdf['suitability_score'] = suitability_score(
+        charging_deserts_gdf['dist_to_nearest_station_m'],
+        charging_deserts_gdf['predicted_open_year'],
+        charging_deserts_gdf['poi_density_1.5m'],
+    )
+
+    #The cells are not sorted here: the top locations are picked with top_k.select_top and the full ranked
+    #layer is sorted while it is written (top_k.write_ranked_stream), only if it is written at all
+    return charging_deserts_gdf
 
+def save_grid_features(grid_gdf, nearest_station_xy, spec):
+    """
+    Persists the features and predictions of every grid cell, with the location of its nearest station,
+    as the 'grid_features' table. The rows are in block order, and the grid spec and the grid.DistanceBlocks
+    incremental_update.py searches are stored in the table metadata.
+    """
+    xy = point_coords(grid_gdf.geometry)
+    table = pd.DataFrame({'cell_id': grid_gdf['cell_id'].to_numpy(), 'x': xy[:, 0], 'y': xy[:, 1]})
+    columns = FEATURES + [c for c in POI_DENSITY_RADII if c not in FEATURES] + ['predicted_open_year']
+    if DRIVE_FEATURE in grid_gdf.columns:
+        columns.append(DRIVE_FEATURE)
+    for column in columns:
+        table[column] = grid_gdf[column].to_numpy()
+    table['nearest_station_x'] = nearest_station_xy[:, 0]
+    table['nearest_station_y'] = nearest_station_xy[:, 1]
+    table = table.iloc[grid.DistanceBlocks.order(spec, table['cell_id'].to_numpy())].reset_index(drop=True)
+    blocks = grid.DistanceBlocks.from_cells(spec, table['cell_id'].to_numpy(), table['dist_to_nearest_station_m'].to_numpy())
+    metadata = {'grid': spec._asdict(), 'crs': TARGET_CRS, 'blocks': blocks.to_metadata()}
+    return storage.write_table(table, 'grid_features', metadata=metadata, base_path=OUTPUT_PATH)
+
+@instrumented_run('predict_demand')
 def main():
     """
     this is the main function that orchestrates the prediction process
+    Every stage is cached on disk (see stage_cache.py), keyed on its inputs, parameters and code,
+    so a rerun only recomputes the stages whose inputs changed. Use --no-cache to recompute everything.
+    Timings and memory of every stage end up in the run report (see instrumentation.py).
     """
+    parser = argparse.ArgumentParser(description="Predict demand and rank charging station locations on a grid.")
+    parser.add_argument("--no-cache", action="store_true", help="recompute every stage instead of using cached results")
+    parser.add_argument("--top", type=int, default=top_k.TOP_K, help="number of top locations written for the dashboard")
+    parser.add_argument("--min-separation", type=float, default=top_k.MIN_SEPARATION_M,
+                        help="minimum distance in meters between two top locations (0 = none)")
+    parser.add_argument("--no-ranked-export", action="store_true",
+                        help="only write the top locations, not the full ranked layer")
+    parser.add_argument("--feature-backend", choices=["vector", "raster"], default=FEATURE_BACKEND,
+                        help="compute the grid features with spatial index queries or on a raster (see raster_features.py)")
+    parser.add_argument("--no-explanations", action="store_true",
+                        help="do not compute the per-cell feature contributions the dashboard shows (see explain.py)")
+    parser.add_argument("--as-of", default=None,
+                        help="rank against the stations that existed on this date (e.g. 2024-01-01) instead of the "
+                             "current station layer, for backtesting (see station_history.py). The outputs are "
+                             "written to data/processed/backtests/as_of_<date>/ and the grid feature table is not written")
+    args = parser.parse_args()
+    cache = StageCache(enabled=not args.no_cache)
+    output_path = OUTPUT_PATH
+    if args.as_of:
+        try:
+            as_of_date = pd.Timestamp(args.as_of).date()
+        except ValueError as e:
+            parser.error(f"--as-of: {e}")
+        output_path = os.path.join(BACKTEST_PATH, f"as_of_{as_of_date}")
+
     print("Starting demand prediction...")
-    #Load the processed data
-    print("Loading processed data...")
     try:
-        #We need ecisting stations to calc distances to the nearest rival
-        gdf_stations = gpd.read_file(os.path.join(PROCESSED_DATA_PATH, "afdc_unique_stations_with_features.geojson"))
-        #We need roads and POIs to calc features for our grid cells
-        gdf_roads = gpd.read_file(os.path.join(PROCESSED_DATA_PATH, "majorRoadsWashington_cleaned.geojson"))
-        #Concacenated POI data
-        gdf_pois = gpd.read_file(os.path.join(PROCESSED_DATA_PATH, "all_pois_Washington.geojson"))
-
-        #Use joblib to load the model saved from forecast_demand.py
-        model = joblib.load(os.path.join(MODELS_PATH, "xgb_year_prediction_model.pkl"))
-
-        print("Successfully loaded all datasets.")
-    except FileNotFoundError as e:
+        input_files = [storage.find_layer(name, PROCESSED_DATA_PATH)[0] for name in ('stations', 'roads', 'pois')]
+        if not os.path.exists(MODEL_FILE):
+            raise FileNotFoundError(f"Model file '{MODEL_FILE}' not found")
+        #The features the model was trained on decide whether the drive distance has to be computed
+        model_features = list(load_model(MODEL_FILE, drive_distance=True).features)
+    except (FileNotFoundError, ValueError) as e:
         print(f"ERROR: {e}. Please ensure all required files are present.")
+        fail(str(e))
         return
 
+    with stage('load_layers') as s:
+        (gdf_stations, gdf_roads, gdf_pois), layers_key = cache.run(
+            'reproject', load_layers, files=input_files, params={'crs': TARGET_CRS}, code=[storage, projection]
+        )
+        s.rows = len(gdf_stations) + len(gdf_roads) + len(gdf_pois)
+    if args.as_of:
+        import station_history
 
-    #Ensure all data is in the same CRS for accurate spatial calculations
-    print("Reprojecting datasets to target CRS...")
-    gdf_stations = gdf_stations.to_crs(TARGET_CRS)
-    gdf_roads = gdf_roads.to_crs(TARGET_CRS)
-    gdf_pois = gdf_pois.to_crs(TARGET_CRS)
-    print("Reprojection complete.")
-    #Filter roads to only include major roads as we did in feature engineering
-    major_road_types = ['motorway', 'trunk', 'primary', 'secondary']
-    gdf_major_roads = gdf_roads[gdf_roads['highway'].isin(major_road_types)]
+        #The stations of that date replace the station layer, and their key replaces the layer key in every stage after
+        print(f"Using the stations that existed on {args.as_of} from the station history...")
+        try:
+            with stage('stations_as_of') as s:
+                gdf_stations, layers_key = cache.run(
+                    'stations_as_of', station_history.stations_gdf_as_of, args.as_of, PROCESSED_DATA_PATH, files=[storage.table_path('station_history', PROCESSED_DATA_PATH)],
+                    depends=[layers_key], params={'as_of': args.as_of}, code=[station_history]
+                )
+                s.rows = len(gdf_stations)
+        except FileNotFoundError as e:
+            print(f"ERROR: {e}. Run station_history.py build first.")
+            fail(str(e))
+            return
 
     #Grid of potential locations to analyze the entire state.
     print("Creating prediction grid...")
-    grid_gdf = create_prediction_grid(gdf_roads)
-    #We will use the center point of each grid cell for our calculations
-    # Note: The centroid is not needed for sjoin_nearest, but we keep it in case you need it later.
-    grid_gdf['centroid']= grid_gdf.geometry.centroid
+    with stage('create_prediction_grid') as s:
+        grid_gdf, grid_key = cache.run(
+            'grid', create_prediction_grid, gdf_roads, GRID_SIZE,
+            depends=[layers_key], params={'grid_size': GRID_SIZE}, code=[grid]
+        )
+        s.rows = len(grid_gdf)
     print(f"Created grid with {len(grid_gdf)} potential locations.")
 
     #for every cell in our grid we also need to calculate the same features our model was trained on
+    #The shared features module computes them at the center point of each cell with bulk spatial index queries,
+    #exactly the way forecast_demand.py computes them for the training stations.
+    #POI density is also counted at 0.5 and 3 miles, which costs one extra KD-tree pass each.
     print("Calculating features for each grid cell...")
+    feature_depends = [layers_key, grid_key]
+    if args.feature_backend == 'raster':
+        import raster_features
 
-    # Temporarily set the active geometry to the centroid for more accurate distance calcs.
-    grid_gdf = grid_gdf.set_geometry('centroid')
-
-
-    # OPTIMIZED: Calculate distance to nearest major road using sjoin_nearest.
-    print("  - Calculating distance to nearest major road (optimized)...")
-    # This single command replaces the slow loop. It finds the nearest road for every grid cell
-    # and automatically calculates the distance, adding it to a new column.
-    grid_gdf = gpd.sjoin_nearest(grid_gdf, gdf_major_roads[['geometry']], how="left", distance_col="dist_to_major_road_m")
-    # sjoin_nearest can create duplicates if a grid cell is equidistant to multiple roads.
-    # This line removes those duplicates, keeping the first match for each cell.
-    grid_gdf = grid_gdf.loc[~grid_gdf.index.duplicated(keep='first')]
-    # **FIX:** Drop the temporary 'index_right' column created by the join.
-    grid_gdf = grid_gdf.drop(columns=['index_right'])
-
-
-    # OPTIMIZED: Calculate distance to nearest existing station using sjoin_nearest.
-    print("  - Calculating distance to nearest existing station (optimized)...")
-    # We use the same highly efficient technique to find the nearest existing station.
-    grid_gdf = gpd.sjoin_nearest(grid_gdf, gdf_stations[['geometry']], how="left", distance_col="dist_to_nearest_station_m")
-    # Again, we remove any potential duplicates to ensure our data is clean.
-    grid_gdf = grid_gdf.loc[~grid_gdf.index.duplicated(keep='first')]
-    # **FIX:** And we drop the new 'index_right' column from this join as well.
-    grid_gdf = grid_gdf.drop(columns=['index_right'])
-
-
-    # Switch the active geometry back to the polygons before buffering and saving.
-    grid_gdf = grid_gdf.set_geometry('geometry')
-
-
-    # Calculate how many points of interest (shops, etc.) are within a 1.5-mile radius.
-    print("  - Calculating POI density...")
-    buffer_radius = 2414  # Approximately 1.5 miles in meters
-    buffers = grid_gdf.geometry.buffer(buffer_radius)
-    # A spatial join is a special operation that finds which points fall inside which polygons.
-    joined_pois = gpd.sjoin(gdf_pois, gpd.GeoDataFrame(geometry=buffers), how="inner", predicate="within")
-    # We group by each grid cell and count how many POIs were found inside.
-    poi_counts = joined_pois.groupby(joined_pois.index_right).size()
-    grid_gdf['poi_density_1.5m'] = poi_counts
-    # If a grid cell had no POIs nearby, we fill its value with 0.
-    grid_gdf['poi_density_1.5m'] = grid_gdf['poi_density_1.5m'].fillna(0)
+        #All three features in one pass over a raster aligned with the grid
+        print("  - Calculating road and station distances and POI density on a raster...")
+        with stage('raster_features', rows=len(grid_gdf)):
+            (road_dist, station_dist, nearest_station_xy, poi_counts), road_key = cache.run(
+                'raster_features', raster_features.raster_feature_stage, grid_gdf,
+                grid.grid_spec(gdf_roads.total_bounds, GRID_SIZE), gdf_roads, gdf_stations, gdf_pois, POI_DENSITY_RADII,
+                depends=feature_depends,
+                params={'road_types': MAJOR_ROAD_TYPES, 'radii': POI_DENSITY_RADII,
+                        'supersample': raster_features.SUPERSAMPLE,
+                        'min_radius_pixels': raster_features.MIN_RADIUS_PIXELS},
+                code=[features, raster_features]
+            )
+        station_key = poi_key = road_key
+    else:
+        #All three features from one features.FeatureIndex, like every other script that scores cells
+        print("  - Calculating road and station distances and POI density...")
+        with stage('vector_features', rows=len(grid_gdf)):
+            (vector_features, nearest_station_xy), road_key = cache.run(
+                'vector_features', vector_feature_stage, grid_gdf, gdf_roads, gdf_stations, gdf_pois,
+                MAJOR_ROAD_TYPES, POI_DENSITY_RADII, depends=feature_depends,
+                params={'road_types': MAJOR_ROAD_TYPES, 'radii': POI_DENSITY_RADII}, code=[features]
+            )
+        road_dist = vector_features['dist_to_major_road_m']
+        station_dist = vector_features['dist_to_nearest_station_m']
+        poi_counts = vector_features[list(POI_DENSITY_RADII)]
+        station_key = poi_key = road_key
+    prediction_depends = [road_key, station_key, poi_key]
+    if DRIVE_FEATURE in model_features:
+        import road_graph
 
+        print("  - Calculating drive distance to the nearest station over the road network...")
+        with stage('drive_dist_to_nearest_station', rows=len(grid_gdf)):
+            grid_gdf[DRIVE_FEATURE], drive_key = cache.run(
+                'drive_dist_to_nearest_station', drive_distance_stage, grid_gdf, gdf_stations, gdf_roads, input_files[1],
+                depends=feature_depends, code=[features, road_graph]
+            )
+        prediction_depends.append(drive_key)
+    grid_gdf['dist_to_major_road_m'] = road_dist
+    grid_gdf['dist_to_nearest_station_m'] = station_dist
+    grid_gdf = grid_gdf.join(poi_counts)
     print("Feature engineering complete.")
 
     #Now we use our trained model to predict the open year for each grid cell which is a proxy for demand
-
     print("running model to predict demand for each grid cell...")
-    features = ['dist_to_major_road_m', 'poi_density_1.5m', 'dist_to_nearest_station_m'] #must be in same order as training
-    X_grid = grid_gdf[features]
-    #predicting open year
-    grid_gdf['predicted_open_year'] = model.predict(X_grid)
+    with stage('predict', rows=len(grid_gdf)):
+        grid_gdf['predicted_open_year'], prediction_key = cache.run(
+            'prediction', prediction_stage, grid_gdf[model_features], MODEL_FILE,
+            files=[MODEL_FILE], depends=prediction_depends, code=[model_io]
+        )
     print("Prediction complete.")
 
-    print("Ranking potential locations by identifying charging deserts")
-    # First, we filter out any grid cells that are already close to an existing station.
-    #If a cell is more than 2 miles (3218 meters) from the nearest station, we consider it a "charging desert"
-    charging_deserts_gdf = grid_gdf[grid_gdf['dist_to_nearest_station_m'] > 3218].copy()
+    #The grid feature table lets incremental_update.py rescore only the cells a station change affects. A backtest
+    #does not write it: its distances are to historical stations, not to the ones station changes are applied to.
+    if not args.as_of:
+        with stage('save_grid_features', rows=len(grid_gdf)):
+            save_grid_features(grid_gdf, nearest_station_xy, grid.grid_spec(gdf_roads.total_bounds, GRID_SIZE))
 
-    #Now we createa final 'sustainability score' that ranks remaining locations
-    #A great spot is one that is far from other stations and has high demand (low predicted open year)
-    #We will add a bonus for having more pois
-    charging_deserts_gdf['suitability_score'] = \
-        (charging_deserts_gdf['dist_to_nearest_station_m'] / charging_deserts_gdf['predicted_open_year']) * \
-        (1 + np.log1p(charging_deserts_gdf['poi_density_1.5m']))
-    
-    #Sort locations by their suitability score in descending order
-    ranked_locations_gdf = charging_deserts_gdf.sort_values(by='suitability_score', ascending=False)
+    print("Ranking potential locations by identifying charging deserts")
+    with stage('ranking') as s:
+        ranked_locations_gdf, ranking_key = cache.run(
+            'ranking', ranking_stage, grid_gdf, CHARGING_DESERT_M,
+            depends=[prediction_key, road_key, station_key, poi_key],
+            params={'desert_m': CHARGING_DESERT_M}, code=[suitability_score]
+        )
+        s.rows = len(ranked_locations_gdf)
     print(f"Identified {len(ranked_locations_gdf)} potential locations in charging deserts.")
 
-    #Finally, we save our complete and ranked list to a new file
-    output_file = os.path.join(OUTPUT_PATH, "ranked_optimal_locations.geojson")
-    print(f"Saving ranked locations to {output_file}...")
+    #Why every charging desert cell got its prediction, for the dashboard (see explain.py)
+    if not args.no_explanations:
+        import explain
+
+        print("Explaining the predictions of the charging desert cells...")
+        with stage('explain', rows=len(ranked_locations_gdf)):
+            explanations, _ = cache.run(
+                'explanations', explain.explain_cells, ranked_locations_gdf['cell_id'].to_numpy(),
+                ranked_locations_gdf[model_features], MODEL_FILE,
+                files=[MODEL_FILE], depends=[ranking_key], params={'approx': explain.EXPLAIN_APPROX}, code=[explain, model_io]
+            )
+
+    # We only need to save the columns that will be useful for the next script and the dashboard.
+    columns_to_save = ['geometry', 'cell_id', 'predicted_open_year', 'suitability_score', 'dist_to_nearest_station_m'] + list(POI_DENSITY_RADII)
+    #The top locations for the dashboard are picked straight from the scores, without sorting every cell
+    with stage('select_top_locations') as s:
+        top_locations_gdf = top_k.select_top(
+            ranked_locations_gdf[columns_to_save], args.top, args.min_separation,
+            xy=point_coords(ranked_locations_gdf.geometry) if args.min_separation > 0 else None,
+        )
+        s.rows = len(top_locations_gdf)
+
+    #Finally, we save our complete and ranked list to a new file (a backtest's go to its own directory)
     try:
-        # We only need to save the columns that will be useful for the next script and the dashboard.
-        columns_to_save = ['geometry', 'predicted_open_year', 'suitability_score', 'dist_to_nearest_station_m', 'poi_density_1.5m']
-        ranked_locations_gdf[columns_to_save].to_file(output_file, driver='GeoJSON')
+        top_path = storage.layer_path('top_locations', top_k.TOP_LOCATIONS_FORMAT, output_path)
+        print(f"Saving the top {len(top_locations_gdf)} locations to {top_path}...")
+        with stage('write_top_locations', rows=len(top_locations_gdf)):
+            storage.write_layer(top_locations_gdf, 'top_locations', top_k.TOP_LOCATIONS_FORMAT, output_path)
+        if not args.no_ranked_export:
+            print(f"Saving ranked locations to {storage.layer_path('ranked_locations', base_path=output_path)}...")
+            with stage('write_ranked_locations', rows=len(ranked_locations_gdf)):
+                top_k.write_ranked_stream(ranked_locations_gdf[columns_to_save], 'ranked_locations', base_path=output_path)
+        if not args.no_explanations:
+            with stage('write_explanations', rows=len(explanations)):
+                explanations_path = explain.write_explanations(explanations, MODEL_FILE, output_path)
+            print(f"Saved the explanations of every ranked location to {explanations_path}.")
+        elif os.path.exists(storage.table_path('explanations', output_path)):
+            #Explanations of an earlier model or grid would be shown for the cells of this ranking
+            os.remove(storage.table_path('explanations', output_path))
+            print("Removed the explanations of the previous run, they do not match this ranking.")
         print("Prediction and ranking process complete!")
     except Exception as e:
         print(f"An error occurred while saving the output file: {e}")
+        fail(str(e))
 
 # This ensures the 'main' function runs when you execute the script from your terminal.
 if __name__ == "__main__":
@@ -1,152 +1,98 @@
-import pandas as pd
 import geopandas as gpd
 import os
-
-
-def clean_charging_stations(raw_data_path, processed_data_path):
-    columns_to_keep = [
-        'access', 'amenity', 'brand', 'operator',
-        'capacity', 'fee', 'opening_hours', 'geometry'
-    ]
-
-    input_file = os.path.join(raw_data_path, "chargingStationWashington.geojson")
-    output_file = os.path.join(processed_data_path, "chargingStationWashington_cleaned.geojson")
-
+import time
+from concurrent.futures import ProcessPoolExecutor
+import pyogrio
+import storage
+
+
+# Every OSM layer we clean, described as data instead of code.
+# 'input' is the raw file, 'columns' the columns to keep and 'prefixes' keeps every column starting with one of them.
+# Adding a new OSM layer only takes a new entry here (and its output name in storage.LAYERS).
+LAYER_SPECS = {
+    'osm_charging_stations': {
+        'input': "chargingStationWashington.geojson",
+        'columns': ['access', 'amenity', 'brand', 'operator', 'capacity', 'fee', 'opening_hours'],
+        'prefixes': ['socket:'],
+    },
+    'amenities': {
+        'input': "amenitiesWashington.geojson",
+        'columns': ['amenity', 'access', 'fee', 'capacity', 'building', 'shop', 'leisure'],
+    },
+    'roads': {
+        'input': "majorRoadsWashington.geojson",
+        'columns': ['highway'],
+    },
+    'leisure': {
+        'input': "leisureWashington.geojson",
+        'columns': ['leisure', 'name'],
+    },
+    'shops': {
+        'input': "shopsWashington.geojson",
+        'columns': ['shop', 'name'],
+    },
+    'residential': {
+        'input': "residentialWashington.geojson",
+        'columns': ['building', 'name'],
+    },
+}
+
+
+def columns_to_read(input_file, spec):
+    """
+    Looks at the field names in the file header (without reading any features)
+    and returns the ones the layer spec wants to keep.
+    """
+    fields = pyogrio.read_info(input_file)['fields']
+    prefixes = tuple(spec.get('prefixes', ()))
+    return [field for field in fields if field in spec['columns'] or (prefixes and field.startswith(prefixes))]
+
+
+def clean_layer(name, raw_data_path, processed_data_path):
+    """
+    Cleans one layer: only the wanted columns are parsed from the raw file (the rest is skipped while reading)
+    and the result is written through storage.py. Returns a small report dict for the summary.
+    """
+    spec = LAYER_SPECS[name]
+    input_file = os.path.join(raw_data_path, spec['input'])
+    start = time.perf_counter()
     try:
-        gdf = gpd.read_file(input_file)
-        print(f"Loaded '{os.path.basename(input_file)}': Found {len(gdf)} features.")
-
-        existing_columns = [col for col in gdf.columns if col in columns_to_keep or col.startswith('socket:')]
-        gdf_cleaned = gdf[existing_columns]
-
-        print(f"-> Kept {len(gdf_cleaned.columns)} relevant columns.")
-        gdf_cleaned.to_file(output_file, driver='GeoJSON')
-        print(f"-> Successfully saved cleaned file to '{output_file}'")
-    except FileNotFoundError:
-        print(f"Error: The file was not found at {input_file}")
+        columns = columns_to_read(input_file, spec)
+        gdf_cleaned = gpd.read_file(input_file, columns=columns, engine='pyogrio')
+        output_file = storage.write_layer(gdf_cleaned, name, base_path=processed_data_path)
+        return {'layer': name, 'rows': len(gdf_cleaned), 'columns': len(gdf_cleaned.columns),
+                'seconds': time.perf_counter() - start, 'output': output_file, 'error': None}
+    except (FileNotFoundError, pyogrio.errors.DataSourceError):
+        error = f"The file was not found at {input_file}"
     except Exception as e:
-        print(f"An error occurred: {e}")
+        error = f"An error occurred: {e}"
+    return {'layer': name, 'rows': 0, 'columns': 0, 'seconds': time.perf_counter() - start, 'output': None, 'error': error}
 
 
-def clean_amenities(raw_data_path, processed_data_path):
-    columns_to_keep = [
-        'amenity', 'access', 'fee', 'capacity',
-        'building', 'shop', 'leisure', 'geometry'
-    ]
-
-    input_file = os.path.join(raw_data_path, "amenitiesWashington.geojson")
-    output_file = os.path.join(processed_data_path, "amenitiesWashington_cleaned.geojson")
-
-    try:
-        gdf = gpd.read_file(input_file)
-        print(f"Loaded '{os.path.basename(input_file)}': Found {len(gdf)} total amenities.")
-
-        existing_columns = [col for col in gdf.columns if col in columns_to_keep]
-        gdf_cleaned = gdf[existing_columns]
-
-        print(f"-> Kept {len(gdf_cleaned.columns)} relevant columns.")
-        gdf_cleaned.to_file(output_file, driver='GeoJSON')
-        print(f"-> Successfully saved cleaned amenities file to '{output_file}'")
-    except FileNotFoundError:
-        print(f"Error: The file was not found at {input_file}")
-    except Exception as e:
-        print(f"An error occurred: {e}")
-
-
-def clean_major_roads(raw_data_path, processed_data_path):
-    columns_to_keep = ['highway', 'geometry']
-    input_file = os.path.join(raw_data_path, "majorRoadsWashington.geojson")
-    output_file = os.path.join(processed_data_path, "majorRoadsWashington_cleaned.geojson")
-
-    try:
-        gdf = gpd.read_file(input_file)
-        print(f"Loaded '{os.path.basename(input_file)}': Found {len(gdf)} road segments.")
-
-        existing_columns = [col for col in gdf.columns if col in columns_to_keep]
-        gdf_cleaned = gdf[existing_columns]
-
-        print(f"-> Kept {len(gdf_cleaned.columns)} essential columns.")
-        gdf_cleaned.to_file(output_file, driver='GeoJSON')
-        print(f"-> Successfully saved cleaned roads file to '{output_file}'")
-    except FileNotFoundError:
-        print(f"Error: The file was not found at {input_file}")
-    except Exception as e:
-        print(f"An error occurred: {e}")
-
-
-def clean_leisure(raw_data_path, processed_data_path):
-    columns_to_keep = ['leisure', 'name', 'geometry']
-    input_file = os.path.join(raw_data_path, "leisureWashington.geojson")
-    output_file = os.path.join(processed_data_path, "leisureWashington_cleaned.geojson")
-
-    try:
-        gdf = gpd.read_file(input_file)
-        print(f"Loaded '{os.path.basename(input_file)}': Found {len(gdf)} leisure features.")
-
-        existing_columns = [col for col in gdf.columns if col in columns_to_keep]
-        gdf_cleaned = gdf[existing_columns]
-
-        print(f"-> Kept {len(gdf_cleaned.columns)} essential columns.")
-        gdf_cleaned.to_file(output_file, driver='GeoJSON')
-        print(f"-> Successfully saved cleaned leisure file to '{output_file}'")
-    except FileNotFoundError:
-        print(f"Error: The file was not found at {input_file}")
-    except Exception as e:
-        print(f"An error occurred: {e}")
-
-
-def clean_shops(raw_data_path, processed_data_path):
-    columns_to_keep = ['shop', 'name', 'geometry']
-    input_file = os.path.join(raw_data_path, "shopsWashington.geojson")
-    output_file = os.path.join(processed_data_path, "shopsWashington_cleaned.geojson")
-
-    try:
-        gdf = gpd.read_file(input_file)
-        print(f"Loaded '{os.path.basename(input_file)}': Found {len(gdf)} shop features.")
-
-        existing_columns = [col for col in gdf.columns if col in columns_to_keep]
-        gdf_cleaned = gdf[existing_columns]
-
-        print(f"-> Kept {len(gdf_cleaned.columns)} essential columns.")
-        gdf_cleaned.to_file(output_file, driver='GeoJSON')
-        print(f"-> Successfully saved cleaned shops file to '{output_file}'")
-    except FileNotFoundError:
-        print(f"Error: The file was not found at {input_file}")
-    except Exception as e:
-        print(f"An error occurred: {e}")
-
-
-def clean_residential(raw_data_path, processed_data_path):
-    columns_to_keep = ['building', 'name', 'geometry']
-    input_file = os.path.join(raw_data_path, "residentialWashington.geojson")  # fixed typo
-    output_file = os.path.join(processed_data_path, "residentialWashington_cleaned.geojson")
-
-    try:
-        gdf = gpd.read_file(input_file)
-        print(f"Loaded '{os.path.basename(input_file)}': Found {len(gdf)} building features.")
-
-        existing_columns = [col for col in gdf.columns if col in columns_to_keep]
-        gdf_cleaned = gdf[existing_columns]
-
-        print(f"-> Kept {len(gdf_cleaned.columns)} essential columns.")
-        gdf_cleaned.to_file(output_file, driver='GeoJSON')
-        print(f"-> Successfully saved cleaned residential buildings file to '{output_file}'")
-    except FileNotFoundError:
-        print(f"Error: The file was not found at {input_file}. Please check the filename.")
-    except Exception as e:
-        print(f"An error occurred: {e}")
+def clean_layers(raw_data_path, processed_data_path, layers=None, workers=None):
+    """
+    Cleans all layers (or the given ones) concurrently in a process pool and returns their reports.
+    """
+    layers = list(layers or LAYER_SPECS)
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(clean_layer, name, raw_data_path, processed_data_path) for name in layers]
+        return [future.result() for future in futures]
 
 
 def main():
-    raw_data_path = "EV-Charging-Optimization-Forecasting/data/raw/"
-    processed_data_path = "EV-Charging-Optimization-Forecasting/data/processed/"
-
-    clean_charging_stations(raw_data_path, processed_data_path)
-    clean_amenities(raw_data_path, processed_data_path)
-    clean_major_roads(raw_data_path, processed_data_path)
-    clean_leisure(raw_data_path, processed_data_path)
-    clean_shops(raw_data_path, processed_data_path)
-    clean_residential(raw_data_path, processed_data_path)
+    raw_data_path = storage.RAW_DATA_PATH
+    processed_data_path = storage.PROCESSED_DATA_PATH
+
+    start = time.perf_counter()
+    reports = clean_layers(raw_data_path, processed_data_path)
+
+    print(f"{'layer':<24}{'rows':>12}{'columns':>9}{'seconds':>9}")
+    for report in reports:
+        if report['error']:
+            print(f"{report['layer']:<24} Error: {report['error']}")
+        else:
+            print(f"{report['layer']:<24}{report['rows']:>12}{report['columns']:>9}{report['seconds']:>9.1f}  -> {report['output']}")
+    print(f"Cleaned {sum(1 for r in reports if not r['error'])}/{len(reports)} layers in {time.perf_counter() - start:.1f} s.")
 
 
 if __name__ == "__main__":
@@ -1,93 +1,154 @@
 import pandas as pd
-import geopandas as gpd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pv
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
 import os
 import glob
+import re
+import time
+from concurrent.futures import ProcessPoolExecutor
+import station_history
+import storage
 
 
-#Delete all values where state != 'WA' in AFDC data
 # --- 1. Define the correct, cross-platform paths ---
-# We use forward slashes, which work on all operating systems.
-base_path = "EV-Charging-Optimization-Forecasting/data/raw"
+# The same roots as every other script (see storage.py), relative to the project root we are run from.
+raw_data_path = storage.RAW_DATA_PATH
+processed_data_path = storage.PROCESSED_DATA_PATH
 
-# --- 2. Process all AFDC historical files in a loop ---
+# We only keep the stations of this state
+STATE = 'WA'
 
-print("--- Processing AFDC Historical Data ---")
-search_pattern = os.path.join(base_path, "alt_fuel_stations_historical_day*.csv")
-all_afdc_files = glob.glob(search_pattern)
+# --- 2. Define the columns you want to KEEP for your model, with their types ---
+# Pinning the types means pandas/pyarrow never has to guess them (and never reads a file twice to do so),
+# and every yearly file ends up with exactly the same schema.
+columns_to_keep = {
+    'ID': pa.int64(),
+    'Latitude': pa.float64(),
+    'Longitude': pa.float64(),
+    'State': pa.string(), # We use this to filter
+    'EV Level1 EVSE Num': pa.float64(),
+    'EV Level2 EVSE Num': pa.float64(),
+    'EV DC Fast Count': pa.float64(),
+    'EV Connector Types': pa.string(),
+    'Groups With Access Code': pa.string(), # Often used for Public/Private status
+    'Access Days Time': pa.string(),
+    'Facility Type': pa.string(),
+    'EV Workplace Charging': pa.string(),
+    'Open Date': pa.string(),
+    'EV Network': pa.string(),
+    'EV Pricing': pa.string(),
+}
 
-for file_path in all_afdc_files:
+# Values that mean "no value" in the AFDC exports
+NULL_VALUES = ['', 'NA', 'N/A', 'NONE', 'None', 'null']
+
+# The CSV files are read in blocks of this many bytes, so memory is bounded by the block size
+# instead of by the size of the largest national daily snapshot.
+BLOCK_SIZE_BYTES = 16 * 1024 * 1024
+
+
+def snapshot_of(file_path):
+    """
+    Gets the year and (if it can be parsed) the date of a snapshot from its file name,
+    e.g. "alt_fuel_stations_historical_day (Dec 31 2020).csv" -> (2020, Timestamp('2020-12-31')).
+    """
+    label = os.path.basename(file_path).split('(')[-1].split(')')[0]
+    year = int(re.findall(r'\d{4}', label)[-1])
+    snapshot_date = pd.to_datetime(label, errors='coerce')
+    return year, snapshot_date
+
+
+def ingest_file(file_path, output_dir, state=STATE, block_size=BLOCK_SIZE_BYTES):
+    """
+    Streams one AFDC historical CSV, keeps the rows of one state and the columns in columns_to_keep,
+    and writes them as one Parquet file in the Year=YYYY partition of output_dir.
+    Every block of the CSV is filtered and written on its own, so only one block is in memory at a time.
+    The raw file is never modified. Returns (file name, rows read, rows kept, seconds).
+    """
+    start = time.perf_counter()
+    base_name = os.path.basename(file_path)
+    year, snapshot_date = snapshot_of(file_path)
+
+    reader = pv.open_csv(
+        file_path,
+        read_options=pv.ReadOptions(block_size=block_size),
+        convert_options=pv.ConvertOptions(
+            include_columns=list(columns_to_keep),
+            # Older snapshots do not have every column, those are filled with nulls
+            include_missing_columns=True,
+            column_types=columns_to_keep,
+            null_values=NULL_VALUES,
+            strings_can_be_null=True,
+        ),
+    )
+
+    schema = reader.schema.append(pa.field('snapshot_date', pa.timestamp('s')))
+    snapshot = snapshot_date if not pd.isna(snapshot_date) else None
+    rows = {'read': 0, 'kept': 0}
+
+    def write(tmp_path):
+        with pq.ParquetWriter(tmp_path, schema) as writer:
+            for batch in reader:
+                rows['read'] += batch.num_rows
+                kept = batch.filter(pc.equal(batch.column('State'), state))
+                if kept.num_rows:
+                    columns = kept.columns + [pa.array([snapshot] * kept.num_rows, type=pa.timestamp('s'))]
+                    writer.write_batch(pa.RecordBatch.from_arrays(columns, schema=schema))
+                    rows['kept'] += kept.num_rows
+
+    # Written under a hidden temporary name and renamed when complete, so a half written file never ends up in the dataset
+    partition_dir = os.path.join(output_dir, f"Year={year}")
+    storage.atomic_write(os.path.join(partition_dir, os.path.splitext(base_name)[0] + '.parquet'), write)
+    return base_name, rows['read'], rows['kept'], time.perf_counter() - start
+
+
+def read_afdc_history(columns=None, years=None, base_path=processed_data_path):
+    """
+    Reads the ingested AFDC history as one DataFrame (with a 'Year' column),
+    optionally only some columns and some years. Partitions of other years are never opened.
+    """
+    dataset = ds.dataset(storage.dataset_path('afdc_history', base_path), format='parquet', partitioning='hive')
+    filter_expression = ds.field('Year').isin(list(years)) if years is not None else None
+    return dataset.to_table(columns=columns, filter=filter_expression).to_pandas()
+
+
+def main(workers=None):
+    # --- 3. Find all the AFDC historical CSV files ---
+    search_pattern = os.path.join(raw_data_path, "alt_fuel_stations_historical_day*.csv")
+    all_files = sorted(glob.glob(search_pattern))
+    print(f"Found {len(all_files)} files to process.")
+
+    output_dir = storage.dataset_path('afdc_history', processed_data_path)
+    os.makedirs(output_dir, exist_ok=True)
+
+    # --- 4. Ingest the files in parallel, each one streamed once ---
+    ingested = 0
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(ingest_file, file_path, output_dir): file_path for file_path in all_files}
+        for future, file_path in futures.items():
+            try:
+                base_name, rows_read, rows_kept, seconds = future.result()
+                print(f"-> {base_name}: {rows_read} rows -> {rows_kept} {STATE} rows in {seconds:.1f} s.")
+                ingested += 1
+            except Exception as e:
+                print(f"An error occurred while processing {file_path}: {e}")
+
+    print(f"\n\nAll files have been processed into '{output_dir}'.")
+
+    # --- 5. Rebuild the as-of station history store from the ingested snapshots ---
+    # Only when something new was ingested, the existing store stays as it is otherwise
+    if not ingested:
+        print("No file was ingested, the station history was not rebuilt.")
+        return
     try:
-        df = pd.read_csv(file_path, low_memory=False)
-        if 'State' in df.columns:
-            original_rows = len(df)
-            df_filtered = df[df['State'] == 'WA'].copy() #Copies only rows where State is WA
-            # Overwrite the original file with the filtered data
-            df_filtered.to_csv(file_path, index=False)
-            print(f"-> Overwrote {os.path.basename(file_path)}: {original_rows} rows -> {len(df_filtered)} rows.")
-        else:
-            print(f"Warning: 'State' column not found in {os.path.basename(file_path)}")
+        history_path = station_history.build(base_path=processed_data_path)
+        print(f"Station history intervals saved to '{history_path}'.")
     except Exception as e:
-        print(f"Error processing {file_path}: {e}")
-        
-
-# --- 1. Define the columns you want to KEEP for your model ---
-# It's easier and safer to specify what you need, rather than what you don't.
-columns_to_keep = [
-    'ID',
-    'Latitude',
-    'Longitude',
-    'State', # We'll use this to filter, then it can be dropped if desired
-    'EV Level1 EVSE Num',
-    'EV Level2 EVSE Num',
-    'EV DC Fast Count',
-    'EV Connector Types',
-    'Groups With Access Code', # Often used for Public/Private status
-    'Access Days Time',
-    'Facility Type',
-    'EV Workplace Charging',
-    'Open Date',
-    'EV Network',
-    'EV Pricing'
-]
-
-# --- 2. Define your input and output directories ---
-raw_data_path = "EV-Charging-Optimization-Forecasting/data/raw/"
-processed_data_path = "EV-Charging-Optimization-Forecasting/data/processed/"
-
-# Create the output directory if it doesn't already exist
-os.makedirs(processed_data_path, exist_ok=True)
-
-# --- 3. Find all the AFDC historical CSV files ---
-search_pattern = os.path.join(raw_data_path, "alt_fuel_stations_historical_day*.csv")
-all_files = glob.glob(search_pattern)
-
-print(f"Found {len(all_files)} files to process.")
-
-# --- 4. Loop through each file, clean it, and save to the processed folder ---
-for file_path in all_files:
-    try:
-        base_name = os.path.basename(file_path)
-        
-        # Read the raw CSV file
-        df = pd.read_csv(file_path, low_memory=False)
-        print(f"\nProcessing '{base_name}' with {len(df)} rows and {len(df.columns)} columns.")
-
-        # --- Step B: Filter by relevant columns ---
-        # Find which of our desired columns actually exist in this specific file
-        existing_columns_to_keep = [col for col in columns_to_keep if col in df.columns]
-        
-        # Keep only those columns
-        df_cleaned = df[existing_columns_to_keep]
-        
-        print(f"-> Kept {len(df_cleaned.columns)} relevant columns.")
-
-        # --- Step C: Save the cleaned file to the processed directory ---
-        output_path = os.path.join(processed_data_path, base_name)
-        df_cleaned.to_csv(output_path, index=False)
-        
-        print(f"-> Successfully saved cleaned file to '{output_path}'")
+        print(f"An error occurred while building the station history: {e}")
 
-    except Exception as e:
-        print(f"An error occurred while processing {file_path}: {e}")
 
-print("\n\nAll files have been processed.")
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,140 @@
+#Coordinate transformations and cached reprojected layers
+#Every script used to call to_crs(TARGET_CRS) on the stations, roads and POIs it reads, so the full POI layer was
+#reprojected on every run. This module keeps one pyproj Transformer per CRS pair (and thread), transforms raw
+#coordinate arrays in bulk (in chunks on a long-lived thread pool for large layers), and caches reprojected layers as
+#GeoParquet in PROJECTED_CACHE_DIR, keyed on the content of the source file, the target CRS and the columns read.
+#A repeat run reads the projected layer straight from the cache.
+import functools
+import hashlib
+import json
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import geopandas as gpd
+import numpy as np
+import shapely
+from pyproj import CRS, Transformer
+
+import storage
+from features import TARGET_CRS
+from stage_cache import StageCache
+
+PROJECTED_CACHE_DIR = os.getenv("EV_PROJECTED_CACHE_DIR", ".cache/projected")
+
+#Arrays with at least this many points are transformed in chunks on TRANSFORM_THREADS threads
+#(PROJ runs without the GIL, so the chunks really run in parallel)
+THREADED_MIN_POINTS = 500_000
+TRANSFORM_THREADS = int(os.getenv("EV_TRANSFORM_THREADS", min(8, os.cpu_count() or 1)))
+
+
+@functools.lru_cache(maxsize=None)
+def _crs(crs):
+    return CRS.from_user_input(crs)
+
+
+def crs_name(crs):
+    """
+    Short stable name of a CRS ("EPSG:32148" when it has an authority code, else its WKT).
+    """
+    crs = _crs(crs) if isinstance(crs, str) else CRS.from_user_input(crs)
+    return crs.to_string()
+
+
+@functools.lru_cache(maxsize=None)
+def _same_crs(source, target):
+    return _crs(source) == _crs(target)
+
+
+#Transformers of the current thread by (source, target)
+_local = threading.local()
+
+
+def transformer(source, target):
+    """
+    The Transformer from source to target (x/y, i.e. lon/lat order), created once per CRS pair.
+    A Transformer must not be used by two threads at once, so every thread gets its own; they go away with the thread.
+    """
+    key = (crs_name(source), crs_name(target))
+    transformers = getattr(_local, 'transformers', None)
+    if transformers is None:
+        transformers = _local.transformers = {}
+    if key not in transformers:
+        transformers[key] = Transformer.from_crs(*key, always_xy=True)
+    return transformers[key]
+
+
+@functools.lru_cache(maxsize=None)
+def _pool(threads):
+    #Kept for the life of the process, so its threads and their Transformers are reused by every call
+    return ThreadPoolExecutor(max_workers=threads, thread_name_prefix='transform')
+
+
+def transform_xy(xy, source, target, threads=None):
+    """
+    Transforms an (N, 2) array of x/y coordinates from source to target and returns a new (N, 2) array.
+    Large arrays are split into chunks that are transformed on `threads` threads (default TRANSFORM_THREADS).
+    """
+    xy = np.asarray(xy, dtype=float).reshape(-1, 2)
+    source, target = crs_name(source), crs_name(target)
+    if _same_crs(source, target):
+        return xy.copy()
+    threads = TRANSFORM_THREADS if threads is None else threads
+    out = np.empty_like(xy)
+
+    def transform_chunk(bounds):
+        start, stop = bounds
+        out[start:stop, 0], out[start:stop, 1] = transformer(source, target).transform(xy[start:stop, 0], xy[start:stop, 1])
+
+    if threads <= 1 or len(xy) < THREADED_MIN_POINTS:
+        transform_chunk((0, len(xy)))
+        return out
+    edges = np.linspace(0, len(xy), threads + 1).astype(int)
+    list(_pool(threads).map(transform_chunk, zip(edges[:-1], edges[1:])))
+    return out
+
+
+def to_crs(gdf, crs=TARGET_CRS, threads=None):
+    """
+    gdf reprojected to crs, like GeoDataFrame.to_crs, but with the cached Transformers and the threaded
+    bulk transform: all coordinates of all geometries go through transform_xy in one call.
+    """
+    if gdf.crs is None:
+        raise ValueError("Cannot reproject a GeoDataFrame without a CRS")
+    if _same_crs(crs_name(gdf.crs), crs_name(crs)):
+        return gdf
+    source = gdf.crs
+    geometry = shapely.transform(np.asarray(gdf.geometry.values), lambda coords: transform_xy(coords, source, crs, threads))
+    return gdf.set_geometry(gpd.GeoSeries(geometry, index=gdf.index, crs=crs), crs=crs)
+
+
+def read_projected_layer(name, crs=TARGET_CRS, columns=None, base_path=storage.PROCESSED_DATA_PATH,
+                         cache_dir=PROJECTED_CACHE_DIR):
+    """
+    Reads a layer (see storage.read_layer) reprojected to crs. The projected layer is cached as GeoParquet,
+    so as long as the source file does not change it is only ever reprojected once.
+    """
+    path, _ = storage.find_layer(name, base_path)
+    #StageCache hashes the source file by content (remembering digests by size and modification time)
+    key = StageCache(cache_dir=cache_dir).key(
+        'projected_layer', files=[path], params={'crs': crs_name(crs), 'columns': columns}, code=[to_crs]
+    )
+    #One cache entry per source file, CRS and column selection, overwritten when the source changes. The full path is
+    #part of the name, so layers with the same file name in different directories do not evict each other.
+    variant = hashlib.sha256(json.dumps([os.path.abspath(path), crs_name(crs), columns]).encode()).hexdigest()[:12]
+    cached = os.path.join(cache_dir, f"{os.path.splitext(os.path.basename(path))[0]}_{variant}.parquet")
+    try:
+        with open(cached + ".key") as f:
+            if f.read() == key:
+                return gpd.read_parquet(cached)
+    except OSError:
+        pass
+
+    gdf = to_crs(storage.read_layer(name, columns=columns, base_path=base_path), crs)
+    #The key file is written last, so a cache entry is only used once it is complete
+    if os.path.exists(cached + ".key"):
+        os.remove(cached + ".key")
+    storage.atomic_write(cached, lambda tmp_path: gdf.to_parquet(tmp_path, index=False, write_covering_bbox=True),
+                         suffix='.parquet')
+    storage.atomic_write(cached + ".key", key.encode())
+    return gdf
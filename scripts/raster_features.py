@@ -0,0 +1,273 @@
+#Raster feature backend for dense uniform grids
+#The vector backend (features.py) answers one nearest-neighbour or radius query per cell. On a uniform grid the same
+#features can be computed for all cells at once on a raster that is aligned with the grid: every cell is split into
+#SUPERSAMPLE x SUPERSAMPLE pixels (an odd number, so the center pixel of a cell sits exactly on its centroid), the
+#layers are burnt into the raster once, and then
+#  - dist_to_major_road_m and dist_to_nearest_station_m come from one exact Euclidean distance transform each
+#    (scipy.ndimage.distance_transform_edt). The transform returns the nearest marked pixel of every pixel, and the
+#    distance is then measured from the cell centroid to the station (or the road line) in that pixel, so the
+#    error is bounded by the pixel size and not by the cell size.
+#  - the POI densities come from a convolution of the POI count raster with a disk kernel of every radius.
+#
+#The raster features are close to, but not exactly the same as the vector features:
+#  - a distance is off by at most one pixel diagonal (283 m for 1000 m cells at SUPERSAMPLE 5),
+#  - a POI counts when the center of its pixel is within the radius, so the POIs near the edge of the disk are
+#    counted or not by chance. The error grows as the radius spans fewer pixels, roughly 25% / (radius in pixels)
+#    of the counted POIs: 8.6% for 0.5 mile (4 pixels of 200 m) but 2.1% for 1.5 miles and 0.8% for 3 miles.
+#    Radii shorter than MIN_RADIUS_PIXELS pixels are therefore counted exactly with a KD-tree (they are also the
+#    cheapest ones to count that way), so every density stays within POI_TOLERANCE.
+#Check the errors on your data (the script exits with an error when a feature is out of tolerance):
+#    python scripts/raster_features.py --grid-size 1000
+#and pick the backend per run with python scripts/predict_demand.py --feature-backend raster.
+import argparse
+import sys
+import time
+from collections import namedtuple
+
+import numpy as np
+import pandas as pd
+import shapely
+from scipy.ndimage import distance_transform_edt
+from scipy.signal import fftconvolve
+from scipy.spatial import cKDTree
+
+import grid
+from features import POI_DENSITY_RADII, RadiusCounter, point_coords, select_major_roads
+
+#Pixels per cell side (odd), lowered automatically for grids that would need more than MAX_RASTER_PIXELS
+SUPERSAMPLE = 5
+MAX_RASTER_PIXELS = 40_000_000
+
+#POI radii shorter than this many pixels are counted exactly instead of with a disk kernel
+MIN_RADIUS_PIXELS = 10
+
+#Largest POI density error accepted by the comparison in main, as a share of all the POIs the vector features count
+POI_TOLERANCE = 0.03
+
+#The raster: lower left corner, pixel size and shape (columns, rows), padded by `pad` pixels around the grid
+RasterFrame = namedtuple('RasterFrame', ['xmin', 'ymin', 'pixel_size', 'ncols', 'nrows', 'pad', 'supersample'])
+
+
+def raster_frame(spec, supersample=SUPERSAMPLE, pad_m=0.0, max_pixels=MAX_RASTER_PIXELS):
+    """
+    The RasterFrame of a grid: supersample x supersample pixels per cell, with pad_m meters of margin around it
+    (so POIs just outside the grid are still counted). The supersample is lowered (odd values only) until the
+    raster has at most max_pixels pixels.
+    """
+    if supersample < 1 or supersample % 2 == 0:
+        raise ValueError(f"The supersample must be an odd number, not {supersample}")
+    while True:
+        pixel_size = spec.cell_size / supersample
+        pad = int(np.ceil(pad_m / pixel_size))
+        ncols, nrows = spec.ncols * supersample + 2 * pad, spec.nrows * supersample + 2 * pad
+        if ncols * nrows <= max_pixels or supersample == 1:
+            break
+        supersample -= 2
+    return RasterFrame(spec.xmin - pad * pixel_size, spec.ymin - pad * pixel_size, pixel_size, ncols, nrows, pad, supersample)
+
+
+def pixels_of(frame, xy):
+    """
+    (cols, rows, inside) of the pixels the points in xy fall in; inside is False for points off the raster.
+    """
+    xy = np.asarray(xy, dtype=float).reshape(-1, 2)
+    cols = np.floor((xy[:, 0] - frame.xmin) / frame.pixel_size).astype(np.int64)
+    rows = np.floor((xy[:, 1] - frame.ymin) / frame.pixel_size).astype(np.int64)
+    inside = (cols >= 0) & (cols < frame.ncols) & (rows >= 0) & (rows < frame.nrows)
+    return cols, rows, inside
+
+
+def cell_pixels(frame, spec, ids):
+    """
+    (cols, rows) of the center pixel of every grid cell in ids.
+    """
+    cols, rows = grid.cell_col_row(spec, ids)
+    offset = frame.pad + frame.supersample // 2
+    return cols * frame.supersample + offset, rows * frame.supersample + offset
+
+
+def nearest_points(frame, spec, ids, xy):
+    """
+    For every grid cell in ids: (distance in meters to the nearest point of xy, position of that point in xy).
+    The points are burnt into the raster (one point per pixel) and one distance transform finds the nearest marked
+    pixel of every cell. Points off the raster are checked exactly with a KD-tree instead.
+    Cells get (inf, -1) when there are no points at all.
+    """
+    xy = np.asarray(xy, dtype=float).reshape(-1, 2)
+    centroids = grid.cell_centroids(spec, ids)
+    distances = np.full(len(centroids), np.inf)
+    nearest = np.full(len(centroids), -1, dtype=np.int64)
+    cols, rows, inside = pixels_of(frame, xy)
+    if inside.any():
+        owner = np.full((frame.ncols, frame.nrows), -1, dtype=np.int64)
+        owner[cols[inside], rows[inside]] = np.flatnonzero(inside)
+        #Indices of the nearest marked (zero) pixel of every pixel; the distances themselves are not needed
+        indices = distance_transform_edt(owner < 0, return_distances=False, return_indices=True)
+        cell_cols, cell_rows = cell_pixels(frame, spec, ids)
+        nearest = owner[indices[0][cell_cols, cell_rows], indices[1][cell_cols, cell_rows]]
+        del indices
+        distances = np.hypot(*(centroids - xy[nearest]).T)
+    if not inside.all():
+        outside = np.flatnonzero(~inside)
+        outside_distances, outside_nearest = cKDTree(xy[outside]).query(centroids, k=1)
+        closer = outside_distances < distances
+        distances[closer] = outside_distances[closer]
+        nearest[closer] = outside[outside_nearest[closer]]
+    return distances, nearest
+
+
+def road_vertices(road_lines, pixel_size):
+    """
+    (vertices, position of their line in road_lines) of the road lines, with extra vertices so that no segment is
+    longer than half a pixel. Every pixel a road crosses then holds at least one vertex.
+    """
+    return shapely.get_coordinates(shapely.segmentize(road_lines, pixel_size / 2), return_index=True)
+
+
+def disk_kernel(radius_m, pixel_size):
+    """
+    A square kernel with 1 for every pixel whose center is within radius_m of the center pixel's center.
+    """
+    reach = int(np.floor(radius_m / pixel_size))
+    offsets = np.arange(-reach, reach + 1) * pixel_size
+    return (np.hypot(*np.meshgrid(offsets, offsets, indexing='ij')) <= radius_m).astype(float)
+
+
+def poi_densities(frame, spec, ids, poi_xy, density_radii=POI_DENSITY_RADII, min_radius_pixels=MIN_RADIUS_PIXELS):
+    """
+    {column: counts} of the POIs within each radius of every grid cell in ids, from a POI count raster convolved
+    with a disk kernel per radius. A POI counts when the center of its pixel is within the radius.
+    Radii shorter than min_radius_pixels pixels are counted exactly with a RadiusCounter instead.
+    """
+    small = {column: radius for column, radius in density_radii.items() if radius < min_radius_pixels * frame.pixel_size}
+    densities = {}
+    if small:
+        exact = RadiusCounter(poi_xy).count(grid.cell_centroids(spec, ids), set(small.values()))
+        densities.update({column: exact[radius] for column, radius in small.items()})
+
+    large = {column: radius for column, radius in density_radii.items() if column not in small}
+    if large:
+        cols, rows, inside = pixels_of(frame, poi_xy)
+        counts = np.zeros((frame.ncols, frame.nrows))
+        np.add.at(counts, (cols[inside], rows[inside]), 1)
+        cell_cols, cell_rows = cell_pixels(frame, spec, ids)
+    for column, radius in large.items():
+        convolved = fftconvolve(counts, disk_kernel(radius, frame.pixel_size), mode='same')
+        #FFT rounding noise, the true values are whole numbers
+        densities[column] = np.rint(convolved[cell_cols, cell_rows]).astype(np.int64)
+    return {column: densities[column] for column in density_radii}
+
+
+def raster_feature_stage(grid_gdf, spec, gdf_roads, gdf_stations, gdf_pois, density_radii=POI_DENSITY_RADII,
+                         supersample=SUPERSAMPLE):
+    """
+    The raster version of predict_demand.py's road, station and POI stages for the cells of grid_gdf (cells of spec).
+    Returns (road distances, station distances, nearest station coordinates, POI density DataFrame).
+    """
+    ids = grid_gdf['cell_id'].to_numpy(dtype=np.int64)
+    frame = raster_frame(spec, supersample, pad_m=max(density_radii.values(), default=0))
+
+    #The distance is measured to the whole road line the nearest vertex belongs to, not just to the vertex
+    road_lines = select_major_roads(gdf_roads).geometry.values
+    vertices, line_of_vertex = road_vertices(road_lines, frame.pixel_size)
+    _, nearest_vertex = nearest_points(frame, spec, ids, vertices)
+    road_dist = np.full(len(ids), np.inf)
+    found = nearest_vertex >= 0
+    road_dist[found] = shapely.distance(shapely.points(grid.cell_centroids(spec, ids[found])),
+                                        road_lines[line_of_vertex[nearest_vertex[found]]])
+
+    station_xy = point_coords(gdf_stations.geometry)
+    station_dist, nearest = nearest_points(frame, spec, ids, station_xy)
+    nearest_station_xy = np.full((len(ids), 2), np.nan)
+    found = nearest >= 0
+    nearest_station_xy[found] = station_xy[nearest[found]]
+
+    densities = poi_densities(frame, spec, ids, point_coords(gdf_pois.geometry), density_radii)
+    poi_counts = pd.DataFrame({column: densities[column] for column in density_radii}, index=grid_gdf.index)
+    return road_dist, station_dist, nearest_station_xy, poi_counts
+
+
+def feature_errors(raster, vector):
+    """
+    {column: errors} of the raster features against the vector features, both given as {column: values}.
+    Distances get the max, mean and 99th percentile error in meters, POI densities the share of exact cells,
+    the mean error and the summed error relative to all the POIs the vector features count.
+    """
+    errors = {}
+    for column, vector_values in vector.items():
+        error = np.abs(np.asarray(raster[column], dtype=float) - np.asarray(vector_values, dtype=float))
+        if column in POI_DENSITY_RADII:
+            errors[column] = {'exact': float(np.mean(error == 0)), 'mean': float(error.mean()),
+                              'relative': float(error.sum() / max(np.sum(vector_values), 1))}
+        else:
+            errors[column] = {'max_m': float(error.max()), 'mean_m': float(error.mean()),
+                              'p99_m': float(np.percentile(error, 99))}
+    return errors
+
+
+def tolerance_violations(errors, pixel_size, poi_tolerance=POI_TOLERANCE):
+    """
+    Messages for the features of feature_errors that are out of tolerance: a distance off by more than one pixel
+    diagonal, or a POI density off by more than poi_tolerance of the counted POIs.
+    """
+    max_distance_error = np.sqrt(2) * pixel_size
+    violations = []
+    for column, error in errors.items():
+        if 'relative' in error and error['relative'] > poi_tolerance:
+            violations.append(f"{column} is off by {error['relative']:.2%} of the counted POIs "
+                              f"(tolerance {poi_tolerance:.2%})")
+        elif 'max_m' in error and error['max_m'] > max_distance_error:
+            violations.append(f"{column} is off by up to {error['max_m']:.1f} m (tolerance {max_distance_error:.1f} m)")
+    return violations
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare the raster features of the prediction grid with the vector features.")
+    parser.add_argument("--grid-size", type=float, default=None, help="cell size in meters (default: predict_demand.GRID_SIZE)")
+    parser.add_argument("--supersample", type=int, default=SUPERSAMPLE, help="pixels per cell side (odd)")
+    args = parser.parse_args()
+
+    #Imported here so the backend itself does not depend on the prediction script
+    import predict_demand
+
+    gdf_stations, gdf_roads, gdf_pois = predict_demand.load_layers()
+    grid_size = args.grid_size or predict_demand.GRID_SIZE
+    grid_gdf = predict_demand.create_prediction_grid(gdf_roads, grid_size)
+    spec = grid.grid_spec(gdf_roads.total_bounds, grid_size)
+    frame = raster_frame(spec, args.supersample, pad_m=max(POI_DENSITY_RADII.values()))
+    print(f"Grid of {len(grid_gdf)} cells of {grid_size:.0f} m, raster of {frame.ncols} x {frame.nrows} pixels "
+          f"of {frame.pixel_size:.0f} m.")
+
+    start = time.perf_counter()
+    road_dist, station_dist, _, poi_counts = raster_feature_stage(
+        grid_gdf, spec, gdf_roads, gdf_stations, gdf_pois, supersample=args.supersample
+    )
+    raster_s = time.perf_counter() - start
+
+    start = time.perf_counter()
+    vector_features, _ = predict_demand.vector_feature_stage(grid_gdf, gdf_roads, gdf_stations, gdf_pois)
+    vector_s = time.perf_counter() - start
+    print(f"Raster features: {raster_s:.2f} s, vector features: {vector_s:.2f} s.")
+
+    raster = {'dist_to_major_road_m': road_dist, 'dist_to_nearest_station_m': station_dist, **poi_counts}
+    vector = {column: vector_features[column] for column in raster}
+    errors = feature_errors(raster, vector)
+    for column, error in errors.items():
+        if 'relative' in error:
+            exact = " (counted exactly)" if POI_DENSITY_RADII[column] < MIN_RADIUS_PIXELS * frame.pixel_size else ""
+            print(f"  - {column}: {error['exact']:.1%} of the cells exact, mean error {error['mean']:.2f} POIs "
+                  f"({error['relative']:.2%} of all counted POIs){exact}")
+        else:
+            print(f"  - {column}: max error {error['max_m']:.2f} m, mean {error['mean_m']:.3f} m, "
+                  f"99th percentile {error['p99_m']:.2f} m")
+
+    violations = tolerance_violations(errors, frame.pixel_size)
+    for violation in violations:
+        print(f"ERROR: {violation}.")
+    if violations:
+        sys.exit(1)
+    print("Every raster feature is within tolerance.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,235 @@
+#Road network graph and drive distances to the nearest charger
+#dist_to_nearest_station_m is a straight line, but coverage is about how far you have to drive. This module builds
+#an undirected graph from the road layer: every road vertex is a node (vertices closer than SNAP_M are merged, so
+#roads that share a junction are connected) and every segment is an edge weighted by its length in meters.
+#The graph is stored as CSR arrays (.npz) in GRAPH_CACHE_DIR, keyed on the content of the road layer, so it is
+#only built once.
+#
+#Drive distances come from one multi-source Dijkstra run: every station is a virtual node tied to its nearest road
+#node, and scipy's dijkstra(min_only=True) labels every road node with the distance to (and the index of) the
+#nearest station in O(E log V) for all stations together. A point (grid cell, candidate site) then gets the
+#distance of its nearest road node plus the straight line to that node.
+#
+#The drive distance is an optional model feature (features.DRIVE_FEATURE). Train a model that uses it with
+#    python scripts/forecast_demand.py --drive-distance
+#and predict_demand.py/tiled_scoring.py compute it whenever the model's metadata lists it.
+#
+#Build (or inspect) the cached graph from the command line:
+#    python scripts/road_graph.py build
+import argparse
+import hashlib
+import os
+import time
+
+import numpy as np
+import shapely
+from scipy.sparse import coo_matrix, csr_matrix
+from scipy.sparse.csgraph import connected_components, dijkstra
+from scipy.spatial import cKDTree
+
+import projection
+import storage
+from features import TARGET_CRS
+from stage_cache import code_version, file_digest
+
+GRAPH_CACHE_DIR = os.getenv("EV_GRAPH_CACHE_DIR", ".cache/road_graph")
+
+#Road vertices are snapped to a grid of this size (in meters) to find shared junctions
+SNAP_M = 1.0
+
+#Edges shorter than this (e.g. a station right on a road) get this weight, csgraph reads zero weights as no edge
+MIN_EDGE_M = 1e-3
+
+
+class RoadGraph:
+    """
+    The road network as node coordinates (N, 2) plus an undirected CSR adjacency matrix with edge lengths in meters.
+    """
+
+    def __init__(self, node_xy, adjacency):
+        self.node_xy = node_xy
+        self.adjacency = adjacency
+        self._node_tree = None
+
+    @property
+    def n_nodes(self):
+        return len(self.node_xy)
+
+    @property
+    def n_edges(self):
+        return self.adjacency.nnz // 2
+
+    @property
+    def node_tree(self):
+        if self._node_tree is None:
+            self._node_tree = cKDTree(self.node_xy)
+        return self._node_tree
+
+    def snap(self, xy):
+        """
+        Returns (straight-line distance to the nearest node, nearest node) for every point of xy.
+        """
+        return self.node_tree.query(np.asarray(xy, dtype=float).reshape(-1, 2), k=1)
+
+    def save(self, path):
+        def write(tmp_path):
+            np.savez(tmp_path, node_xy=self.node_xy, indptr=self.adjacency.indptr,
+                     indices=self.adjacency.indices, data=self.adjacency.data)
+        storage.atomic_write(path, write, suffix='.npz')
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as arrays:
+            n = len(arrays['node_xy'])
+            adjacency = csr_matrix((arrays['data'], arrays['indices'], arrays['indptr']), shape=(n, n))
+            return cls(arrays['node_xy'], adjacency)
+
+
+def build_road_graph(gdf_roads, snap_m=SNAP_M):
+    """
+    Builds the RoadGraph of the road lines of gdf_roads (in TARGET_CRS). Multi-part lines are split into their
+    parts, and parallel edges between the same two nodes keep the shortest length.
+    """
+    lines = shapely.get_parts(gdf_roads.geometry.values)
+    lines = lines[shapely.get_type_id(lines) == 1]
+    coords, line_index = shapely.get_coordinates(lines, return_index=True)
+
+    #Vertices that fall into the same snap cell are one node
+    _, node_of_vertex = np.unique(np.round(coords / snap_m).astype(np.int64), axis=0, return_inverse=True)
+    node_of_vertex = node_of_vertex.ravel()
+    n_nodes = int(node_of_vertex.max()) + 1 if len(node_of_vertex) else 0
+    node_xy = np.zeros((n_nodes, 2))
+    node_xy[node_of_vertex] = coords
+
+    #A segment joins two consecutive vertices of the same line
+    same_line = line_index[1:] == line_index[:-1]
+    u, v = node_of_vertex[:-1][same_line], node_of_vertex[1:][same_line]
+    length = np.hypot(*(coords[1:][same_line] - coords[:-1][same_line]).T)
+    keep = u != v
+    u, v, length = u[keep], v[keep], np.maximum(length[keep], MIN_EDGE_M)
+
+    #Both directions, and only the shortest of parallel edges (a sparse matrix would add their lengths up)
+    rows, cols, weights = np.concatenate([u, v]), np.concatenate([v, u]), np.concatenate([length, length])
+    order = np.lexsort((weights, cols, rows))
+    rows, cols, weights = rows[order], cols[order], weights[order]
+    first = np.ones(len(rows), dtype=bool)
+    first[1:] = (rows[1:] != rows[:-1]) | (cols[1:] != cols[:-1])
+    adjacency = coo_matrix((weights[first], (rows[first], cols[first])), shape=(n_nodes, n_nodes)).tocsr()
+    return RoadGraph(node_xy, adjacency)
+
+
+def graph_cache_path(roads_file, snap_m=SNAP_M, cache_dir=GRAPH_CACHE_DIR):
+    """
+    Cache file of the graph of a road layer file: keyed on its content, the snap size and the graph building code.
+    """
+    key = hashlib.sha256(
+        f"{file_digest(roads_file)}|{snap_m}|{TARGET_CRS}|{code_version(build_road_graph)}".encode()
+    ).hexdigest()[:24]
+    return os.path.join(cache_dir, f"road_graph_{key}.npz")
+
+
+def load_road_graph(gdf_roads=None, roads_file=None, snap_m=SNAP_M, cache_dir=GRAPH_CACHE_DIR):
+    """
+    The RoadGraph of the road layer, from the cache when the layer did not change since it was built.
+    gdf_roads (in TARGET_CRS) is only used when the graph has to be built; it is read from disk if not given.
+    """
+    roads_file = roads_file or storage.find_layer('roads')[0]
+    path = graph_cache_path(roads_file, snap_m, cache_dir)
+    if os.path.exists(path):
+        return RoadGraph.load(path)
+    if gdf_roads is None:
+        gdf_roads = projection.read_projected_layer('roads', columns=['geometry'])
+    graph = build_road_graph(gdf_roads, snap_m)
+    graph.save(path)
+    return graph
+
+
+def _with_stations(graph, station_xy):
+    #The adjacency matrix plus one virtual node per station, tied to the station's nearest road node by a
+    #straight line. Returns (adjacency, virtual node numbers).
+    n, n_stations = graph.n_nodes, len(station_xy)
+    access, nearest = graph.snap(station_xy)
+    virtual = np.arange(n, n + n_stations)
+    access = np.maximum(access, MIN_EDGE_M)
+    edges = graph.adjacency.tocoo()
+    full = coo_matrix(
+        (np.concatenate([edges.data, access, access]),
+         (np.concatenate([edges.row, virtual, nearest]), np.concatenate([edges.col, nearest, virtual]))),
+        shape=(n + n_stations, n + n_stations),
+    )
+    return full.tocsr(), virtual
+
+
+class DriveDistance:
+    """
+    Drive distance from any point to the nearest station, after one multi-source Dijkstra over the road graph.
+    Points and stations are tied to the network by a straight line to their nearest road node. Points whose road
+    node cannot reach any station (a separate network component) get NaN, which the model treats as missing.
+    """
+
+    def __init__(self, graph, station_xy):
+        self.graph = graph
+        self.station_xy = np.asarray(station_xy, dtype=float).reshape(-1, 2)
+        if not len(self.station_xy) or not graph.n_nodes:
+            self.adjacency, self.virtual = None, np.empty(0, dtype=np.int64)
+            self.distance = np.full(graph.n_nodes, np.nan)
+            self.source = np.full(graph.n_nodes, -1)
+            return
+        self.adjacency, self.virtual = _with_stations(graph, self.station_xy)
+        distance, _, source = dijkstra(self.adjacency, directed=False, indices=self.virtual,
+                                       min_only=True, return_predecessors=True)
+        #Labels of every node: distance to the nearest station and which station that is (-1 if unreachable)
+        self.distance = np.where(np.isfinite(distance), distance, np.nan)
+        self.source = np.where(source >= 0, source - graph.n_nodes, -1)
+
+    def query(self, xy):
+        """
+        Drive distance in meters from every point of xy to its nearest station.
+        """
+        access, nearest = self.graph.snap(xy)
+        if not len(self.station_xy):
+            return np.full(len(access), np.nan)
+        return access + self.distance[nearest]
+
+    def to_nearest_other_station(self):
+        """
+        Drive distance from every station to the nearest other station (for training, like exclude_self).
+        The shortest path between a station and its nearest other station crosses exactly one edge whose two ends
+        are labelled with different stations, so the minimum of d(u) + w(u, v) + d(v) over those edges is the
+        answer for both labels (Mehlhorn's observation), without a Dijkstra run per station.
+        """
+        result = np.full(len(self.station_xy), np.inf)
+        if self.adjacency is None:
+            return np.full(len(self.station_xy), np.nan)
+        edges = self.adjacency.tocoo()
+        source_u, source_v = self.source[edges.row], self.source[edges.col]
+        boundary = (source_u >= 0) & (source_v >= 0) & (source_u != source_v)
+        length = self.distance[edges.row[boundary]] + edges.data[boundary] + self.distance[edges.col[boundary]]
+        np.minimum.at(result, source_u[boundary], length)
+        return np.where(np.isfinite(result), result, np.nan)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build or inspect the cached road graph.")
+    parser.add_argument("command", choices=["build", "info"])
+    parser.add_argument("--snap", type=float, default=SNAP_M, help="snap size in meters for road vertices")
+    args = parser.parse_args()
+
+    roads_file = storage.find_layer('roads')[0]
+    path = graph_cache_path(roads_file, args.snap)
+    if args.command == "build" or not os.path.exists(path):
+        start = time.perf_counter()
+        gdf_roads = projection.read_projected_layer('roads', columns=['geometry'])
+        graph = build_road_graph(gdf_roads, args.snap)
+        graph.save(path)
+        print(f"Built the road graph of '{roads_file}' in {time.perf_counter() - start:.2f} s.")
+    else:
+        graph = RoadGraph.load(path)
+    n_components, labels = connected_components(graph.adjacency, directed=False)
+    largest = np.bincount(labels).max() if graph.n_nodes else 0
+    print(f"'{path}': {graph.n_nodes} nodes, {graph.n_edges} edges, {n_components} components "
+          f"(the largest has {largest} nodes).")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,281 @@
+#Parallel sweep over the scoring parameters
+#predict_demand.py scores the grid with one fixed set of parameters: the charging desert distance, the POI radius,
+#the road classes that count as major roads and the weight of the POI bonus in suitability_score. This script
+#evaluates a whole grid of parameter sets ("scenarios") in one run:
+#  1. The expensive features are computed once for every cell: the road distance for every road class subset,
+#     the POI density for every radius, the station distance, and one model prediction per (road classes, radius)
+#     combination. They are written as one float32 table (.npy) in SCENARIO_CACHE_DIR, keyed on the inputs, so
+#     a rerun with the same layers and parameter values skips this step.
+#  2. A pool of worker processes memory-maps the table (no copy per worker) and evaluates the filter and score of
+#     every scenario with vectorized NumPy.
+#  3. A report compares the scenarios: how many of the baseline's top K locations every scenario keeps, and the
+#     distribution of its scores. It is printed and written to SCENARIO_REPORT_DIR as JSON and CSV.
+#
+#Every value given for a parameter is combined with every value of the others:
+#    python scripts/scenario_sweep.py --desert-m 2000 3218 5000 --poi-radius 805 2414 \
+#        --road-classes motorway,trunk,primary,secondary motorway,trunk --poi-weight 0 1 2
+import argparse
+import datetime
+import itertools
+import json
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+import shapely
+from scipy.spatial import cKDTree
+
+import features
+import grid
+import top_k
+from features import (DRIVE_FEATURE, MAJOR_ROAD_TYPES, POI_RADIUS_M, RadiusCounter, dist_to_major_road,
+                      dist_to_nearest_station, point_coords, select_major_roads)
+from instrumentation import fail, instrumented_run, stage
+from predict_demand import CHARGING_DESERT_M, GRID_SIZE, MODEL_FILE, load_layers, load_model, suitability_score
+from stage_cache import StageCache
+import storage
+
+SCENARIO_CACHE_DIR = os.getenv("EV_SCENARIO_CACHE_DIR", ".cache/scenarios")
+SCENARIO_REPORT_DIR = os.getenv("EV_SCENARIO_REPORT_DIR", "reports/scenarios")
+
+#The parameters predict_demand.py uses; the other scenarios are compared against this one
+BASELINE = {
+    'desert_m': CHARGING_DESERT_M,
+    'poi_radius': POI_RADIUS_M,
+    'road_classes': tuple(MAJOR_ROAD_TYPES),
+    'poi_weight': 1.0,
+}
+
+#Quantiles of the scores of the charging desert cells reported per scenario
+SCORE_QUANTILES = [0.5, 0.9, 0.99]
+
+#State of a worker process, filled in by _init_worker
+_WORKER = {}
+
+
+def scenario_grid(desert_m, poi_radii, road_classes, poi_weights):
+    """
+    Every combination of the given parameter values as a list of scenario dicts, with the baseline first.
+    """
+    scenarios = [dict(BASELINE)]
+    for values in itertools.product(desert_m, poi_radii, road_classes, poi_weights):
+        scenario = dict(zip(['desert_m', 'poi_radius', 'road_classes', 'poi_weight'], values))
+        scenario['road_classes'] = tuple(scenario['road_classes'])
+        if scenario not in scenarios:
+            scenarios.append(scenario)
+    return scenarios
+
+
+def scenario_name(scenario):
+    return (f"desert={scenario['desert_m']:g} radius={scenario['poi_radius']:g} "
+            f"roads={'+'.join(scenario['road_classes'])} poi_weight={scenario['poi_weight']:g}")
+
+
+class FeatureTable:
+    """
+    The column layout of the shared feature table: one float32 column per name, in a (cells, columns) array.
+    Row i is the grid cell with cell ID i (grid.all_cell_ids), so the IDs themselves are not stored.
+    """
+
+    def __init__(self, road_sets, radii):
+        self.road_sets = list(dict.fromkeys(tuple(road_set) for road_set in road_sets))
+        self.radii = sorted(set(radii))
+        self.columns = ['dist_to_nearest_station_m']
+        self.columns += [self.road_column(road_set) for road_set in self.road_sets]
+        self.columns += [self.poi_column(radius) for radius in self.radii]
+        self.columns += [self.prediction_column(road_set, radius) for road_set in self.road_sets for radius in self.radii]
+
+    def road_column(self, road_set):
+        return f"road:{'+'.join(road_set)}"
+
+    def poi_column(self, radius):
+        return f"poi:{radius:g}"
+
+    def prediction_column(self, road_set, radius):
+        return f"predicted:{'+'.join(road_set)}:{radius:g}"
+
+    def index(self, column):
+        return self.columns.index(column)
+
+
+def build_feature_table(layout, gdf_stations, gdf_roads, gdf_pois, model, grid_size=GRID_SIZE, roads_file=None):
+    """
+    Computes every column of the layout for every cell of the grid over the road layer and returns the
+    (cells, columns) float32 array. The model sees the road distance and POI density of each combination in
+    place of its trained road classes and radius.
+    """
+    spec = grid.grid_spec(gdf_roads.total_bounds, grid_size)
+    ids = grid.all_cell_ids(spec)
+    xy = grid.cell_centroids(spec, ids)
+    table = np.empty((len(ids), len(layout.columns)), dtype=np.float32)
+
+    station_xy = point_coords(gdf_stations.geometry)
+    station_dist = dist_to_nearest_station(xy, cKDTree(station_xy) if len(station_xy) else None)
+    table[:, layout.index('dist_to_nearest_station_m')] = station_dist
+
+    points = shapely.points(xy)
+    road_dist = {}
+    for road_set in layout.road_sets:
+        road_tree = shapely.STRtree(select_major_roads(gdf_roads, list(road_set)).geometry.values)
+        road_dist[road_set] = dist_to_major_road(points, road_tree)
+        table[:, layout.index(layout.road_column(road_set))] = road_dist[road_set]
+    #All radii in one pass over the POI KD-tree
+    counts = RadiusCounter(point_coords(gdf_pois.geometry)).count(xy, layout.radii)
+    for radius in layout.radii:
+        table[:, layout.index(layout.poi_column(radius))] = counts[radius]
+
+    inputs = {'dist_to_nearest_station_m': station_dist}
+    if DRIVE_FEATURE in model.features:
+        import road_graph
+
+        drive = road_graph.DriveDistance(road_graph.load_road_graph(gdf_roads, roads_file=roads_file), station_xy)
+        inputs[DRIVE_FEATURE] = drive.query(xy)
+    for road_set in layout.road_sets:
+        for radius in layout.radii:
+            inputs.update({'dist_to_major_road_m': road_dist[road_set], 'poi_density_1.5m': counts[radius]})
+            X = np.column_stack([inputs[feature] for feature in model.features])
+            table[:, layout.index(layout.prediction_column(road_set, radius))] = model.predict(X)
+    return table
+
+
+def _init_worker(table_path, layout, k):
+    #Every worker maps the same file, the OS page cache holds one copy of it
+    _WORKER.update(table=np.load(table_path, mmap_mode='r'), layout=layout, k=k)
+
+
+def evaluate_scenario(scenario):
+    """
+    Filter and score of one scenario over the shared table. Returns its number of charging desert cells,
+    the cell IDs of its top k (best first) and its score distribution.
+    """
+    table, layout = _WORKER['table'], _WORKER['layout']
+    dist = table[:, layout.index('dist_to_nearest_station_m')]
+    deserts = np.flatnonzero(dist > scenario['desert_m'])
+    predicted = table[deserts, layout.index(layout.prediction_column(scenario['road_classes'], scenario['poi_radius']))]
+    poi_density = table[deserts, layout.index(layout.poi_column(scenario['poi_radius']))]
+    scores = suitability_score(dist[deserts].astype(float), predicted.astype(float), poi_density.astype(float), scenario['poi_weight'])
+    best = deserts[top_k.top_k_indices(scores, _WORKER['k'])]
+    distribution = {'mean': float(scores.mean()) if len(scores) else None,
+                    'max': float(scores.max()) if len(scores) else None}
+    for q in SCORE_QUANTILES:
+        distribution[f'p{q * 100:g}'] = float(np.quantile(scores, q)) if len(scores) else None
+    return {
+        'deserts': int(len(deserts)),
+        'top_cell_ids': best.tolist(),
+        'scores': distribution,
+    }
+
+
+def run_sweep(scenarios, table_path, layout, k=top_k.TOP_K, workers=None):
+    """
+    Evaluates every scenario in a worker pool over the memory-mapped table. Returns one result dict per scenario.
+    """
+    context = multiprocessing.get_context('fork') if 'fork' in multiprocessing.get_all_start_methods() else None
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context, initializer=_init_worker,
+                             initargs=(table_path, layout, k)) as executor:
+        return list(executor.map(evaluate_scenario, scenarios))
+
+
+def comparison_report(scenarios, results, k):
+    """
+    One row per scenario: its parameters, number of charging deserts, how many of the baseline's top k it
+    shares (and the Jaccard index of the two top k sets) and its score distribution.
+    """
+    baseline_top = set(results[0]['top_cell_ids'])
+    rows = []
+    for scenario, result in zip(scenarios, results):
+        top = set(result['top_cell_ids'])
+        union = len(top | baseline_top)
+        rows.append({
+            'scenario': scenario_name(scenario),
+            'desert_m': scenario['desert_m'],
+            'poi_radius': scenario['poi_radius'],
+            'road_classes': '+'.join(scenario['road_classes']),
+            'poi_weight': scenario['poi_weight'],
+            'deserts': result['deserts'],
+            f'top{k}_shared_with_baseline': len(top & baseline_top),
+            f'top{k}_jaccard': len(top & baseline_top) / union if union else 1.0,
+            **{f'score_{name}': value for name, value in result['scores'].items()},
+        })
+    return pd.DataFrame(rows)
+
+
+def write_report(report, scenarios, results, report_dir=SCENARIO_REPORT_DIR):
+    """
+    Writes the report as CSV plus a JSON file that also has every scenario's top cell IDs. Returns the JSON path.
+    """
+    name = f"scenario_sweep_{datetime.datetime.now():%Y%m%d_%H%M%S}"
+    storage.atomic_write(os.path.join(report_dir, name + ".csv"), report.to_csv(index=False).encode())
+    path = os.path.join(report_dir, name + ".json")
+    storage.atomic_write(path, json.dumps([{**scenario, 'road_classes': list(scenario['road_classes']), **result}
+                                           for scenario, result in zip(scenarios, results)], indent=2).encode())
+    return path
+
+
+@instrumented_run('scenario_sweep')
+def main():
+    parser = argparse.ArgumentParser(description="Evaluate a grid of scoring parameter sets over shared grid features.")
+    parser.add_argument("--desert-m", type=float, nargs="+", default=[CHARGING_DESERT_M],
+                        help="charging desert distances in meters")
+    parser.add_argument("--poi-radius", type=float, nargs="+", default=[POI_RADIUS_M], help="POI density radii in meters")
+    parser.add_argument("--road-classes", nargs="+", default=[','.join(MAJOR_ROAD_TYPES)],
+                        help="comma separated road class subsets that count as major roads")
+    parser.add_argument("--poi-weight", type=float, nargs="+", default=[1.0], help="weights of the POI bonus in the score")
+    parser.add_argument("--top", type=int, default=top_k.TOP_K, help="number of top locations compared")
+    parser.add_argument("--workers", type=int, default=None, help="number of worker processes (default: all cores)")
+    parser.add_argument("--grid-size", type=float, default=GRID_SIZE, help="cell size in meters")
+    args = parser.parse_args()
+
+    road_classes = [tuple(classes.split(',')) for classes in args.road_classes]
+    scenarios = scenario_grid(args.desert_m, args.poi_radius, road_classes, args.poi_weight)
+    layout = FeatureTable([s['road_classes'] for s in scenarios], [s['poi_radius'] for s in scenarios])
+    print(f"Sweeping {len(scenarios)} scenarios over {len(layout.road_sets)} road class subsets and "
+          f"{len(layout.radii)} POI radii...")
+
+    try:
+        with stage('load_layers') as s:
+            gdf_stations, gdf_roads, gdf_pois = load_layers()
+            model = load_model(MODEL_FILE, drive_distance=True)
+            s.rows = len(gdf_stations) + len(gdf_roads) + len(gdf_pois)
+    except (FileNotFoundError, ValueError) as e:
+        print(f"ERROR: {e}. Please ensure all required files are present.")
+        fail(str(e))
+        return
+
+    #The table only depends on the layers, the model, the grid and the columns, not on the scenarios themselves
+    input_files = [storage.find_layer(name)[0] for name in ('stations', 'roads', 'pois')]
+    key = StageCache().key(
+        'scenario_features', files=input_files + [MODEL_FILE],
+        params={'grid_size': args.grid_size, 'columns': layout.columns}, code=[features, build_feature_table]
+    )
+    table_path = os.path.join(SCENARIO_CACHE_DIR, f"features_{key[:24]}.npy")
+    if os.path.exists(table_path):
+        print(f"Using the shared feature table '{table_path}'.")
+    else:
+        start = time.perf_counter()
+        with stage('build_feature_table') as s:
+            table = build_feature_table(layout, gdf_stations, gdf_roads, gdf_pois, model, args.grid_size,
+                                        roads_file=input_files[1])
+            #A worker never maps a half written table
+            storage.atomic_write(table_path, lambda tmp_path: np.save(tmp_path, table), suffix='.npy')
+            s.rows = len(table)
+        print(f"Computed the shared features of {len(table)} cells ({len(layout.columns)} columns, "
+              f"{table.nbytes / 1e6:.0f} MB) in {time.perf_counter() - start:.1f} s.")
+        del table
+
+    start = time.perf_counter()
+    with stage('evaluate_scenarios', rows=len(scenarios)):
+        results = run_sweep(scenarios, table_path, layout, k=args.top, workers=args.workers)
+    print(f"Evaluated {len(scenarios)} scenarios in {time.perf_counter() - start:.2f} s.")
+
+    report = comparison_report(scenarios, results, args.top)
+    with pd.option_context('display.width', 200, 'display.max_columns', None):
+        print(report.drop(columns=['scenario']).to_string(index=False))
+    print(f"Scenario report saved to '{write_report(report, scenarios, results)}'.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,342 @@
+#Long-lived scoring service for candidate sites
+#Loads the open year model and the road/station/POI spatial indexes once, then scores lists of lat/lon
+#coordinates with the same features, model and suitability score as predict_demand.py.
+#Requests that arrive at the same time are grouped into micro-batches, so the feature lookups and model.predict
+#run once per batch instead of once per request.
+#
+#Start the HTTP service (from the project root):
+#    python scripts/scoring_service.py serve --port 8050
+#Score sites:
+#    curl -X POST localhost:8050/score -d '{"sites": [{"lat": 47.61, "lon": -122.33}, {"lat": 46.6, "lon": -120.5}]}'
+#Load test it (starts an in-process server when no --url is given):
+#    python scripts/scoring_service.py load-test --concurrency 16 --sites-per-request 20 --requests 2000
+#
+#From Python, use SiteScorer directly:
+#    scorer = SiteScorer.from_processed_data()
+#    scorer.score(lats, lons)
+import argparse
+import http.client
+import json
+import queue
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
+
+import numpy as np
+import pandas as pd
+
+from features import DRIVE_FEATURE, FEATURES, TARGET_CRS, FeatureIndex, point_coords, select_major_roads
+import projection
+import storage
+from predict_demand import CHARGING_DESERT_M, MODEL_FILE, load_layers, load_model, suitability_score
+
+#A micro-batch is scored as soon as it holds this many sites...
+MAX_BATCH_SITES = 4096
+#...or when its oldest request waited this long
+MAX_WAIT_MS = 2.0
+
+#Upper bound of the sites accepted in one request
+MAX_SITES_PER_REQUEST = 100_000
+
+#Columns returned for every site (plus DRIVE_FEATURE after the features, for a model that uses it)
+RESULT_COLUMNS = ['lat', 'lon'] + FEATURES + ['predicted_open_year', 'suitability_score', 'charging_desert']
+
+
+class SiteScorer:
+    """
+    Scores candidate sites given as WGS84 lat/lon arrays.
+    The spatial indexes and the model are built once, score() is thread safe (everything is only read).
+    """
+
+    def __init__(self, feature_index, model):
+        self.feature_index = feature_index
+        self.model = model
+        if DRIVE_FEATURE in model.features and feature_index.drive_distance is None:
+            raise ValueError(f"The model uses '{DRIVE_FEATURE}', the feature index needs a road_graph.DriveDistance")
+        self.result_columns = list(RESULT_COLUMNS)
+        if DRIVE_FEATURE in model.features:
+            self.result_columns.insert(2 + len(FEATURES), DRIVE_FEATURE)
+
+    @classmethod
+    def from_processed_data(cls, model_file=MODEL_FILE):
+        """
+        Builds a scorer from the processed layers and the trained model, like predict_demand.py does.
+        A model trained with the drive distance gets the road network drive distances, like in tiled_scoring.py.
+        """
+        model = load_model(model_file, drive_distance=True)
+        gdf_stations, gdf_roads, gdf_pois = load_layers()
+        drive_distance = None
+        if DRIVE_FEATURE in model.features:
+            import road_graph
+
+            print("Labelling the road network with drive distances to the nearest station...")
+            graph = road_graph.load_road_graph(gdf_roads, roads_file=storage.find_layer('roads')[0])
+            drive_distance = road_graph.DriveDistance(graph, point_coords(gdf_stations.geometry))
+        feature_index = FeatureIndex(select_major_roads(gdf_roads), gdf_stations, gdf_pois, drive_distance)
+        return cls(feature_index, model)
+
+    def score(self, lats, lons):
+        """
+        Returns a DataFrame with the result columns, one row per site, in the order of the input.
+        The features come from FeatureIndex.compute(), the same code as for the training stations and the grid.
+        """
+        lats = np.asarray(lats, dtype=float)
+        lons = np.asarray(lons, dtype=float)
+        xy = projection.transform_xy(np.column_stack([lons, lats]), "EPSG:4326", TARGET_CRS)
+
+        features = self.feature_index.compute(xy)
+        #The rest stays in NumPy arrays until the end: for the small batches of an online service the DataFrame
+        #bookkeeping would cost more than the lookups
+        columns = {'lat': lats, 'lon': lons, **{column: features[column].to_numpy() for column in features.columns}}
+        #Same column order as training
+        X = np.column_stack([columns[feature] for feature in self.model.features])
+        columns['predicted_open_year'] = self.model.predict(X)
+        columns['suitability_score'] = suitability_score(
+            columns['dist_to_nearest_station_m'], columns['predicted_open_year'], columns['poi_density_1.5m']
+        )
+        columns['charging_desert'] = columns['dist_to_nearest_station_m'] > CHARGING_DESERT_M
+        return pd.DataFrame(columns, columns=self.result_columns)
+
+
+class MicroBatcher:
+    """
+    Groups concurrent score requests into batches for a SiteScorer.
+    submit() returns a Future right away, a background thread scores the queued requests together
+    (up to max_batch_sites sites, waiting at most max_wait_ms for more to arrive) and resolves the futures.
+    """
+
+    def __init__(self, scorer, max_batch_sites=MAX_BATCH_SITES, max_wait_ms=MAX_WAIT_MS):
+        self.scorer = scorer
+        self.max_batch_sites = max_batch_sites
+        self.max_wait = max_wait_ms / 1000
+        self.requests = queue.Queue()
+        self.batches = 0
+        self.thread = threading.Thread(target=self._run, name="micro-batcher", daemon=True)
+        self.thread.start()
+
+    def submit(self, lats, lons):
+        future = Future()
+        self.requests.put((np.asarray(lats, dtype=float), np.asarray(lons, dtype=float), future))
+        return future
+
+    def score(self, lats, lons):
+        return self.submit(lats, lons).result()
+
+    def _collect(self):
+        #Blocks for the first request, then keeps adding requests until the batch is full or the wait is over
+        batch = [self.requests.get()]
+        n_sites = len(batch[0][0])
+        deadline = time.perf_counter() + self.max_wait
+        while n_sites < self.max_batch_sites:
+            timeout = deadline - time.perf_counter()
+            try:
+                request = self.requests.get(timeout=timeout) if timeout > 0 else self.requests.get_nowait()
+            except queue.Empty:
+                break
+            batch.append(request)
+            n_sites += len(request[0])
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            try:
+                results = self.scorer.score(np.concatenate([r[0] for r in batch]), np.concatenate([r[1] for r in batch]))
+            except Exception as e:
+                for _, _, future in batch:
+                    future.set_exception(e)
+                continue
+            self.batches += 1
+            start = 0
+            for lats, _, future in batch:
+                future.set_result(results.iloc[start:start + len(lats)].reset_index(drop=True))
+                start += len(lats)
+
+
+def parse_sites(payload):
+    """
+    Accepts {"sites": [{"lat": .., "lon": ..}, ...]} or {"lat": [...], "lon": [...]} and returns (lats, lons).
+    Raises ValueError for anything else.
+    """
+    if 'sites' in payload:
+        sites = payload['sites']
+        lats = [site['lat'] for site in sites]
+        lons = [site['lon'] for site in sites]
+    else:
+        lats, lons = payload['lat'], payload['lon']
+    lats = np.asarray(lats, dtype=float)
+    lons = np.asarray(lons, dtype=float)
+    if lats.ndim != 1 or lats.shape != lons.shape:
+        raise ValueError("'lat' and 'lon' must be lists of the same length")
+    if len(lats) > MAX_SITES_PER_REQUEST:
+        raise ValueError(f"At most {MAX_SITES_PER_REQUEST} sites per request")
+    if not (np.isfinite(lats).all() and np.isfinite(lons).all()):
+        raise ValueError("Coordinates must be finite numbers")
+    if (np.abs(lats) > 90).any() or (np.abs(lons) > 180).any():
+        raise ValueError("Coordinates must be WGS84 latitudes and longitudes")
+    return lats, lons
+
+
+def make_handler(batcher):
+    class ScoreHandler(BaseHTTPRequestHandler):
+        #Keep-alive connections, so clients do not pay for a TCP handshake per request
+        protocol_version = "HTTP/1.1"
+
+        def _send(self, status, body):
+            data = body.encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            if self.path == "/health":
+                self._send(200, json.dumps({'status': 'ok', 'batches': batcher.batches}))
+            else:
+                self._send(404, json.dumps({'error': 'not found'}))
+
+        def do_POST(self):
+            if self.path != "/score":
+                self._send(404, json.dumps({'error': 'not found'}))
+                return
+            try:
+                length = int(self.headers.get("Content-Length", 0))
+                lats, lons = parse_sites(json.loads(self.rfile.read(length)))
+            except KeyError as e:
+                self._send(400, json.dumps({'error': f"missing field {e}"}))
+                return
+            except (ValueError, TypeError) as e:
+                self._send(400, json.dumps({'error': str(e)}))
+                return
+            try:
+                results = batcher.score(lats, lons)
+            except Exception as e:
+                self._send(500, json.dumps({'error': str(e)}))
+                return
+            self._send(200, '{"results": ' + results.to_json(orient='records', double_precision=6) + '}')
+
+        def log_message(self, format, *args):
+            #One log line per request would cost more than scoring it
+            pass
+
+    return ScoreHandler
+
+
+class ScoringServer(ThreadingHTTPServer):
+    daemon_threads = True
+    #Room for many clients connecting at once, the default backlog of 5 drops connections under load
+    request_queue_size = 256
+
+
+def make_server(batcher, host="127.0.0.1", port=8050):
+    return ScoringServer((host, port), make_handler(batcher))
+
+
+def load_test(url, n_requests=2000, concurrency=16, sites_per_request=20, bounds=(-124.7, 45.6, -116.9, 49.0), seed=0):
+    """
+    Sends n_requests POST /score requests with random sites inside bounds (lon/lat) from concurrency threads,
+    each on its own keep-alive connection. Returns a dict with throughput and latency percentiles.
+    """
+    parsed = urlparse(url)
+    rng = np.random.default_rng(seed)
+    bodies = [
+        json.dumps({
+            'lat': rng.uniform(bounds[1], bounds[3], sites_per_request).tolist(),
+            'lon': rng.uniform(bounds[0], bounds[2], sites_per_request).tolist(),
+        })
+        for _ in range(min(n_requests, 256))
+    ]
+    latencies = np.zeros(n_requests)
+    errors = []
+
+    def worker(thread_no):
+        connection = http.client.HTTPConnection(parsed.hostname, parsed.port)
+        for i in range(thread_no, n_requests, concurrency):
+            start = time.perf_counter()
+            connection.request("POST", "/score", body=bodies[i % len(bodies)], headers={"Content-Type": "application/json"})
+            response = connection.getresponse()
+            response.read()
+            latencies[i] = time.perf_counter() - start
+            if response.status != 200:
+                errors.append(response.status)
+        connection.close()
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(worker, range(concurrency)))
+    elapsed = time.perf_counter() - start
+
+    return {
+        'requests': n_requests,
+        'sites': n_requests * sites_per_request,
+        'errors': len(errors),
+        'seconds': elapsed,
+        'requests_per_s': n_requests / elapsed,
+        'sites_per_s': n_requests * sites_per_request / elapsed,
+        'p50_ms': float(np.percentile(latencies, 50) * 1000),
+        'p90_ms': float(np.percentile(latencies, 90) * 1000),
+        'p99_ms': float(np.percentile(latencies, 99) * 1000),
+        'max_ms': float(latencies.max() * 1000),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Score candidate charging station sites over HTTP.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    serve_parser = subparsers.add_parser("serve", help="run the scoring service")
+    serve_parser.add_argument("--host", default="127.0.0.1")
+    serve_parser.add_argument("--port", type=int, default=8050)
+    serve_parser.add_argument("--max-batch-sites", type=int, default=MAX_BATCH_SITES)
+    serve_parser.add_argument("--max-wait-ms", type=float, default=MAX_WAIT_MS)
+    test_parser = subparsers.add_parser("load-test", help="measure throughput and latency of the service")
+    test_parser.add_argument("--url", default=None, help="service to test, an in-process server is started if omitted")
+    test_parser.add_argument("--requests", type=int, default=2000)
+    test_parser.add_argument("--concurrency", type=int, default=16)
+    test_parser.add_argument("--sites-per-request", type=int, default=20)
+    args = parser.parse_args()
+
+    server = None
+    url = getattr(args, 'url', None)
+    if args.command == "serve" or url is None:
+        print("Loading the model and building the spatial indexes...")
+        start = time.perf_counter()
+        try:
+            scorer = SiteScorer.from_processed_data()
+        except FileNotFoundError as e:
+            print(f"ERROR: {e}. Run the preprocessing scripts and forecast_demand.py first.")
+            return
+        except ValueError as e:
+            #e.g. a model trained on other features than FEATURES (optionally plus the drive distance)
+            print(f"ERROR: {e}.")
+            return
+        print(f"Ready in {time.perf_counter() - start:.1f} s.")
+        batcher = MicroBatcher(scorer, getattr(args, 'max_batch_sites', MAX_BATCH_SITES), getattr(args, 'max_wait_ms', MAX_WAIT_MS))
+        server = make_server(batcher, getattr(args, 'host', "127.0.0.1"), getattr(args, 'port', 0))
+
+    if args.command == "serve":
+        host, port = server.server_address[:2]
+        print(f"Scoring service listening on http://{host}:{port} (POST /score, GET /health)")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            server.shutdown()
+        return
+
+    if server is not None:
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        host, port = server.server_address[:2]
+        url = f"http://{host}:{port}"
+    print(f"Load testing {url} with {args.requests} requests of {args.sites_per_request} sites, {args.concurrency} at a time...")
+    report = load_test(url, args.requests, args.concurrency, args.sites_per_request)
+    print(f"{report['requests_per_s']:.0f} requests/s, {report['sites_per_s']:.0f} sites/s, {report['errors']} errors")
+    print(f"latency p50 {report['p50_ms']:.1f} ms, p90 {report['p90_ms']:.1f} ms, "
+          f"p99 {report['p99_ms']:.1f} ms, max {report['max_ms']:.1f} ms")
+    if server is not None:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,266 @@
+#On-disk cache for the results of pipeline stages
+#Every stage result is stored under a key that hashes everything the result depends on: the content of its
+#input files, the keys of the stages it builds on, its parameters and the source code of the functions involved.
+#If none of those changed, rerunning the stage is a cache hit and the stored result is returned right away.
+#The cache has a size cap and evicts the least recently used results first.
+#
+#Inspect or clear it from the command line:
+#    python scripts/stage_cache.py list
+#    python scripts/stage_cache.py info
+#    python scripts/stage_cache.py clear [--stage NAME]
+import argparse
+import hashlib
+import inspect
+import json
+import os
+import pickle
+import time
+
+import storage
+
+CACHE_DIR = os.getenv("EV_CACHE_DIR", ".cache/stages")
+
+#Default size cap of the cache, 5 GB unless EV_CACHE_MAX_BYTES says otherwise
+CACHE_MAX_BYTES = int(os.getenv("EV_CACHE_MAX_BYTES", 5 * 1024 ** 3))
+
+#Bump this to invalidate every cached result at once, e.g. after changing the pickle format
+CACHE_VERSION = 1
+
+_HASH_CHUNK_BYTES = 1024 * 1024
+
+
+def file_digest(path, memo=None):
+    """
+    SHA-256 of the content of a file.
+    When a memo dict is given, digests are remembered by (size, modification time), so unchanged
+    large inputs are only read once.
+    """
+    path = os.path.abspath(path)
+    stat = os.stat(path)
+    if memo is not None:
+        known = memo.get(path)
+        if known and known[0] == stat.st_size and known[1] == stat.st_mtime_ns:
+            return known[2]
+
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(_HASH_CHUNK_BYTES), b''):
+            digest.update(chunk)
+    digest = digest.hexdigest()
+    if memo is not None:
+        memo[path] = [stat.st_size, stat.st_mtime_ns, digest]
+    return digest
+
+
+def code_version(*objects):
+    """
+    Hash of the source code of the given functions, classes or modules.
+    Any edit to them changes the hash, which invalidates the cached results that depend on them.
+    """
+    digest = hashlib.sha256()
+    for obj in objects:
+        try:
+            digest.update(inspect.getsource(obj).encode())
+        except (OSError, TypeError):
+            digest.update(repr(obj).encode())
+    return digest.hexdigest()
+
+
+class StageCache:
+    """
+    Content-hashed store for stage results.
+    The key of a stage is built from its name, input files, upstream stage keys, parameters and code version.
+    The in-memory arguments of a stage are not hashed, so everything a stage result depends on
+    must be declared through those four.
+    """
+
+    def __init__(self, cache_dir=CACHE_DIR, max_bytes=CACHE_MAX_BYTES, enabled=True):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.enabled = enabled
+        self._memo_path = os.path.join(cache_dir, "file_digests.json")
+        self._memo = None
+
+    def _file_memo(self):
+        if self._memo is None:
+            try:
+                with open(self._memo_path) as f:
+                    self._memo = json.load(f)
+            except (OSError, ValueError):
+                self._memo = {}
+        return self._memo
+
+    def _save_file_memo(self):
+        #A disabled cache (--no-cache) still computes keys, but writes nothing to the cache directory
+        if self._memo is not None and self.enabled:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            storage.atomic_write(self._memo_path, json.dumps(self._memo).encode())
+
+    def key(self, stage, files=(), depends=(), params=None, code=()):
+        """
+        Returns the cache key of a stage.
+        files are input file paths (hashed by content), depends are keys of upstream stages,
+        params is a JSON serializable dict and code the functions/modules whose source the result depends on.
+        """
+        memo = self._file_memo()
+        payload = {
+            'version': CACHE_VERSION,
+            'stage': stage,
+            'files': sorted(file_digest(path, memo) for path in files),
+            'depends': list(depends),
+            'params': params or {},
+            'code': code_version(*code) if code else None,
+        }
+        self._save_file_memo()
+        return hashlib.sha256(json.dumps(payload, sort_keys=True, default=str).encode()).hexdigest()
+
+    def _value_path(self, key):
+        return os.path.join(self.cache_dir, key + ".pkl")
+
+    def _info_path(self, key):
+        return os.path.join(self.cache_dir, key + ".json")
+
+    def get(self, key):
+        """
+        Returns (True, value) on a cache hit and (False, None) on a miss.
+        """
+        if not self.enabled:
+            return False, None
+        path = self._value_path(key)
+        try:
+            with open(path, 'rb') as f:
+                value = pickle.load(f)
+        except (OSError, pickle.UnpicklingError, EOFError):
+            return False, None
+        #The modification time of the value file is the "last used" time for the LRU eviction
+        os.utime(path)
+        return True, value
+
+    def put(self, key, value, stage=None):
+        """
+        Stores a stage result and evicts old results if the cache grew beyond its size cap.
+        """
+        if not self.enabled:
+            return
+        os.makedirs(self.cache_dir, exist_ok=True)
+        data = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        storage.atomic_write(self._value_path(key), data)
+        info = {'stage': stage, 'created': time.time(), 'bytes': len(data)}
+        storage.atomic_write(self._info_path(key), json.dumps(info).encode())
+        self.evict()
+
+    def run(self, stage, fn, *args, files=(), depends=(), params=None, code=(), **kwargs):
+        """
+        Returns (result, key) of fn(*args, **kwargs), taken from the cache when the stage key is known.
+        The code of fn itself is always part of the key.
+        """
+        key = self.key(stage, files=files, depends=depends, params=params, code=(fn,) + tuple(code))
+        hit, value = self.get(key)
+        if hit:
+            print(f"  [cache] {stage}: hit ({key[:12]})")
+            return value, key
+        value = fn(*args, **kwargs)
+        self.put(key, value, stage=stage)
+        return value, key
+
+    def entries(self):
+        """
+        Lists the cached results as dicts (key, stage, bytes, created, last_used), most recently used first.
+        """
+        entries = []
+        if not os.path.isdir(self.cache_dir):
+            return entries
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith(".pkl"):
+                continue
+            key = name[:-4]
+            try:
+                stat = os.stat(self._value_path(key))
+            except OSError:
+                continue
+            try:
+                with open(self._info_path(key)) as f:
+                    info = json.load(f)
+            except (OSError, ValueError):
+                info = {}
+            entries.append({
+                'key': key,
+                'stage': info.get('stage'),
+                'bytes': stat.st_size,
+                'created': info.get('created'),
+                'last_used': stat.st_mtime,
+            })
+        entries.sort(key=lambda entry: entry['last_used'], reverse=True)
+        return entries
+
+    def remove(self, key):
+        for path in (self._value_path(key), self._info_path(key)):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def evict(self):
+        """
+        Removes the least recently used results until the cache fits in max_bytes.
+        """
+        entries = self.entries()
+        total = sum(entry['bytes'] for entry in entries)
+        while entries and total > self.max_bytes:
+            entry = entries.pop()
+            self.remove(entry['key'])
+            total -= entry['bytes']
+
+    def clear(self, stage=None):
+        """
+        Removes all cached results, or only those of one stage. Returns the number of removed results.
+        """
+        removed = 0
+        for entry in self.entries():
+            if stage is None or entry['stage'] == stage:
+                self.remove(entry['key'])
+                removed += 1
+        if stage is None:
+            try:
+                os.remove(self._memo_path)
+            except FileNotFoundError:
+                pass
+            self._memo = None
+        return removed
+
+
+def _format_bytes(n):
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if n < 1024:
+            return f"{n:.1f} {unit}"
+        n /= 1024
+    return f"{n:.1f} TB"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Inspect or clear the pipeline stage cache.")
+    parser.add_argument("--cache-dir", default=CACHE_DIR)
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    subparsers.add_parser("list", help="list cached stage results, most recently used first")
+    subparsers.add_parser("info", help="show the size of the cache")
+    clear_parser = subparsers.add_parser("clear", help="remove cached results")
+    clear_parser.add_argument("--stage", default=None, help="only remove the results of this stage")
+    args = parser.parse_args()
+
+    cache = StageCache(args.cache_dir)
+    if args.command == "list":
+        for entry in cache.entries():
+            last_used = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(entry['last_used']))
+            print(f"{entry['key'][:12]}  {str(entry['stage']):<28} {_format_bytes(entry['bytes']):>10}  {last_used}")
+    elif args.command == "info":
+        entries = cache.entries()
+        total = sum(entry['bytes'] for entry in entries)
+        print(f"Cache directory: {cache.cache_dir}")
+        print(f"{len(entries)} results, {_format_bytes(total)} of {_format_bytes(cache.max_bytes)}")
+    else:
+        removed = cache.clear(args.stage)
+        print(f"Removed {removed} cached results.")
+
+
+if __name__ == "__main__":
+    main()
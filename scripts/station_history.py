@@ -0,0 +1,197 @@
+#As-of store of the AFDC station history
+#The ingested history (preprocess_data.py) holds one row per station per snapshot, and the station layer only keeps
+#one record per ID, so "which stations existed on date X" needed a full scan of every snapshot. This module collapses
+#the snapshots into intervals: one row per version of a station, valid from the snapshot it first appeared in (or its
+#'Open Date', if that is earlier) until the first snapshot it was missing from or had changed in (NaT = still open).
+#The intervals are stored as the 'station_history' table, sorted by valid_from, so stations_as_of(date) is a
+#binary search plus one vectorized comparison. Coordinates are also stored in TARGET_CRS, ready for the features.
+#
+#Rebuild the store after new snapshots were ingested (preprocess_data.py does this at the end of every run):
+#    python scripts/station_history.py build
+#Train with features against the stations that existed when each station opened with
+#    python scripts/forecast_demand.py --as-of-features
+#and backtest the ranking against the stations of a past date with python scripts/predict_demand.py --as-of 2024-01-01
+import argparse
+import functools
+import time
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import shapely
+
+import projection
+import storage
+from features import TARGET_CRS
+
+#A station gets a new version when one of these changes between two snapshots
+TRACKED_COLUMNS = ['Latitude', 'Longitude', 'EV Level1 EVSE Num', 'EV Level2 EVSE Num', 'EV DC Fast Count',
+                   'EV Network', 'Facility Type', 'Open Date']
+
+#valid_to of versions that are still open, so the as-of comparison needs no special case
+OPEN_END = np.datetime64('9999-12-31', 's')
+
+
+def snapshot_dates(history):
+    """
+    The snapshot date of every row of the ingested history. Rows of files whose name has no parsable date
+    get December 31 of their 'Year' partition.
+    """
+    dates = pd.to_datetime(history['snapshot_date'])
+    if 'Year' in history.columns:
+        year_end = pd.to_datetime(history['Year'].astype(int).astype(str) + '-12-31')
+        dates = dates.fillna(year_end)
+    return dates
+
+
+def build_intervals(history):
+    """
+    Collapses the rows of the ingested history (one per station and snapshot) into one row per station version with
+    valid_from/valid_to, plus x/y in TARGET_CRS. Returns (intervals sorted by valid_from, sorted snapshot dates).
+    """
+    history = history.dropna(subset=['ID', 'Latitude', 'Longitude']).copy()
+    history['snapshot_date'] = snapshot_dates(history)
+    history = history.dropna(subset=['snapshot_date'])
+    snapshots = np.sort(history['snapshot_date'].unique())
+    history['snapshot_no'] = np.searchsorted(snapshots, history['snapshot_date'].to_numpy())
+    #One row per station and snapshot (a station listed twice in one snapshot keeps its last row)
+    history = history.sort_values(['ID', 'snapshot_no'], kind='stable').drop_duplicates(['ID', 'snapshot_no'], keep='last')
+    history = history.reset_index(drop=True)
+
+    #A new version starts at a new ID, after a snapshot the station was missing from, or when a tracked column changed
+    tracked = history[[column for column in TRACKED_COLUMNS if column in history.columns]]
+    previous = tracked.shift()
+    changed = ~((tracked == previous) | (tracked.isna() & previous.isna())).all(axis=1)
+    ids = history['ID'].to_numpy()
+    snapshot_no = history['snapshot_no'].to_numpy()
+    new_version = np.ones(len(history), dtype=bool)
+    new_version[1:] = (ids[1:] != ids[:-1]) | (snapshot_no[1:] != snapshot_no[:-1] + 1) | changed.to_numpy()[1:]
+
+    first = np.flatnonzero(new_version)
+    last = np.append(first[1:], len(history)) - 1
+    intervals = history.iloc[first].drop(columns=['snapshot_date', 'snapshot_no', 'Year'], errors='ignore')
+    intervals = intervals.reset_index(drop=True)
+    intervals['valid_from'] = snapshots[snapshot_no[first]]
+    ends = snapshot_no[last] + 1
+    intervals['valid_to'] = pd.Series(snapshots[np.minimum(ends, len(snapshots) - 1)]).where(ends < len(snapshots))
+
+    #The first version of a station starts at its opening if that is before the first snapshot it is listed in
+    first_version = np.ones(len(intervals), dtype=bool)
+    first_version[1:] = ids[first][1:] != ids[first][:-1]
+    if 'Open Date' in intervals.columns:
+        opened = pd.to_datetime(intervals['Open Date'], errors='coerce').to_numpy()
+        earlier = first_version & ~np.isnat(opened) & (opened < intervals['valid_from'].to_numpy())
+        intervals.loc[earlier, 'valid_from'] = opened[earlier]
+
+    xy = projection.transform_xy(intervals[['Longitude', 'Latitude']].to_numpy(dtype=float), "EPSG:4326", TARGET_CRS)
+    intervals['x'], intervals['y'] = xy[:, 0], xy[:, 1]
+    #Versions of a station are numbered from 0 in time order (the rows are still sorted by ID and snapshot here)
+    intervals['version'] = intervals.groupby('ID').cumcount()
+    intervals = intervals.sort_values(['valid_from', 'ID'], kind='stable').reset_index(drop=True)
+    return intervals, snapshots
+
+
+def build(base_path=storage.PROCESSED_DATA_PATH):
+    """
+    Builds the 'station_history' table from the ingested AFDC history in base_path and returns its path.
+    """
+    #Imported here because it pulls in the CSV reader, which reading the store never needs
+    from preprocess_data import read_afdc_history
+
+    intervals, snapshots = build_intervals(read_afdc_history(base_path=base_path))
+    metadata = {
+        'snapshots': [str(pd.Timestamp(date).date()) for date in snapshots],
+        'crs': TARGET_CRS,
+    }
+    path = storage.write_table(intervals, 'station_history', metadata=metadata, base_path=base_path)
+    load.cache_clear()
+    return path
+
+
+class StationHistory:
+    """
+    The station intervals as NumPy arrays, for fast as-of queries.
+    """
+
+    def __init__(self, intervals):
+        self.intervals = intervals.sort_values('valid_from', kind='stable').reset_index(drop=True)
+        self.valid_from = self.intervals['valid_from'].to_numpy(dtype='datetime64[s]')
+        valid_to = self.intervals['valid_to'].to_numpy(dtype='datetime64[s]')
+        self.valid_to = np.where(np.isnat(valid_to), OPEN_END, valid_to)
+        self.ids = self.intervals['ID'].to_numpy()
+        self.xy = self.intervals[['x', 'y']].to_numpy(dtype=float)
+
+    def positions_as_of(self, date):
+        """
+        Rows of the intervals that are valid on date (valid_from <= date < valid_to).
+        """
+        date = np.datetime64(pd.Timestamp(date), 's')
+        #Only rows that started by then can be valid, and they are a prefix of the sorted table
+        started = np.searchsorted(self.valid_from, date, side='right')
+        return np.flatnonzero(self.valid_to[:started] > date)
+
+    def stations_as_of(self, date):
+        """
+        (IDs, (N, 2) coordinates in TARGET_CRS) of the stations that existed on date.
+        """
+        positions = self.positions_as_of(date)
+        return self.ids[positions], self.xy[positions]
+
+    def stations_gdf_as_of(self, date):
+        """
+        The stations that existed on date as a point GeoDataFrame in TARGET_CRS (like the station layer).
+        """
+        positions = self.positions_as_of(date)
+        records = self.intervals.iloc[positions].reset_index(drop=True)
+        return gpd.GeoDataFrame(records, geometry=shapely.points(self.xy[positions]), crs=TARGET_CRS)
+
+
+@functools.lru_cache(maxsize=4)
+def load(base_path=storage.PROCESSED_DATA_PATH):
+    """
+    The StationHistory stored in base_path, read once per process.
+    Raises FileNotFoundError when the store was not built yet.
+    """
+    return StationHistory(storage.read_table('station_history', base_path=base_path))
+
+
+def stations_as_of(date, base_path=storage.PROCESSED_DATA_PATH):
+    """
+    (IDs, (N, 2) coordinates in TARGET_CRS) of the stations that existed on date.
+    """
+    return load(base_path).stations_as_of(date)
+
+
+def stations_gdf_as_of(date, base_path=storage.PROCESSED_DATA_PATH):
+    """
+    The stations that existed on date as a point GeoDataFrame in TARGET_CRS.
+    """
+    return load(base_path).stations_gdf_as_of(date)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build or query the as-of store of the AFDC station history.")
+    parser.add_argument("command", choices=["build", "info", "as-of"])
+    parser.add_argument("date", nargs="?", help="date for the as-of command, e.g. 2024-01-01")
+    args = parser.parse_args()
+
+    if args.command == "build":
+        start = time.perf_counter()
+        path = build()
+        print(f"Built '{path}' in {time.perf_counter() - start:.2f} s.")
+    history = load()
+    if args.command == "as-of":
+        if not args.date:
+            parser.error("the as-of command needs a date")
+        start = time.perf_counter()
+        ids, _ = history.stations_as_of(args.date)
+        print(f"{len(ids)} stations existed on {args.date} ({(time.perf_counter() - start) * 1000:.2f} ms).")
+        return
+    metadata = storage.read_table_metadata('station_history')
+    snapshots = metadata.get('snapshots', [])
+    print(f"{len(history.ids)} versions of {len(np.unique(history.ids))} stations from {len(snapshots)} snapshots"
+          + (f" ({snapshots[0]} to {snapshots[-1]})." if snapshots else "."))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,264 @@
+#Storage of the intermediate layers of the pipeline
+#Every script reads and writes its layers through this module, so file names and the file format
+#are chosen in one place. GeoParquet is the default: it is columnar (we can read just the columns we need),
+#compressed and much faster to parse than GeoJSON. Feather and GeoJSON are still supported.
+#geopandas and pyarrow are imported inside the functions that read or write, so the path helpers can be used
+#(e.g. by pipeline.py to check which outputs are up to date) without loading them.
+import json
+import os
+import tempfile
+
+#Every path is relative to the project root, the scripts are run from there
+RAW_DATA_PATH = "data/raw/"
+PROCESSED_DATA_PATH = "data/processed/"
+
+#Format used for the intermediate layers: "parquet" (GeoParquet), "feather" or "geojson".
+#It can be overridden with the EV_DATA_FORMAT environment variable.
+DATA_FORMAT = os.getenv("EV_DATA_FORMAT", "parquet")
+
+FORMAT_EXTENSIONS = {
+    'parquet': '.parquet',
+    'feather': '.feather',
+    'geojson': '.geojson',
+}
+
+#Logical layer names and the file name (without extension) they are stored under
+LAYERS = {
+    'osm_charging_stations': 'chargingStationWashington_cleaned',
+    'amenities': 'amenitiesWashington_cleaned',
+    'roads': 'majorRoadsWashington_cleaned',
+    'leisure': 'leisureWashington_cleaned',
+    'shops': 'shopsWashington_cleaned',
+    'residential': 'residentialWashington_cleaned',
+    'pois': 'all_pois_Washington',
+    'stations': 'afdc_unique_stations_with_features',
+    'ranked_locations': 'ranked_optimal_locations',
+    'top_locations': 'top_charging_locations',
+    'placement_plan': 'placement_plan',
+}
+
+#Non-spatial tables, always stored as Parquet
+TABLES = {
+    'grid_features': 'grid_features',
+    'openings_forecast': 'monthly_openings_forecast',
+    'station_history': 'afdc_station_history',
+    'explanations': 'cell_explanations',
+}
+
+#Partitioned Parquet datasets (directories of Parquet files)
+DATASETS = {
+    'afdc_history': 'afdc_history',
+}
+
+
+def layer_path(name, fmt=None, base_path=PROCESSED_DATA_PATH):
+    """
+    Path of a layer in the given format (DATA_FORMAT by default).
+    """
+    fmt = fmt or DATA_FORMAT
+    if fmt not in FORMAT_EXTENSIONS:
+        raise ValueError(f"Unknown data format '{fmt}', expected one of {sorted(FORMAT_EXTENSIONS)}")
+    return os.path.join(base_path, LAYERS.get(name, name) + FORMAT_EXTENSIONS[fmt])
+
+
+def find_layer(name, base_path=PROCESSED_DATA_PATH):
+    """
+    Returns (path, format) of a stored layer. The configured DATA_FORMAT is preferred, but a layer that
+    only exists in another format (e.g. GeoJSON written by the notebooks) is found as well.
+    Raises FileNotFoundError when the layer does not exist in any format.
+    """
+    formats = [DATA_FORMAT] + [fmt for fmt in FORMAT_EXTENSIONS if fmt != DATA_FORMAT]
+    for fmt in formats:
+        path = layer_path(name, fmt, base_path)
+        if os.path.exists(path):
+            return path, fmt
+    raise FileNotFoundError(f"Layer '{name}' not found in '{base_path}' (looked for {', '.join(formats)})")
+
+
+def read_layer(name, columns=None, bbox=None, base_path=PROCESSED_DATA_PATH):
+    """
+    Reads a layer as a GeoDataFrame.
+    columns limits the attribute columns that are read (the geometry is always read),
+    bbox (xmin, ymin, xmax, ymax, in the layer's CRS) only returns the features that intersect it.
+    With GeoParquet both filters are applied while reading, so unused columns and row groups are never parsed.
+    """
+    import geopandas as gpd
+
+    path, fmt = find_layer(name, base_path)
+    attributes = [column for column in columns if column != 'geometry'] if columns is not None else None
+
+    if fmt == 'parquet':
+        return gpd.read_parquet(path, columns=None if attributes is None else attributes + ['geometry'], bbox=bbox)
+    if fmt == 'feather':
+        gdf = gpd.read_feather(path, columns=None if attributes is None else attributes + ['geometry'])
+        return gdf.cx[bbox[0]:bbox[2], bbox[1]:bbox[3]] if bbox is not None else gdf
+    return gpd.read_file(path, columns=attributes, bbox=tuple(bbox) if bbox is not None else None)
+
+
+def write_layer(gdf, name, fmt=None, base_path=PROCESSED_DATA_PATH):
+    """
+    Writes a GeoDataFrame as a layer (atomically, see atomic_write) and returns the path it was written to.
+    GeoParquet files get a bounding box column, which is what makes bbox-filtered reads fast.
+    """
+    fmt = fmt or DATA_FORMAT
+    path = layer_path(name, fmt, base_path)
+    if fmt == 'parquet':
+        write = lambda tmp_path: gdf.to_parquet(tmp_path, index=False, write_covering_bbox=True)
+    elif fmt == 'feather':
+        write = lambda tmp_path: gdf.to_feather(tmp_path, index=False)
+    else:
+        write = lambda tmp_path: gdf.to_file(tmp_path, driver='GeoJSON')
+    return atomic_write(path, write, suffix=FORMAT_EXTENSIONS[fmt])
+
+
+def _temp_file(path, suffix='.tmp'):
+    """
+    Creates a hidden temporary file in the directory of path (creating the directory) and returns (fd, its path).
+    """
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    return tempfile.mkstemp(dir=os.path.dirname(path) or '.', prefix='.' + os.path.basename(path) + '.', suffix=suffix)
+
+
+def atomic_write(path, data, suffix='.tmp'):
+    """
+    Writes a file next to path and renames it over path, so a crash never leaves a half written file and readers
+    (cache lookups, dashboard workers mapping the file) only ever see a complete one.
+    data is either bytes, or a function that writes the file given its temporary path (e.g. np.save); suffix is the
+    extension of the temporary file, for writers that add their own extension when it is missing. The temporary
+    file is hidden (its name starts with a dot), so directory readers like pyarrow datasets skip it.
+    """
+    fd, tmp_path = _temp_file(path, suffix)
+    try:
+        if callable(data):
+            os.close(fd)
+            data(tmp_path)
+        else:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return path
+
+
+def table_path(name, base_path=PROCESSED_DATA_PATH):
+    """
+    Path of a non-spatial table.
+    """
+    return os.path.join(base_path, TABLES.get(name, name) + '.parquet')
+
+
+def dataset_path(name, base_path=PROCESSED_DATA_PATH):
+    """
+    Directory of a partitioned Parquet dataset.
+    """
+    return os.path.join(base_path, DATASETS.get(name, name))
+
+
+def write_table(df, name, metadata=None, base_path=PROCESSED_DATA_PATH, row_group_size=None):
+    """
+    Writes a DataFrame as a Parquet table (atomically, see atomic_write) and returns its path.
+    metadata is an optional JSON serializable dict stored in the file footer (read it back with read_table_metadata).
+    Small row groups (row_group_size rows) let filtered reads of a table sorted by the filter column skip most of it.
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    if metadata is not None:
+        table = table.replace_schema_metadata({**(table.schema.metadata or {}), b'ev_metadata': json.dumps(metadata).encode()})
+    return atomic_write(table_path(name, base_path), lambda tmp_path: pq.write_table(table, tmp_path, row_group_size=row_group_size))
+
+
+def read_table(name, columns=None, base_path=PROCESSED_DATA_PATH, filters=None):
+    """
+    Reads a Parquet table written by write_table, optionally only some of its columns.
+    filters (pyarrow filters, e.g. [('cell_id', '==', 42)]) only returns the matching rows and skips
+    row groups that cannot hold any.
+    """
+    import pandas as pd
+
+    return pd.read_parquet(table_path(name, base_path), columns=columns, filters=filters)
+
+
+def read_table_metadata(name, base_path=PROCESSED_DATA_PATH):
+    """
+    Returns the metadata dict stored with a table by write_table (empty if there is none).
+    """
+    import pyarrow.parquet as pq
+
+    metadata = pq.read_schema(table_path(name, base_path)).metadata or {}
+    return json.loads(metadata[b'ev_metadata']) if b'ev_metadata' in metadata else {}
+
+
+def geoparquet_metadata(geometry_type, crs):
+    """
+    The 'geo' file metadata that makes a plain Parquet file with a WKB 'geometry' column a GeoParquet file.
+    """
+    from pyproj import CRS
+
+    return {
+        'version': '1.0.0',
+        'primary_column': 'geometry',
+        'columns': {
+            'geometry': {
+                'encoding': 'WKB',
+                'geometry_types': [geometry_type],
+                'crs': CRS.from_user_input(crs).to_json_dict(),
+            }
+        },
+    }
+
+
+class GeoParquetStreamWriter:
+    """
+    Writes a GeoParquet file one chunk at a time, for outputs that are too big to hold in memory at once.
+    Every chunk is a DataFrame of attributes plus the WKB encoded geometries of its rows.
+    The chunks go to a hidden temporary file that replaces path when the writer is closed, like atomic_write;
+    if the with block raises, the temporary file is removed and path is left as it was.
+    """
+
+    def __init__(self, path, geometry_type, crs):
+        self.path = path
+        self.metadata = json.dumps(geoparquet_metadata(geometry_type, crs)).encode()
+        self.writer = None
+        self.tmp_path = None
+        self.rows = 0
+
+    def write(self, df, geometry_wkb):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        table = pa.Table.from_pandas(df, preserve_index=False)
+        table = table.append_column('geometry', pa.array(geometry_wkb, type=pa.binary()))
+        if self.writer is None:
+            metadata = dict(table.schema.metadata or {})
+            metadata[b'geo'] = self.metadata
+            fd, self.tmp_path = _temp_file(self.path)
+            os.close(fd)
+            self.writer = pq.ParquetWriter(self.tmp_path, table.schema.with_metadata(metadata))
+        self.writer.write_table(table)
+        self.rows += len(df)
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+            os.replace(self.tmp_path, self.path)
+
+    def abort(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+            os.remove(self.tmp_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
@@ -0,0 +1,249 @@
+#Tiled, multi-process version of predict_demand.py for large grids (250 m cells, neighbouring states, ...)
+#The bounding box is split into tiles. Every tile generates its own cells, computes features, predicts and
+#scores them in a worker process and writes its charging desert cells, sorted by score, to a small part file.
+#The sorted parts are then merged into one ranked GeoParquet file batch by batch, so peak memory depends
+#on the tile size and not on the size of the whole grid. Every tile also returns its best few cells, which
+#are merged into the top locations for the dashboard as the tiles come in (see top_k.py).
+import argparse
+import multiprocessing
+import os
+import shutil
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import pyarrow.parquet as pq
+import shapely
+
+import grid
+import top_k
+from features import (DRIVE_FEATURE, FEATURES, POI_DENSITY_RADII, TARGET_CRS, FeatureIndex, point_coords,
+                      select_major_roads)
+from instrumentation import fail, instrumented_run, stage
+from predict_demand import CHARGING_DESERT_M, GRID_SIZE, MODEL_FILE, load_layers, load_model, suitability_score
+from storage import GeoParquetStreamWriter, find_layer, layer_path, write_layer
+
+#Each tile is at most TILE_CELLS x TILE_CELLS cells
+TILE_CELLS = 256
+
+#Number of rows the merge step keeps in memory across all parts
+MERGE_BUFFER_ROWS = 500_000
+
+#Columns written for every ranked cell, next to its polygon geometry
+OUTPUT_COLUMNS = ['cell_id'] + FEATURES + [c for c in POI_DENSITY_RADII if c not in FEATURES] + \
+    ['predicted_open_year', 'suitability_score']
+
+#State of a worker process, filled in by _init_worker
+_WORKER = {}
+
+
+def _init_worker(feature_index, model_path, spec, parts_dir, pool_rows):
+    """
+    Runs once in every worker process. With the 'fork' start method the spatial indexes built by the
+    parent are inherited as they are (read-only, no copy or pickling), otherwise they are pickled once per worker.
+    """
+    #One thread per worker, the parallelism comes from the process pool
+    model = load_model(model_path, nthread=1, drive_distance=True)
+    #The index is this process's own copy after the fork (or unpickling), so this does not affect the parent
+    feature_index.set_workers(1)
+    _WORKER.update(feature_index=feature_index, model=model, spec=spec, parts_dir=parts_dir, pool_rows=pool_rows)
+
+
+def score_tile(tile):
+    """
+    Computes features, predictions and suitability scores for every cell of one tile and writes the
+    charging desert cells to a part file sorted by score (highest first), unless parts_dir is None.
+    Returns (part_path or None, number of cells, number of charging desert cells, best pool_rows cells).
+    """
+    tile_no, (col0, col1, row0, row1) = tile
+    spec = _WORKER['spec']
+    ids = grid.tile_cell_ids(spec, col0, col1, row0, row1)
+    xy = grid.cell_centroids(spec, ids)
+
+    features = _WORKER['feature_index'].compute(xy, density_radii=POI_DENSITY_RADII)
+    features.insert(0, 'cell_id', ids)
+    features['predicted_open_year'] = _WORKER['model'].predict(features)
+
+    deserts = features[features['dist_to_nearest_station_m'] > CHARGING_DESERT_M].copy()
+    if deserts.empty:
+        return None, len(ids), 0, None
+    deserts['suitability_score'] = suitability_score(
+        deserts['dist_to_nearest_station_m'], deserts['predicted_open_year'], deserts['poi_density_1.5m']
+    )
+    best = deserts.iloc[top_k.top_k_indices(deserts['suitability_score'].to_numpy(), _WORKER['pool_rows'])]
+    if _WORKER['parts_dir'] is None:
+        return None, len(ids), len(deserts), best[OUTPUT_COLUMNS]
+
+    deserts = deserts.sort_values('suitability_score', ascending=False)[OUTPUT_COLUMNS]
+    part_path = os.path.join(_WORKER['parts_dir'], f"tile_{tile_no:06d}.parquet")
+    deserts.to_parquet(part_path, index=False)
+    return part_path, len(ids), len(deserts), best[OUTPUT_COLUMNS]
+
+
+def merge_ranked_parts(part_paths, output_file, spec, buffer_rows=MERGE_BUFFER_ROWS):
+    """
+    K-way merges part files that are each sorted by suitability_score (descending) into one ranked GeoParquet file.
+    Every part only keeps one batch in memory. A row is written once its score is at least as high as the
+    lowest buffered score of every part that still has unread rows, which guarantees no unread row can beat it.
+    Returns the number of rows written.
+    """
+    batch_rows = max(1024, buffer_rows // max(1, len(part_paths)))
+    readers = [pq.ParquetFile(path).iter_batches(batch_size=batch_rows, columns=OUTPUT_COLUMNS) for path in part_paths]
+    buffers = [None] * len(readers)
+    exhausted = [False] * len(readers)
+
+    def refill(i):
+        buffers[i] = None
+        for batch in readers[i]:
+            if batch.num_rows:
+                buffers[i] = batch.to_pandas()
+                return
+        exhausted[i] = True
+
+    for i in range(len(readers)):
+        refill(i)
+
+    with GeoParquetStreamWriter(output_file, 'Polygon', TARGET_CRS) as writer:
+        while True:
+            live = [b for b in buffers if b is not None and len(b)]
+            if not live:
+                break
+            #Lowest buffered score of each part that still has rows on disk
+            open_floors = [buffers[i]['suitability_score'].iloc[-1] for i in range(len(buffers))
+                           if buffers[i] is not None and len(buffers[i]) and not exhausted[i]]
+            threshold = max(open_floors) if open_floors else -np.inf
+
+            ready = []
+            for i, buffer in enumerate(buffers):
+                if buffer is None or not len(buffer):
+                    continue
+                take = buffer['suitability_score'].to_numpy() >= threshold
+                ready.append(buffer[take])
+                buffers[i] = buffer[~take]
+
+            chunk = pd.concat(ready, ignore_index=True).sort_values('suitability_score', ascending=False, kind='stable')
+            writer.write(chunk, shapely.to_wkb(grid.cell_boxes(spec, chunk['cell_id'].to_numpy())))
+
+            #Parts whose buffer ran empty load their next batch
+            for i in range(len(buffers)):
+                if not exhausted[i] and (buffers[i] is None or not len(buffers[i])):
+                    refill(i)
+    return writer.rows
+
+
+def run_tiled_scoring(gdf_stations, gdf_roads, gdf_pois, model_path, output_file,
+                      grid_size=GRID_SIZE, tile_cells=TILE_CELLS, workers=None,
+                      top=top_k.TOP_K, min_separation=top_k.MIN_SEPARATION_M, roads_file=None):
+    """
+    Scores the whole grid over the bounds of gdf_roads tile by tile in a process pool and writes
+    the ranked charging desert cells to output_file (skipped when output_file is None).
+    All layers must already be in TARGET_CRS. roads_file is the road layer gdf_roads was read from, which keys
+    the cached road graph of a model that uses the drive distance (the current road layer by default).
+    Returns (number of cells scored, number of ranked cells, top locations GeoDataFrame).
+    """
+    spec = grid.grid_spec(gdf_roads.total_bounds, grid_size)
+    tile_list = list(enumerate(grid.tiles(spec, tile_cells)))
+    print(f"Grid has {spec.ncols * spec.nrows} cells of {grid_size} m, split into {len(tile_list)} tiles.")
+
+    #The indexes are built once here and shared with every worker
+    drive_distance = None
+    if DRIVE_FEATURE in load_model(model_path, drive_distance=True).features:
+        import road_graph
+
+        print("Labelling the road network with drive distances to the nearest station...")
+        graph = road_graph.load_road_graph(gdf_roads, roads_file=roads_file)
+        drive_distance = road_graph.DriveDistance(graph, point_coords(gdf_stations.geometry))
+    feature_index = FeatureIndex(select_major_roads(gdf_roads), gdf_stations, gdf_pois, drive_distance)
+
+    parts_dir = None
+    if output_file is not None:
+        parts_dir = tempfile.mkdtemp(prefix="tiles_", dir=os.path.dirname(os.path.abspath(output_file)))
+    context = multiprocessing.get_context('fork') if 'fork' in multiprocessing.get_all_start_methods() else None
+    pool_rows = top_k.pool_size(top, min_separation)
+    candidates = top_k.TopK(pool_rows)
+    n_cells = n_ranked = 0
+    part_paths = []
+    try:
+        with ProcessPoolExecutor(max_workers=workers, mp_context=context, initializer=_init_worker,
+                                 initargs=(feature_index, model_path, spec, parts_dir, pool_rows)) as executor:
+            results = executor.map(score_tile, tile_list)
+            for done, (part_path, tile_cells_scored, tile_deserts, best) in enumerate(results, start=1):
+                n_cells += tile_cells_scored
+                n_ranked += tile_deserts
+                if part_path is not None:
+                    part_paths.append(part_path)
+                if best is not None:
+                    candidates.add(best)
+                if done % 50 == 0 or done == len(tile_list):
+                    print(f"  - scored {done}/{len(tile_list)} tiles")
+
+        if output_file is not None:
+            print(f"Merging {len(part_paths)} ranked tiles into {output_file}...")
+            n_ranked = merge_ranked_parts(part_paths, output_file, spec)
+    finally:
+        if parts_dir is not None:
+            shutil.rmtree(parts_dir, ignore_errors=True)
+    return n_cells, n_ranked, top_locations(candidates, spec, top, min_separation)
+
+
+def top_locations(candidates, spec, top=top_k.TOP_K, min_separation=top_k.MIN_SEPARATION_M):
+    """
+    The top locations (with their cell polygons and a 'rank' column) out of the candidates kept by a top_k.TopK.
+    """
+    pool = candidates.result()
+    if not len(pool):
+        return gpd.GeoDataFrame({column: [] for column in OUTPUT_COLUMNS + ['rank']}, geometry=[], crs=TARGET_CRS)
+    ids = pool['cell_id'].to_numpy()
+    best = top_k.select_top(pool, top, min_separation, xy=grid.cell_centroids(spec, ids))
+    if len(best) < top and candidates.truncated:
+        print(f"WARNING: only {len(best)} locations {min_separation} m apart among the best {len(pool)} candidates.")
+    return gpd.GeoDataFrame(best, geometry=grid.cell_boxes(spec, best['cell_id'].to_numpy()), crs=TARGET_CRS)
+
+
+@instrumented_run('tiled_scoring')
+def main():
+    parser = argparse.ArgumentParser(description="Score the prediction grid tile by tile in parallel.")
+    parser.add_argument("--grid-size", type=float, default=GRID_SIZE, help="cell size in meters")
+    parser.add_argument("--tile-cells", type=int, default=TILE_CELLS, help="tile width/height in cells")
+    parser.add_argument("--workers", type=int, default=None, help="number of worker processes (default: all cores)")
+    #The ranked output is always streamed as GeoParquet
+    parser.add_argument("--output", default=layer_path('ranked_locations', 'parquet'))
+    parser.add_argument("--no-ranked-export", action="store_true",
+                        help="only write the top locations, not the full ranked layer")
+    parser.add_argument("--top", type=int, default=top_k.TOP_K, help="number of top locations written for the dashboard")
+    parser.add_argument("--min-separation", type=float, default=top_k.MIN_SEPARATION_M,
+                        help="minimum distance in meters between two top locations (0 = none)")
+    args = parser.parse_args()
+
+    print("Starting tiled demand prediction...")
+    try:
+        with stage('load_layers') as s:
+            gdf_stations, gdf_roads, gdf_pois = load_layers()
+            roads_file = find_layer('roads')[0]
+            #Checked here so a missing or mismatched model fails before any tile is scored
+            load_model(MODEL_FILE, drive_distance=True)
+            s.rows = len(gdf_stations) + len(gdf_roads) + len(gdf_pois)
+    except (FileNotFoundError, ValueError) as e:
+        print(f"ERROR: {e}. Please ensure all required files are present.")
+        fail(str(e))
+        return
+
+    start = time.perf_counter()
+    with stage('score_tiles') as s:
+        n_cells, n_ranked, top_gdf = run_tiled_scoring(
+            gdf_stations, gdf_roads, gdf_pois, MODEL_FILE, None if args.no_ranked_export else args.output,
+            grid_size=args.grid_size, tile_cells=args.tile_cells, workers=args.workers,
+            top=args.top, min_separation=args.min_separation, roads_file=roads_file,
+        )
+        s.rows = n_cells
+    with stage('write_top_locations', rows=len(top_gdf)):
+        top_path = write_layer(top_gdf, 'top_locations', top_k.TOP_LOCATIONS_FORMAT)
+    print(f"Scored {n_cells} cells and ranked {n_ranked} charging desert locations in {time.perf_counter() - start:.1f} s.")
+    print(f"Saved the top {len(top_gdf)} locations to {top_path}.")
+
+
+if __name__ == "__main__":
+    main()
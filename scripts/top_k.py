@@ -0,0 +1,158 @@
+#Top-K selection of the best ranked locations
+#Only the best few hundred cells end up in the dashboard, so instead of sorting every charging desert cell the
+#top K are picked with np.argpartition (linear time) and only those K are sorted. TopK keeps the best rows of a
+#stream of chunks (tiles, Parquet batches) without holding the stream in memory, and diverse_top_k spreads the
+#picks out so that no two of them are closer than a minimum separation.
+import numpy as np
+import pandas as pd
+import shapely
+from scipy.spatial import cKDTree
+
+from storage import DATA_FORMAT, PROCESSED_DATA_PATH, GeoParquetStreamWriter, layer_path, write_layer
+
+#Number of top locations written for the dashboard, which reads them as GeoJSON whatever format the rest
+#of the pipeline uses
+TOP_K = 200
+TOP_LOCATIONS_FORMAT = "geojson"
+
+#Minimum distance between two top locations in meters (0 = no spatial diversity)
+MIN_SEPARATION_M = 0
+
+#With a minimum separation some of the best cells are skipped, so a stream keeps this many times K candidates
+DIVERSE_POOL_FACTOR = 20
+
+#Rows per chunk when the full ranked layer is streamed to GeoParquet
+EXPORT_CHUNK_ROWS = 100_000
+
+
+def top_k_indices(scores, k):
+    """
+    Positions of the k highest scores, highest first (ties in order of position). NaN scores are never picked.
+    """
+    scores = np.asarray(scores, dtype=float)
+    valid = np.flatnonzero(~np.isnan(scores))
+    k = min(int(k), len(valid))
+    if k <= 0:
+        return np.empty(0, dtype=np.intp)
+    if k < len(valid):
+        #The k-th highest score via a partition; of the cells tied with it, the first ones make the cut
+        values = scores[valid]
+        kth = -np.partition(-values, k - 1)[k - 1]
+        above = valid[values > kth]
+        valid = np.concatenate([above, valid[values == kth][:k - len(above)]])
+    return valid[np.argsort(-scores[valid], kind='stable')]
+
+
+def _greedy_separated(xy, min_separation, k):
+    #Walks xy (sorted by score) from the top and picks every point that is not within min_separation of a pick
+    tree = cKDTree(xy)
+    blocked = np.zeros(len(xy), dtype=bool)
+    picks = []
+    for i in range(len(xy)):
+        if blocked[i]:
+            continue
+        picks.append(i)
+        if len(picks) == k:
+            break
+        blocked[tree.query_ball_point(xy[i], min_separation)] = True
+    return np.asarray(picks, dtype=np.intp)
+
+
+def diverse_top_k(xy, scores, k, min_separation=MIN_SEPARATION_M):
+    """
+    Greedy spatially diverse top k: goes down the locations from the highest score and skips every location
+    within min_separation (in the units of xy) of one already picked. Returns positions, highest score first.
+    Only a pool of the best candidates is sorted and indexed; the pool grows until k locations are picked
+    or every location was considered, so the result is the same as walking the fully sorted list.
+    """
+    if not min_separation or min_separation <= 0:
+        return top_k_indices(scores, k)
+    xy = np.asarray(xy, dtype=float)
+    n = int(np.count_nonzero(~np.isnan(np.asarray(scores, dtype=float))))
+    pool = min(n, max(k, 1) * 4)
+    while True:
+        candidates = top_k_indices(scores, pool)
+        picks = _greedy_separated(xy[candidates], min_separation, k) if len(candidates) else candidates
+        if len(picks) >= k or pool >= n:
+            return candidates[picks]
+        pool = min(n, pool * 2)
+
+
+def select_top(df, k=TOP_K, min_separation=MIN_SEPARATION_M, xy=None, score_column='suitability_score'):
+    """
+    The k best rows of df by score_column, highest first, with a 'rank' column (1 = best).
+    With a min_separation, xy (one point per row, e.g. the cell centroids) is used to keep the picks apart.
+    """
+    scores = df[score_column].to_numpy(dtype=float)
+    if min_separation and min_separation > 0:
+        if xy is None:
+            raise ValueError("xy is needed to select locations with a minimum separation")
+        positions = diverse_top_k(xy, scores, k, min_separation)
+    else:
+        positions = top_k_indices(scores, k)
+    top = df.iloc[positions].copy()
+    top['rank'] = np.arange(1, len(top) + 1)
+    return top
+
+
+class TopK:
+    """
+    Keeps the k best rows of a stream of DataFrame chunks. Every chunk is cut to its own top k with
+    argpartition first, then merged with the rows kept so far, so memory stays at about 2 * k rows.
+    """
+
+    def __init__(self, k, score_column='suitability_score'):
+        self.k = k
+        self.score_column = score_column
+        self.best = None
+        self.seen = 0
+
+    def add(self, chunk):
+        self.seen += len(chunk)
+        if not len(chunk) or self.k <= 0:
+            return
+        chunk = chunk.iloc[top_k_indices(chunk[self.score_column].to_numpy(dtype=float), self.k)]
+        merged = chunk if self.best is None else pd.concat([self.best, chunk], ignore_index=True)
+        self.best = merged.iloc[top_k_indices(merged[self.score_column].to_numpy(dtype=float), self.k)]
+        self.best = self.best.reset_index(drop=True)
+
+    @property
+    def truncated(self):
+        #True when rows were dropped, i.e. a selection that needs more than k candidates may be incomplete
+        return self.best is not None and self.seen > len(self.best)
+
+    def result(self):
+        """
+        The kept rows, highest score first.
+        """
+        return self.best if self.best is not None else pd.DataFrame()
+
+
+def pool_size(k, min_separation=MIN_SEPARATION_M):
+    """
+    Number of candidates a stream keeps to select k locations with the given minimum separation.
+    """
+    return k * DIVERSE_POOL_FACTOR if min_separation and min_separation > 0 else k
+
+
+def write_ranked_stream(gdf, name, fmt=None, base_path=PROCESSED_DATA_PATH, score_column='suitability_score', chunk_rows=EXPORT_CHUNK_ROWS):
+    """
+    Writes gdf sorted by score (highest first) as a layer. Only the score column is sorted; as GeoParquet the rows
+    are then written chunk by chunk in that order, so no sorted copy of the whole GeoDataFrame is ever built.
+    Returns the path written to.
+    """
+    fmt = fmt or DATA_FORMAT
+    order = np.argsort(-gdf[score_column].to_numpy(dtype=float), kind='stable')
+    geometry_types = gdf.geometry.geom_type.unique()
+    #Empty and mixed layers are small or rare enough to go through the regular writer
+    if fmt != 'parquet' or len(geometry_types) != 1:
+        return write_layer(gdf.iloc[order], name, fmt, base_path)
+    path = layer_path(name, fmt, base_path)
+    geometry_type = geometry_types[0]
+    attributes = [column for column in gdf.columns if column != gdf.geometry.name]
+    with GeoParquetStreamWriter(path, geometry_type, gdf.crs) as writer:
+        for start in range(0, len(order), chunk_rows):
+            rows = order[start:start + chunk_rows]
+            chunk = gdf.iloc[rows]
+            writer.write(pd.DataFrame(chunk[attributes]), shapely.to_wkb(chunk.geometry.to_numpy()))
+    return path
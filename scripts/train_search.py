@@ -0,0 +1,272 @@
+#Hyperparameter search with time-series cross-validation for the open year model
+#forecast_demand.py trains one model with fixed parameters and checks it on the 2024 stations only.
+#This script evaluates many parameter sets with rolling-origin cross-validation: for each of the last
+#N years, a model is trained on the stations that opened before that year and validated on that year.
+#Early stopping watches the last training year instead (it is held out of the training rows), so the
+#validation year is never seen while training and its MAE is an honest estimate.
+#
+#Trials run in a process pool. Every worker quantizes the fold data once into QuantileDMatrix objects and
+#reuses them for all its trials, training uses tree_method='hist'. With --mode halving, successive halving
+#gives every configuration a small boosting budget first and only continues the best third with a larger one.
+#All results go to a leaderboard CSV. With --export the best configuration is retrained on all stations and
+#saved with model_io, as models/<SEARCH_MODEL_NAME> unless a name is given (e.g. the production model's).
+#
+#Usage (from the project root):
+#    python scripts/train_search.py --trials 300 --mode halving --export
+import argparse
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+import xgboost as xgb
+
+import model_io
+from features import FEATURES
+from forecast_demand import MODELS_PATH, load_training_data
+
+LEADERBOARD_FILE = os.path.join(MODELS_PATH, "search_leaderboard.csv")
+
+#Name the best model is exported under by default, next to (not over) the production model
+SEARCH_MODEL_NAME = model_io.MODEL_NAME + "_search"
+
+#Number of validation years, the most recent ones
+CV_FOLDS = 3
+#A fold is skipped when it has fewer training, early stopping or validation stations than this
+MIN_FOLD_ROWS = 20
+
+MAX_ROUNDS = 2000
+EARLY_STOPPING_ROUNDS = 50
+#Successive halving: boosting rounds of the first rung, and the factor between rungs
+MIN_ROUNDS = 100
+HALVING_FACTOR = 3
+
+#Parameters every trial uses
+BASE_PARAMS = {
+    'objective': 'reg:squarederror',
+    'eval_metric': 'mae',
+    'tree_method': 'hist',
+    'max_bin': 256,
+    #The parallelism comes from the process pool
+    'nthread': 1,
+}
+
+#State of a worker process, filled in by _init_worker
+_WORKER = {}
+
+
+def rolling_origin_folds(years, n_folds=CV_FOLDS, min_rows=MIN_FOLD_ROWS):
+    """
+    Year-based rolling-origin splits: for each of the last n_folds years with enough stations, train on all
+    earlier years but the last one, stop early on that last training year and validate on the year itself.
+    Returns a list of (validation year, train rows, early stopping rows, valid rows).
+    """
+    years = np.asarray(years)
+    folds = []
+    for year in sorted(np.unique(years), reverse=True):
+        earlier = years[years < year]
+        if not len(earlier):
+            break
+        stop_year = earlier.max()
+        train_rows = np.flatnonzero(years < stop_year)
+        stop_rows = np.flatnonzero(years == stop_year)
+        valid_rows = np.flatnonzero(years == year)
+        if min(len(train_rows), len(stop_rows), len(valid_rows)) >= min_rows:
+            folds.append((int(year), train_rows, stop_rows, valid_rows))
+        if len(folds) == n_folds:
+            break
+    return folds[::-1]
+
+
+def sample_params(rng):
+    """
+    Draws one random configuration from the search space.
+    """
+    return {
+        'eta': float(10 ** rng.uniform(-2.3, -0.5)),
+        'max_depth': int(rng.integers(2, 11)),
+        'min_child_weight': float(10 ** rng.uniform(-1, 1.5)),
+        'subsample': float(rng.uniform(0.5, 1.0)),
+        'colsample_bytree': float(rng.uniform(0.6, 1.0)),
+        'lambda': float(10 ** rng.uniform(-2, 1.5)),
+        'alpha': float(10 ** rng.uniform(-3, 1)),
+        'gamma': float(10 ** rng.uniform(-3, 0.5)),
+    }
+
+
+def _init_worker(X, y, folds):
+    _WORKER.update(X=X, y=y, folds=folds, dmatrices={})
+
+
+def _fold_dmatrices(max_bin):
+    """
+    The quantized (train, early stopping, valid) matrices of every fold, built once per worker and max_bin.
+    The other two matrices use the bins of the training matrix (ref=...).
+    """
+    if max_bin not in _WORKER['dmatrices']:
+        X, y = _WORKER['X'], _WORKER['y']
+        matrices = []
+        for _, train_rows, stop_rows, valid_rows in _WORKER['folds']:
+            dtrain = xgb.QuantileDMatrix(X[train_rows], y[train_rows], max_bin=max_bin, feature_names=FEATURES, nthread=1)
+            dstop = xgb.QuantileDMatrix(X[stop_rows], y[stop_rows], ref=dtrain, feature_names=FEATURES, nthread=1)
+            dvalid = xgb.QuantileDMatrix(X[valid_rows], y[valid_rows], ref=dtrain, feature_names=FEATURES, nthread=1)
+            matrices.append((dtrain, dstop, dvalid))
+        _WORKER['dmatrices'][max_bin] = matrices
+    return _WORKER['dmatrices'][max_bin]
+
+
+def run_trial(trial):
+    """
+    Cross-validates one configuration with a budget of num_rounds boosting rounds.
+    Returns a leaderboard row.
+    """
+    trial_no, params, num_rounds, seed = trial
+    start = time.perf_counter()
+    params = {**BASE_PARAMS, **params, 'seed': seed}
+    scores, iterations, stopped = [], [], []
+    for dtrain, dstop, dvalid in _fold_dmatrices(params['max_bin']):
+        booster = xgb.train(
+            params, dtrain, num_boost_round=num_rounds, evals=[(dstop, 'stop')],
+            early_stopping_rounds=EARLY_STOPPING_ROUNDS, verbose_eval=False,
+        )
+        #Scored on the validation year with the rounds early stopping picked on the year before
+        predicted = booster.predict(dvalid, iteration_range=(0, booster.best_iteration + 1))
+        scores.append(float(np.mean(np.abs(predicted - dvalid.get_label()))))
+        iterations.append(booster.best_iteration + 1)
+        stopped.append(booster.num_boosted_rounds() < num_rounds)
+    return {
+        'trial': trial_no,
+        'num_rounds': num_rounds,
+        'cv_mae': float(np.mean(scores)),
+        'cv_mae_std': float(np.std(scores)),
+        'best_rounds': int(round(np.mean(iterations))),
+        #Early stopping ended every fold before the budget ran out, so a larger budget would not change the result
+        'stopped_early': all(stopped),
+        'seconds': time.perf_counter() - start,
+        **{f'param_{key}': value for key, value in params.items() if key not in BASE_PARAMS and key != 'seed'},
+    }
+
+
+def _params_of(row):
+    return {key[len('param_'):]: value for key, value in row.items() if key.startswith('param_')}
+
+
+def random_search(executor, configs, max_rounds, seed):
+    """
+    Evaluates every configuration with the full boosting budget (early stopping decides the real length).
+    """
+    trials = [(trial_no, params, max_rounds, seed) for trial_no, params in enumerate(configs)]
+    return list(executor.map(run_trial, trials, chunksize=max(1, len(trials) // 64)))
+
+
+def successive_halving(executor, configs, min_rounds, max_rounds, factor, seed):
+    """
+    Evaluates all configurations with min_rounds boosting rounds, keeps the best 1/factor of them and
+    evaluates those again with factor times the rounds, until max_rounds or a single configuration is reached.
+    Configurations that early stopping already ended are not trained again. Returns the rows of every rung.
+    """
+    rows = []
+    latest = {}
+    survivors = list(enumerate(configs))
+    num_rounds = min_rounds
+    while True:
+        pending = [(trial_no, params) for trial_no, params in survivors
+                   if trial_no not in latest or not latest[trial_no]['stopped_early']]
+        trials = [(trial_no, params, num_rounds, seed) for trial_no, params in pending]
+        rung = list(executor.map(run_trial, trials, chunksize=max(1, len(trials) // 64)))
+        rows.extend(rung)
+        latest.update((row['trial'], row) for row in rung)
+        current = [latest[trial_no] for trial_no, _ in survivors]
+        print(f"  rung with {num_rounds} rounds: {len(current)} configurations ({len(rung)} trained), "
+              f"best CV MAE {min(row['cv_mae'] for row in current):.4f}")
+        if num_rounds >= max_rounds or len(survivors) <= 1:
+            return rows
+        keep = max(1, len(survivors) // factor)
+        best = sorted(current, key=lambda row: row['cv_mae'])[:keep]
+        survivors = [(row['trial'], _params_of(row)) for row in best]
+        num_rounds = min(max_rounds, num_rounds * factor)
+
+
+def export_best(best, X, y, years, folds, name=SEARCH_MODEL_NAME, models_path=MODELS_PATH):
+    """
+    Retrains the best configuration on all stations, with the number of rounds early stopping found in the
+    cross-validation, and saves it with model_io under name. Returns the model path.
+    """
+    params = {**BASE_PARAMS, **_params_of(best), 'nthread': 0}
+    dtrain = xgb.QuantileDMatrix(X, y, max_bin=params['max_bin'], feature_names=FEATURES)
+    booster = xgb.train(params, dtrain, num_boost_round=int(best['best_rounds']))
+    training_window = {
+        'target': 'open_year',
+        'train_years': [int(years.min()), int(years.max())],
+        'train_rows': len(y),
+        'cv_validation_years': [year for year, _, _, _ in folds],
+    }
+    metrics = {'cv_mae_years': best['cv_mae'], 'cv_mae_std_years': best['cv_mae_std']}
+    return model_io.save_model(booster, FEATURES, name=name, models_path=models_path, training_window=training_window,
+                               metrics=metrics, params={**params, 'num_boost_round': int(best['best_rounds'])})
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Cross-validated hyperparameter search for the open year model.")
+    parser.add_argument("--trials", type=int, default=200, help="number of random configurations")
+    parser.add_argument("--mode", choices=["random", "halving"], default="halving")
+    parser.add_argument("--folds", type=int, default=CV_FOLDS, help="number of most recent years used for validation")
+    parser.add_argument("--max-rounds", type=int, default=MAX_ROUNDS)
+    parser.add_argument("--min-rounds", type=int, default=MIN_ROUNDS, help="boosting rounds of the first halving rung")
+    parser.add_argument("--workers", type=int, default=None, help="worker processes (default: all cores)")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--leaderboard", default=LEADERBOARD_FILE)
+    parser.add_argument("--export", nargs="?", const=SEARCH_MODEL_NAME, default=None, metavar="NAME",
+                        help=f"retrain the best configuration on all stations and save it as models/NAME "
+                             f"(default {SEARCH_MODEL_NAME}; pass {model_io.MODEL_NAME} to replace the production model)")
+    args = parser.parse_args()
+
+    print("--- Hyperparameter search for the open year model ---")
+    try:
+        gdf_master = load_training_data()
+    except FileNotFoundError as e:
+        print(f"ERROR: {e}. Please run the feature engineering notebook first.")
+        return
+    X = np.ascontiguousarray(gdf_master[FEATURES].to_numpy(dtype=np.float32))
+    y = gdf_master['open_year'].to_numpy(dtype=np.float32)
+    years = gdf_master['open_year'].to_numpy()
+
+    folds = rolling_origin_folds(years, args.folds)
+    if not folds:
+        print(f"ERROR: Not enough stations per year for cross-validation (need {MIN_FOLD_ROWS} per fold).")
+        return
+    print(f"Validation years: {', '.join(str(year) for year, _, _, _ in folds)}")
+
+    rng = np.random.default_rng(args.seed)
+    configs = [sample_params(rng) for _ in range(args.trials)]
+    workers = args.workers or os.cpu_count()
+    print(f"Evaluating {len(configs)} configurations ({args.mode}) on {workers} workers...")
+    start = time.perf_counter()
+    #With 'fork' the workers inherit the training arrays instead of receiving a pickled copy
+    context = multiprocessing.get_context("fork") if "fork" in multiprocessing.get_all_start_methods() else None
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context, initializer=_init_worker,
+                             initargs=(X, y, folds)) as executor:
+        if args.mode == "random":
+            rows = random_search(executor, configs, args.max_rounds, args.seed)
+        else:
+            rows = successive_halving(executor, configs, args.min_rounds, args.max_rounds, HALVING_FACTOR, args.seed)
+    print(f"Search finished in {time.perf_counter() - start:.1f} s.")
+
+    leaderboard = pd.DataFrame(rows).sort_values(['cv_mae', 'num_rounds'], ascending=[True, False], kind='stable')
+    os.makedirs(os.path.dirname(args.leaderboard) or '.', exist_ok=True)
+    leaderboard.to_csv(args.leaderboard, index=False)
+    print(f"Leaderboard saved to '{args.leaderboard}'. Top 5:")
+    print(leaderboard.head().to_string(index=False, float_format=lambda v: f"{v:.4g}"))
+
+    if args.export is None:
+        return
+    #Taken from the rows rather than the leaderboard DataFrame, which would have turned max_depth into a float
+    best = min(rows, key=lambda row: (row['cv_mae'], -row['num_rounds']))
+    path = export_best(best, X, y, years, folds, name=args.export)
+    print(f"Best configuration (CV MAE {best['cv_mae']:.4f} years) retrained on all stations and saved to '{path}'.")
+
+
+if __name__ == "__main__":
+    main()
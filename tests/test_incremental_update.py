@@ -0,0 +1,77 @@
+#The block search of incremental_update.py against a brute force search, and the merge into the ranked locations
+#    python -m pytest tests/
+import os
+import sys
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import shapely
+from scipy.spatial import cKDTree
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, os.path.join(ROOT, 'scripts'))
+import grid
+from incremental_update import SAME_LOCATION_M, affected_cells, merge_ranked
+
+
+def _grid(seed=0, n_stations=40):
+    #A 100 x 60 grid of 500 m cells in block order, with its distances to random stations
+    rng = np.random.default_rng(seed)
+    spec = grid.GridSpec(0.0, 0.0, 500.0, 100, 60)
+    ids = grid.all_cell_ids(spec)
+    ids = ids[grid.DistanceBlocks.order(spec, ids)]
+    xy = grid.cell_centroids(spec, ids)
+    stations = rng.uniform([0, 0], [50_000, 30_000], (n_stations, 2))
+    dist, nearest = cKDTree(stations).query(xy, k=1)
+    return spec, ids, xy, stations, dist, stations[nearest]
+
+
+def test_added_stations_match_brute_force():
+    spec, ids, xy, _, dist, nearest_xy = _grid()
+    blocks = grid.DistanceBlocks.from_cells(spec, ids, dist)
+    added = np.array([[1_000.0, 1_000.0], [25_000.0, 15_000.0], [49_900.0, 29_900.0]])
+    expected = np.flatnonzero(cKDTree(added).query(xy, k=1)[0] < dist)
+    np.testing.assert_array_equal(affected_cells(xy, dist, nearest_xy, added, np.empty((0, 2)), blocks), expected)
+
+
+def test_removed_stations_match_brute_force():
+    spec, ids, xy, stations, dist, nearest_xy = _grid(seed=1)
+    blocks = grid.DistanceBlocks.from_cells(spec, ids, dist)
+    removed = stations[:5]
+    expected = np.flatnonzero(cKDTree(removed).query(nearest_xy, k=1)[0] <= SAME_LOCATION_M)
+    assert len(expected)
+    np.testing.assert_array_equal(affected_cells(xy, dist, nearest_xy, np.empty((0, 2)), removed, blocks), expected)
+
+
+def test_block_bounds_follow_updates():
+    #After a series of stations is opened and the bounds are updated, the search still finds every closer cell
+    spec, ids, xy, _, dist, nearest_xy = _grid(seed=2)
+    blocks = grid.DistanceBlocks.from_cells(spec, ids, dist)
+    rng = np.random.default_rng(3)
+    for station in rng.uniform([0, 0], [50_000, 30_000], (20, 2)):
+        expected = np.flatnonzero(np.hypot(*(xy - station).T) < dist)
+        affected = affected_cells(xy, dist, nearest_xy, station[None, :], np.empty((0, 2)), blocks)
+        np.testing.assert_array_equal(affected, expected)
+        dist[affected] = np.hypot(*(xy[affected] - station).T)
+        nearest_xy[affected] = station
+        blocks.update(affected, dist)
+    np.testing.assert_array_equal(blocks.max_dist, grid.DistanceBlocks.from_cells(spec, ids, dist).max_dist)
+
+
+def test_merge_ranked_matches_a_full_sort():
+    rng = np.random.default_rng(4)
+    scores = np.round(rng.uniform(0, 10, 500), 1)
+    ranked = gpd.GeoDataFrame({'cell_id': np.arange(500), 'suitability_score': scores},
+                              geometry=shapely.points(rng.uniform(0, 1, (500, 2))))
+    ranked = ranked.sort_values('suitability_score', ascending=False, kind='stable').reset_index(drop=True)
+    changed_ids = rng.choice(500, 60, replace=False)
+    #Some changed cells are no charging deserts any more, the others get a new score
+    new_rows = ranked[ranked['cell_id'].isin(changed_ids[:40])].copy()
+    new_rows['suitability_score'] = np.round(rng.uniform(0, 10, len(new_rows)), 1)
+
+    merged = merge_ranked(ranked, new_rows, changed_ids)
+    expected = pd.concat([ranked[~ranked['cell_id'].isin(changed_ids)], new_rows]).sort_values(
+        'suitability_score', ascending=False, kind='stable')
+    np.testing.assert_array_equal(merged['cell_id'].to_numpy(), expected['cell_id'].to_numpy())
+    np.testing.assert_array_equal(merged['suitability_score'].to_numpy(), expected['suitability_score'].to_numpy())
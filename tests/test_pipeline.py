@@ -0,0 +1,53 @@
+#When pipeline.py considers a stage up to date, stale or blocked
+#    python -m pytest tests/
+import os
+import sys
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, os.path.join(ROOT, 'scripts'))
+import pipeline
+
+
+def _stage(tmp_path, inputs=(), outputs=()):
+    return pipeline.Stage('test', 'geospatial_analysis.py', [], [str(tmp_path / name) for name in inputs],
+                          [str(tmp_path / name) for name in outputs], "test stage")
+
+
+def _touch(path, mtime):
+    path.write_text('')
+    os.utime(path, (mtime, mtime))
+
+
+def test_up_to_date_when_outputs_are_newer(tmp_path):
+    script_mtime = os.path.getmtime(os.path.join(pipeline.SCRIPTS_DIR, 'geospatial_analysis.py'))
+    _touch(tmp_path / 'in.csv', script_mtime + 10)
+    _touch(tmp_path / 'out.parquet', script_mtime + 20)
+    assert pipeline.stage_status(_stage(tmp_path, ['in.csv'], ['out.parquet'])) == ('up to date', None)
+
+
+def test_stale_when_an_input_is_newer_or_an_output_missing(tmp_path):
+    script_mtime = os.path.getmtime(os.path.join(pipeline.SCRIPTS_DIR, 'geospatial_analysis.py'))
+    _touch(tmp_path / 'in.csv', script_mtime + 20)
+    _touch(tmp_path / 'out.parquet', script_mtime + 10)
+    assert pipeline.stage_status(_stage(tmp_path, ['in.csv'], ['out.parquet']))[0] == 'stale'
+    assert pipeline.stage_status(_stage(tmp_path, ['in.csv'], ['out.parquet', 'other.parquet']))[0] == 'stale'
+    assert pipeline.stage_status(_stage(tmp_path, ['*.csv'], ['out.parquet']))[0] == 'stale'
+
+
+def test_blocked_when_inputs_and_outputs_are_missing(tmp_path):
+    assert pipeline.stage_status(_stage(tmp_path, ['in.csv'], ['out.parquet']))[0] == 'blocked'
+    assert pipeline.stage_status(_stage(tmp_path, ['*.csv'], ['out.parquet']))[0] == 'blocked'
+
+
+def test_existing_outputs_are_kept_without_inputs(tmp_path):
+    #The outputs are older than the script, but the stage cannot be rerun without its inputs
+    _touch(tmp_path / 'out.parquet', 0)
+    status, reason = pipeline.stage_status(_stage(tmp_path, ['in.csv'], ['out.parquet']))
+    assert status == 'up to date'
+    assert 'in.csv' in reason
+
+
+def test_force_does_not_rerun_a_stage_without_inputs(tmp_path):
+    _touch(tmp_path / 'out.parquet', 0)
+    results = pipeline.run_pipeline([_stage(tmp_path, ['in.csv'], ['out.parquet'])], jobs=1, force=True)
+    assert results['test'][0] == 'skipped'
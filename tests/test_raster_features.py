@@ -0,0 +1,59 @@
+#Accuracy of the raster feature backend against the vector features, on seeded synthetic layers
+#    python -m pytest tests/
+import os
+import sys
+
+import geopandas as gpd
+import numpy as np
+import pytest
+import shapely
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, os.path.join(ROOT, 'scripts'))
+sys.path.insert(0, os.path.join(ROOT, 'benchmarks'))
+import grid
+import raster_features
+import synthetic_data
+from features import POI_DENSITY_RADII, TARGET_CRS, compute_features, select_major_roads
+
+#About 100 x 80 km around Seattle, with 1 km cells like predict_demand.GRID_SIZE
+BOUNDS = (340_000, 30_000, 440_000, 110_000)
+GRID_SIZE = 1000
+
+
+@pytest.fixture(scope='module')
+def comparison():
+    stations, roads, pois = synthetic_data.generate(n_pois=50_000, n_stations=300, n_roads=500, n_cities=1,
+                                                    seed=1, bounds=BOUNDS)
+    spec = grid.grid_spec(roads.total_bounds, GRID_SIZE)
+    ids = grid.all_cell_ids(spec)
+    grid_gdf = gpd.GeoDataFrame({'cell_id': ids}, geometry=shapely.points(grid.cell_centroids(spec, ids)), crs=TARGET_CRS)
+
+    road_dist, station_dist, _, poi_counts = raster_features.raster_feature_stage(grid_gdf, spec, roads, stations, pois)
+    vector = compute_features(grid_gdf, select_major_roads(roads), stations, pois, density_radii=POI_DENSITY_RADII)
+    raster = {'dist_to_major_road_m': road_dist, 'dist_to_nearest_station_m': station_dist, **poi_counts}
+    errors = raster_features.feature_errors(raster, {column: vector[column] for column in raster})
+    frame = raster_features.raster_frame(spec, pad_m=max(POI_DENSITY_RADII.values()))
+    return raster, vector, errors, frame
+
+
+@pytest.mark.parametrize('column', ['dist_to_major_road_m', 'dist_to_nearest_station_m', *POI_DENSITY_RADII])
+def test_feature_within_tolerance(comparison, column):
+    _, _, errors, frame = comparison
+    assert raster_features.tolerance_violations({column: errors[column]}, frame.pixel_size) == []
+
+
+def test_short_radii_are_exact(comparison):
+    raster, vector, _, frame = comparison
+    short = [column for column, radius in POI_DENSITY_RADII.items()
+             if radius < raster_features.MIN_RADIUS_PIXELS * frame.pixel_size]
+    assert short, "expected at least one radius below MIN_RADIUS_PIXELS on this grid"
+    for column in short:
+        np.testing.assert_array_equal(raster[column], vector[column].to_numpy())
+
+
+def test_out_of_tolerance_is_reported():
+    errors = {'poi_density_1.5m': {'exact': 0.5, 'mean': 1.0, 'relative': 0.1},
+              'dist_to_nearest_station_m': {'max_m': 500.0, 'mean_m': 10.0, 'p99_m': 100.0}}
+    violations = raster_features.tolerance_violations(errors, pixel_size=200)
+    assert len(violations) == 2
@@ -0,0 +1,79 @@
+#How station_history.py collapses the AFDC snapshots into station versions
+#    python -m pytest tests/
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, os.path.join(ROOT, 'scripts'))
+from station_history import StationHistory, build_intervals
+
+SNAPSHOTS = ['2020-12-31', '2021-12-31', '2022-12-31', '2023-12-31']
+
+
+def _history():
+    #(ID, snapshots it is listed in, Level 2 ports per snapshot, Open Date)
+    stations = [
+        ('steady', [0, 1, 2, 3], [2, 2, 2, 2], '2015-05-01'),
+        ('gap', [0, 1, 3], [4, 4, 4], None),
+        ('upgraded', [0, 1, 2, 3], [2, 2, 6, 6], '2019-01-01'),
+        ('closed', [0, 1], [1, 1], None),
+    ]
+    rows = []
+    for station_id, listed, ports, opened in stations:
+        for snapshot, port_count in zip(listed, ports):
+            rows.append({'ID': station_id, 'Latitude': 47.6, 'Longitude': -122.3, 'EV Level2 EVSE Num': port_count,
+                         'Open Date': opened, 'snapshot_date': pd.Timestamp(SNAPSHOTS[snapshot])})
+    return pd.DataFrame(rows)
+
+
+@pytest.fixture(scope='module')
+def intervals():
+    intervals, snapshots = build_intervals(_history())
+    assert list(snapshots) == list(pd.to_datetime(SNAPSHOTS))
+    return intervals
+
+
+def _versions(intervals, station_id):
+    #(valid_from, valid_to) of every version of the station, valid_to None while it is still open
+    rows = intervals[intervals['ID'] == station_id].sort_values('version')
+    return [(row.valid_from, None if pd.isna(row.valid_to) else row.valid_to) for row in rows.itertuples()]
+
+
+def test_station_listed_in_every_snapshot_stays_open(intervals):
+    #The Open Date is before the first snapshot, so the station counts from its opening
+    assert _versions(intervals, 'steady') == [(pd.Timestamp('2015-05-01'), None)]
+
+
+def test_gap_between_snapshots_starts_a_new_version(intervals):
+    assert _versions(intervals, 'gap') == [(pd.Timestamp('2020-12-31'), pd.Timestamp('2022-12-31')),
+                                           (pd.Timestamp('2023-12-31'), None)]
+
+
+def test_changed_tracked_column_starts_a_new_version(intervals):
+    #Only the first version is moved back to the Open Date
+    assert _versions(intervals, 'upgraded') == [(pd.Timestamp('2019-01-01'), pd.Timestamp('2022-12-31')),
+                                                (pd.Timestamp('2022-12-31'), None)]
+    ports = intervals[intervals['ID'] == 'upgraded'].sort_values('version')['EV Level2 EVSE Num'].tolist()
+    assert ports == [2, 6]
+
+
+def test_station_missing_from_the_last_snapshot_is_closed(intervals):
+    assert _versions(intervals, 'closed') == [(pd.Timestamp('2020-12-31'), pd.Timestamp('2022-12-31'))]
+
+
+def test_stations_as_of(intervals):
+    history = StationHistory(intervals)
+    ids, _ = history.stations_as_of('2022-06-01')
+    assert sorted(ids) == ['closed', 'gap', 'steady', 'upgraded']
+    #Between the snapshot 'gap' was missing from and the one it is back in
+    ids, _ = history.stations_as_of('2023-06-01')
+    assert sorted(ids) == ['steady', 'upgraded']
+    ids, _ = history.stations_as_of('2024-06-01')
+    assert sorted(ids) == ['gap', 'steady', 'upgraded']
+    ids, _ = history.stations_as_of('2018-01-01')
+    assert list(ids) == ['steady']
+    assert np.isfinite(history.xy).all()
@@ -0,0 +1,56 @@
+#A failed write of storage.py leaves the previous file as it was, and no temporary file behind
+#    python -m pytest tests/
+import os
+import sys
+
+import geopandas as gpd
+import pandas as pd
+import pytest
+import shapely
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, os.path.join(ROOT, 'scripts'))
+import storage
+
+
+def _points(n):
+    return gpd.GeoDataFrame({'score': range(n)}, geometry=shapely.points([[i, i] for i in range(n)]), crs=3857)
+
+
+def test_failed_write_keeps_the_old_file(tmp_path):
+    path = str(tmp_path / 'data.bin')
+    storage.atomic_write(path, b'old')
+
+    def broken(tmp_file):
+        with open(tmp_file, 'wb') as f:
+            f.write(b'half')
+        raise RuntimeError("disk full")
+
+    with pytest.raises(RuntimeError):
+        storage.atomic_write(path, broken)
+    assert open(path, 'rb').read() == b'old'
+    assert os.listdir(tmp_path) == ['data.bin']
+
+
+@pytest.mark.parametrize('fmt', ['parquet', 'feather', 'geojson'])
+def test_write_layer_replaces_the_layer(tmp_path, fmt):
+    storage.write_layer(_points(3), 'ranked_locations', fmt, base_path=str(tmp_path))
+    path = storage.write_layer(_points(5), 'ranked_locations', fmt, base_path=str(tmp_path))
+    assert os.listdir(tmp_path) == [os.path.basename(path)]
+    assert len(storage.read_layer('ranked_locations', base_path=str(tmp_path))) == 5
+
+
+def test_stream_writer_only_replaces_the_file_when_complete(tmp_path):
+    storage.write_layer(_points(3), 'ranked_locations', 'parquet', base_path=str(tmp_path))
+    path = storage.layer_path('ranked_locations', 'parquet', str(tmp_path))
+    chunk = pd.DataFrame({'score': [7, 8]})
+    with pytest.raises(RuntimeError):
+        with storage.GeoParquetStreamWriter(path, 'Point', 3857) as writer:
+            writer.write(chunk, shapely.to_wkb(shapely.points([[0, 0], [1, 1]])))
+            raise RuntimeError("interrupted")
+    assert os.listdir(tmp_path) == [os.path.basename(path)]
+    assert len(storage.read_layer('ranked_locations', base_path=str(tmp_path))) == 3
+
+    with storage.GeoParquetStreamWriter(path, 'Point', 3857) as writer:
+        writer.write(chunk, shapely.to_wkb(shapely.points([[0, 0], [1, 1]])))
+    assert storage.read_layer('ranked_locations', base_path=str(tmp_path))['score'].tolist() == [7, 8]